@@ -0,0 +1,294 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, monotonic
+
+import backpressure
+import connection
+import listener
+import metrics
+import postgres
+
+class AsyncBarsConnection():
+    '''
+    asyncio counterpart of connection.BarsConnection
+    Reads the derivative port with asyncio streams and puts the same
+    (receipt time, list of messages) batches on an asyncio.Queue
+
+    Supervised like BarsConnection (same class settings): a closed socket or
+    no data for stale_seconds reopens the connection with backoff and
+    re-watches every symbol from resume_from(symbols)
+    '''
+
+    def __init__(self,msgqueue,logger,buffer_size=None,resume_from=None):
+        self._host = connection.BarsConnection.iqfeed_host
+        self._port = connection.BarsConnection.deriv_port
+        self._version = connection.BarsConnection.protocol_version
+        self._read_size = buffer_size or connection.BarsConnection.recv_buffer_size
+
+        self._logger = logger
+        self._msgqueue = msgqueue
+
+        self._reader = None
+        self._writer = None
+        self._framer = connection.LineFramer(self._read_size)
+        self._closing = False
+
+        # Watch state replayed after a reconnect
+        self._resume_from = resume_from
+        self._watched = []
+        self._config = None
+        self._latest = {}
+
+        # Supervision counters
+        self.disconnects = 0
+        self.reconnects = 0
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self._host,self._port)
+        await self._send_cmd(f'S,SET PROTOCOL,{str(self._version)}\r\n')
+        print('Async socket connected!')
+
+    async def disconnect(self):
+        self._closing = True
+        if self._writer:
+            print('Disconnecting from IQFeed socket')
+            try:
+                await self._send_cmd('S,UNWATCH ALL\r\n')
+                self._writer.close()
+                await self._writer.wait_closed()
+            except ConnectionError:
+                print('IQFeed socket already closed')
+            self._writer = None
+
+    async def read_loop(self):
+        while not self._closing:
+            try:
+                data = await asyncio.wait_for(self._reader.read(self._read_size),
+                                              connection.BarsConnection.stale_seconds)
+            except asyncio.TimeoutError:
+                await self._reconnect(f'no data or heartbeat for {connection.BarsConnection.stale_seconds:.0f} s')
+                continue
+            except OSError as e:
+                if self._closing:
+                    return
+                await self._reconnect(e)
+                continue
+            if not data:
+                if self._closing:
+                    return
+                await self._reconnect('connection closed by IQFeed')
+                continue
+            received = perf_counter()
+            metrics.socket_bytes.inc(len(data))
+            self._framer.feed(data)
+            lines = self._framer.lines()
+            if lines:
+                # Waits while a bounded msgqueue is full - TCP holds IQFeed back
+                await self._msgqueue.put((received,[line.split(',') for line in lines]))
+
+    async def subscribe_to_symbols(self,symbols,config,latest=None):
+        self._config = config
+        self._watched += [sym for sym in symbols if sym not in self._watched]
+        self._latest.update(latest or {})
+        for sym,cmd in connection.watch_commands(symbols,config,latest):
+            await self._send_cmd(cmd)
+            self._logger.log(f'Subscribing to symbol {sym}',how='pf')
+        await asyncio.sleep(2)
+        await self._send_cmd('S,REQUEST WATCHES\r\n')
+
+    async def _send_cmd(self,cmd,echo=True):
+        self._writer.write(cmd.encode())
+        await self._writer.drain()
+        if echo:
+            print('>>>>>>>>>>>>> Sent command:',cmd[:-2])
+
+    ###########################################################################
+    # Supervision
+
+    async def _reconnect(self,reason):
+        ''' Reopen the connection with backoff until it connects or disconnect() is called '''
+        self.disconnects += 1
+        metrics.disconnects.inc()
+        dropped = perf_counter()
+        self._logger.log(f'WARNING: async reader lost the IQFeed connection ({reason}) - reconnecting',how='tfp')
+        self._close()
+        # A partial line from the old socket would corrupt the first new one
+        self._framer = connection.LineFramer(self._read_size)
+
+        delay = connection.BarsConnection.reconnect_delay
+        while not self._closing:
+            try:
+                await self.connect()
+                await self._resubscribe()
+            except OSError as e:
+                self._close()
+                print(f'Async reader: reconnect failed ({e}) - retrying in {delay:.0f} s')
+                await asyncio.sleep(delay)
+                delay = min(2 * delay,connection.BarsConnection.reconnect_max_delay)
+                continue
+            self.reconnects += 1
+            self._logger.log(f'Async reader reconnected after {perf_counter() - dropped:.1f} s - '
+                             f'{len(self._watched)} symbols re-watched',how='tfp')
+            return
+
+    async def _resubscribe(self):
+        ''' BW every watched symbol again from where its bars stopped '''
+        if not self._watched:
+            return
+        latest = dict(self._latest)
+        if self._resume_from is not None:
+            # Bars already read must reach the parser before asking where to resume
+            try:
+                await asyncio.wait_for(self._msgqueue.join(),connection.BarsConnection.drain_seconds)
+            except asyncio.TimeoutError:
+                pass
+            latest.update(self._resume_from(self._watched))
+        for _,cmd in connection.watch_commands(self._watched,self._config,latest):
+            await self._send_cmd(cmd,echo=False)
+        print(f'Async reader: re-sent {len(self._watched)} BW watches')
+
+    def _close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+class AsyncPipeline():
+    '''
+    Single event loop replacing the reader, Listener and database threads:
+    read_loop -> iq_queue -> _parse_loop (MessageHandler) -> db_queue -> _write_loop
+
+    Database writes go through DatabaseConnection.write_or_spool on one executor
+    thread, so batching, COPY/execute_values, the spool, failed batch recovery
+    and the stats match the threaded runtime. With [queues] both queues are
+    bounded (iq_size messages, db_size bars) and block: a full db_queue holds
+    the parser, a full iq_queue stops the socket being read
+    '''
+
+    def __init__(self,config,logger,symbols,db=None):
+        '''
+        db = DatabaseConnection to write through (connected here) - a new one if None
+        '''
+        self._config = config
+        self._logger = logger
+        self._symbols = symbols
+
+        self._iq_queue = backpressure.async_queue_from_config(config,'iq',logger)
+        self._db_queue = backpressure.async_queue_from_config(config,'db',logger)
+
+        # Parsed bars wait here until db_queue has room
+        self._parsed = []
+        self._handler = listener.MessageHandler(self._parsed.append,logger,symbols)
+        # Reconnects resume each symbol after the newest bar parsed
+        self._conn = AsyncBarsConnection(self._iq_queue,logger,resume_from=self._handler.resume_points)
+        self._db = db or postgres.database_connection(None,logger)
+        self._executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix='AsyncDBWriter')
+
+        self._batch_rows = config['database'].getint('batch_rows',fallback=500)
+        self._flush_seconds = config['database'].getfloat('flush_seconds',fallback=0.5)
+        self._spool_path = None
+        if config.has_section('spool') and config['spool'].getboolean('enabled',fallback=True):
+            self._spool_path = config['spool'].get('path','spool/')
+
+        self._tasks = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor,self._db.connect,False)
+        if self._spool_path:
+            await loop.run_in_executor(self._executor,self._db.enable_spool,os.path.join(self._spool_path,'async'))
+        await self._conn.connect()
+
+        self._tasks = [ asyncio.create_task(self._conn.read_loop(),name='AsyncReader'),
+                        asyncio.create_task(self._parse_loop(),name='AsyncParser'),
+                        asyncio.create_task(self._write_loop(),name='AsyncWriter')]
+
+        latest = None
+        if self._config['market'].getboolean('catchup',fallback=False):
+            latest = await loop.run_in_executor(self._executor,self._db.latest_bars,self._symbols)
+
+        await asyncio.sleep(2)
+        await self._conn.subscribe_to_symbols(self._symbols,self._config,latest)
+        print('Async pipeline initialized')
+
+    async def wait(self):
+        ''' Returns when any stage fails - a dropped socket is reconnected by the reader '''
+        done, _ = await asyncio.wait(self._tasks,return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+
+    async def stop(self):
+        ''' Unwatch, let queued messages & bars drain, then close everything '''
+        await self._conn.disconnect()
+        reader = self._tasks[0] if self._tasks else None
+        if reader and not reader.done():
+            reader.cancel()
+
+        # Bars still waiting for the database go to the spool (or are dropped) instead
+        self._db.cancel_retries()
+        # A failed stage would never drain its queue
+        if not any(task.done() for task in self._tasks[1:]):
+            print('Waiting for queues to clear')
+            await self._iq_queue.join()
+            await self._db_queue.join()
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks,return_exceptions=True)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor,self._db.disconnect)
+        self._executor.shutdown()
+
+    ###########################################################################
+    # Stages
+
+    async def _parse_loop(self):
+        while True:
+            batches = [await self._iq_queue.get()]
+            while not self._iq_queue.empty():
+                batches.append(self._iq_queue.get_nowait())
+
+            self._handler.handle_batches(batches)
+            for bar in self._parsed:
+                await self._db_queue.put(bar)
+            self._parsed.clear()
+            for _ in batches:
+                self._iq_queue.task_done()
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                pending = [await asyncio.wait_for(self._db_queue.get(),self._flush_seconds)]
+            except asyncio.TimeoutError:
+                # Idle - replay spooled bars
+                await loop.run_in_executor(self._executor,self._db.service_spool,0)
+                continue
+            deadline = monotonic() + self._flush_seconds
+
+            while len(pending) < self._batch_rows:
+                if self._db_queue.empty():
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        pending.append(await asyncio.wait_for(self._db_queue.get(),remaining))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    pending.append(self._db_queue.get_nowait())
+
+            try:
+                await loop.run_in_executor(self._executor,self._write,pending,self._db_queue.qsize())
+            finally:
+                for _ in pending:
+                    self._db_queue.task_done()
+
+    def _write(self,bars,backlog):
+        ''' Executor thread - as DatabaseConnection._flush, then replay the spool '''
+        try:
+            self._db.write_or_spool(bars,backlog)
+        except Exception as e:
+            self._db.recover_batch(bars,e)
+        self._db.service_spool(backlog)
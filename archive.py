@@ -0,0 +1,272 @@
+'''
+Columnar archive of stored bars for research & backtests
+
+    python archive.py export [--symbols SPY,QQQ] [--intervals 60,300]
+    python archive.py download 20210104 20210331 [--interval 60] [--symbols SPY,QQQ]
+
+One file per symbol, interval and day: archive/SPY/60/2021-01-04.feather
+Columns: ts (timestamp, seconds), open, high, low, close, volume, cumvol
+
+export streams each symbol's bars out of the database with COPY TO and only
+from the newest archived day on (that day is rewritten - it may have been
+exported before the close), so repeated runs only add the new days.
+download writes HIT history (historical_data_pull.stream_ticker) straight to
+the archive, plus the [resample] intervals, without going through Postgres.
+
+Feather (Arrow IPC, uncompressed) files are memory mapped on read, so a
+backtest reading years of bars does not copy them into the heap first;
+Parquet is smaller on disk but decoded on read.
+
+    [archive]
+    path = archive/
+    format = feather        feather or parquet
+    compression = zstd      parquet only
+    chunk_rows = 500000     rows per chunk read back from COPY
+'''
+
+import argparse
+import configparser
+import glob
+import os
+import tempfile
+from time import perf_counter
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+import historical_data_pull
+import mylogger
+import postgres
+import resample
+
+SCHEMA = pa.schema([('ts',pa.timestamp('s')),
+                    ('open',pa.float64()),('high',pa.float64()),('low',pa.float64()),('close',pa.float64()),
+                    ('volume',pa.int64()),('cumvol',pa.int64())])
+COLUMNS = SCHEMA.names
+
+class ArchiveStore():
+    ''' Day files of bars by symbol & interval under one root directory '''
+
+    def __init__(self,root,fmt='feather',compression='zstd'):
+        if fmt not in ('feather','parquet'):
+            raise ValueError(f'Unknown archive format {fmt} (feather or parquet)')
+        self._root = root
+        self._fmt = fmt
+        self._compression = compression
+
+    def path_for(self,symbol,interval,day):
+        ''' day = YYYY-MM-DD '''
+        return os.path.join(self._root,symbol,str(interval),f'{day}.{self._fmt}')
+
+    def days(self,symbol,interval):
+        ''' Archived days (YYYY-MM-DD), oldest first '''
+        paths = glob.glob(os.path.join(self._root,symbol,str(interval),f'*.{self._fmt}'))
+        return sorted(os.path.basename(path)[:10] for path in paths)
+
+    def last_day(self,symbol,interval):
+        days = self.days(symbol,interval)
+        return days[-1] if days else None
+
+    ###########################################################################
+    # Writing
+
+    def write_frame(self,symbol,interval,df):
+        '''
+        df = bars with a datetime ts column and the other COLUMNS, any number of
+        days - each day replaces its file. Returns the days written
+        '''
+        if df is None or len(df) == 0:
+            return []
+        df = df.drop_duplicates('ts').sort_values('ts')
+        written = []
+        for day,group in df.groupby(df['ts'].dt.strftime('%Y-%m-%d'),sort=True):
+            table = pa.Table.from_pandas(group[COLUMNS],schema=SCHEMA,preserve_index=False)
+            self._write_file(self.path_for(symbol,interval,day),table)
+            written.append(day)
+        return written
+
+    def _write_file(self,path,table):
+        ''' Written next to the target and renamed over it, so readers never see half a file '''
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        tmp = path + '.tmp'
+        if self._fmt == 'feather':
+            feather.write_feather(table,tmp,compression='uncompressed')
+        else:
+            pq.write_table(table,tmp,compression=self._compression)
+        os.replace(tmp,path)
+
+    ###########################################################################
+    # Reading
+
+    def read(self,symbol,interval,start=None,end=None,columns=None):
+        '''
+        pyarrow.Table of the days from start to end (YYYY-MM-DD, inclusive) -
+        feather columns are zero copy views of the memory mapped files
+        '''
+        days = [d for d in self.days(symbol,interval) if (start is None or d >= start) and (end is None or d <= end)]
+        tables = []
+        for day in days:
+            path = self.path_for(symbol,interval,day)
+            if self._fmt == 'feather':
+                tables.append(feather.read_table(path,columns=columns,memory_map=True))
+            else:
+                tables.append(pq.read_table(path,columns=columns,memory_map=True))
+        if not tables:
+            return SCHEMA.empty_table() if columns is None else SCHEMA.empty_table().select(columns)
+        table = pa.concat_tables(tables)
+        if self._fmt == 'parquet':
+            # Parquet has no second resolution timestamps - ts comes back in ms
+            table = table.cast(pa.schema([SCHEMA.field(name) for name in table.column_names]))
+        return table
+
+    def read_frame(self,symbol,interval,start=None,end=None,columns=None):
+        ''' Same as read, as a pandas DataFrame '''
+        return self.read(symbol,interval,start,end,columns).to_pandas()
+
+def store_from_config(config):
+    section = config['archive'] if config.has_section('archive') else {}
+    return ArchiveStore(section.get('path','archive/'),section.get('format','feather'),
+                        section.get('compression','zstd'))
+
+def chunk_rows_from_config(config):
+    section = config['archive'] if config.has_section('archive') else {}
+    return int(section.get('chunk_rows',500000))
+
+###############################################################################
+# Database -> archive
+
+def export_symbol(db,store,symbol,interval,chunk_rows=500000):
+    '''
+    COPY the symbol's bars of interval from the newest archived day on into the
+    archive - returns rows exported. The COPY output is spooled to a temporary
+    file and read back chunk_rows at a time, so memory stays flat.
+    '''
+    since = store.last_day(symbol,interval)
+    rows = 0
+    with tempfile.SpooledTemporaryFile(max_size=64 << 20,mode='w+') as f:
+        db.copy_out(db.export_query(symbol,interval,since),f)
+        f.seek(0)
+        carry = None
+        for chunk in pd.read_csv(f,sep='\t',header=None,names=COLUMNS,parse_dates=['ts'],chunksize=chunk_rows):
+            if carry is not None:
+                chunk = pd.concat([carry,chunk],ignore_index=True)
+            # Rows are in time order - the last day may continue in the next chunk
+            days = chunk['ts'].dt.normalize()
+            last = days.iloc[-1]
+            carry = chunk[days == last]
+            rows += len(chunk) - len(carry)
+            store.write_frame(symbol,interval,chunk[days < last])
+        if carry is not None:
+            rows += len(carry)
+            store.write_frame(symbol,interval,carry)
+    return rows
+
+def export_all(db,store,symbols,intervals,logger,chunk_rows=500000):
+    '''
+    intervals = {symbol: intervals stored for it} - returns {(symbol, interval): rows}
+    A series that fails (e.g. no table for it) is logged and skipped
+    '''
+    exported = {}
+    started = perf_counter()
+    for sym in symbols:
+        for interval in intervals.get(sym,[]):
+            t = perf_counter()
+            try:
+                rows = export_symbol(db,store,sym,interval,chunk_rows)
+            except Exception as e:
+                logger.log(f'Archive: {sym} {interval}s export failed - {e}',how='fp')
+                continue
+            exported[(sym,interval)] = rows
+            elapsed = perf_counter() - t
+            logger.log(f'Archive: {sym} {interval}s {rows:,} rows in {elapsed:.1f} s '
+                       f'({rows / max(elapsed,1e-9):,.0f} rows/sec)',how='fp')
+    total = sum(exported.values())
+    logger.log(f'Archive export done: {total:,} rows in {perf_counter() - started:.1f} s',how='fp')
+    return exported
+
+###############################################################################
+# IQFeed history -> archive
+
+def download_symbol(store,symbol,interval,start_date,end_date,derived=()):
+    '''
+    HIT history of start_date..end_date (YYYYMMDD) written straight to the
+    archive, plus the derived intervals resampled from each whole day - returns rows
+    '''
+    rows = 0
+    carry = None
+    for block in historical_data_pull.stream_ticker(symbol,interval,start_date,end_date):
+        block = block.rename(columns={'openinterest':'cumvol'})
+        if carry is not None:
+            block = pd.concat([carry,block],ignore_index=True)
+        last = block['date'].iloc[-1]
+        carry = block[block['date'] == last]
+        rows += _archive_days(store,symbol,interval,block[block['date'] != last],derived)
+    if carry is not None:
+        rows += _archive_days(store,symbol,interval,carry,derived)
+    return rows
+
+def _archive_days(store,symbol,interval,df,derived):
+    ''' df = whole days of HIT bars (date, time, OHLC, volume, cumvol columns) '''
+    if len(df) == 0:
+        return 0
+    store.write_frame(symbol,interval,_with_ts(df))
+    for k in derived:
+        if k % interval == 0:
+            store.write_frame(symbol,k,_with_ts(resample.resample_frame(df,k)))
+    return len(df)
+
+def _with_ts(df):
+    return df.assign(ts=pd.to_datetime(df['date'] + ' ' + df['time']))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Columnar (Feather/Parquet) archive of bars')
+    commands = parser.add_subparsers(dest='command',required=True)
+    export_cmd = commands.add_parser('export',help='new days from the database')
+    export_cmd.add_argument('--symbols',default=None,help='comma separated (default: config.ini)')
+    export_cmd.add_argument('--intervals',default=None,help='comma separated seconds (default: base + [resample])')
+    download_cmd = commands.add_parser('download',help='IQFeed history straight to the archive')
+    download_cmd.add_argument('start_date',help='YYYYMMDD')
+    download_cmd.add_argument('end_date',help='YYYYMMDD')
+    download_cmd.add_argument('--interval',type=int,default=None,help='seconds per bar (default: config.ini)')
+    download_cmd.add_argument('--symbols',default=None,help='comma separated (default: config.ini)')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+
+    pwd = configparser.ConfigParser()
+    pwd.read('user.pwd')
+
+    mylog = mylogger.Logger(    pwd['telegram']['botToken'],
+                                pwd['telegram']['chatID'],
+                                config['system']['log_path'])
+
+    store = store_from_config(config)
+    symbols = (args.symbols or config['market']['symbols']).split(',')
+    base = config['market'].getint('interval_seconds')
+    derived = resample.intervals_from_config(config,symbols)
+
+    try:
+        if args.command == 'export':
+            if args.intervals:
+                wanted = [int(k) for k in args.intervals.split(',')]
+                intervals = {sym: wanted for sym in symbols}
+            else:
+                intervals = {sym: [base] + derived.get(sym,[]) for sym in symbols}
+            db = postgres.database_connection(None,mylog)
+            db.connect(start_thread=False,check_tables=False)
+            try:
+                export_all(db,store,symbols,intervals,mylog,chunk_rows_from_config(config))
+            finally:
+                db.disconnect()
+        else:
+            interval = args.interval or base
+            for sym in symbols:
+                started = perf_counter()
+                rows = download_symbol(store,sym,interval,args.start_date,args.end_date,derived.get(sym,[]))
+                mylog.log(f'Archive: {sym} {rows:,} HIT rows in {perf_counter() - started:.1f} s',how='fp')
+    finally:
+        mylog.close()
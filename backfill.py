@@ -0,0 +1,196 @@
+'''
+Parallel historical backfill into the per-symbol bar tables
+
+    python backfill.py 20210104 20210331 [--interval 60] [--symbols SPY,QQQ]
+
+Each symbol's date range is split into chunks of chunk_days. Chunks are
+requested (HIT) in parallel over a bounded pool of port-9100 connections,
+retried on failure, and each chunk is COPY'd into its table on arrival.
+The [resample] intervals are derived from each chunk and stored as well.
+'''
+
+import argparse
+import configparser
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from time import sleep, perf_counter
+
+import pandas as pd
+
+import historical_data_pull
+import mylogger
+import dbpool
+import resample
+
+class HistoryConnectionPool():
+    ''' Bounded pool of sockets to the historical data port, opened lazily '''
+
+    def __init__(self,size,timeout=20):
+        self._size = size
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._all = set()
+
+    @contextmanager
+    def connection(self):
+        ''' Yields a socket - a socket that raised is closed instead of returned to the pool '''
+        self._slots.acquire()
+        sock = None
+        try:
+            try:
+                sock = self._idle.get_nowait()
+            except queue.Empty:
+                sock = historical_data_pull.open_historical_socket(self._timeout)
+                with self._lock:
+                    self._all.add(sock)
+            yield sock
+        except Exception:
+            if sock is not None:
+                self._discard(sock)
+            raise
+        else:
+            self._idle.put(sock)
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            socks = list(self._all)
+            self._all.clear()
+        for sock in socks:
+            sock.close()
+
+    def _discard(self,sock):
+        with self._lock:
+            self._all.discard(sock)
+        sock.close()
+
+class BackfillEngine():
+
+    def __init__(self,db,logger,connections=8,chunk_days=5,retries=3,derived=None):
+        '''
+        db = connected postgres.DatabaseConnection or dbpool.WriterPool (thread not required)
+        connections = max simultaneous port-9100 requests
+        chunk_days = calendar days per HIT request
+        retries = attempts per chunk after the first one fails
+        derived = {symbol: intervals} resampled from every chunk (resample.intervals_from_config)
+        '''
+        self._db = db
+        self._derived = derived or {}
+        self._logger = logger
+        self._pool = HistoryConnectionPool(connections)
+        self._connections = connections
+        self._chunk_days = chunk_days
+        self._retries = retries
+
+    def run(self,symbols,interval,start_date,end_date):
+        '''
+        start & end dates: YYYYMMDD
+        Returns {symbol: rows written}; failed chunks are logged and skipped
+        '''
+        for sym in symbols:
+            self._db.ensure_table(sym)
+            for k in self._derived.get(sym,[]):
+                self._db.ensure_table(sym,k)
+
+        jobs = [(sym,s,e) for sym in symbols for s,e in self.chunks(start_date,end_date)]
+        self._logger.log(f'Backfill: {len(symbols)} symbols, {len(jobs)} chunks, {self._connections} connections',how='pf')
+
+        rows = {sym: 0 for sym in symbols}
+        failed = []
+        started = perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=self._connections,thread_name_prefix='Backfill') as pool:
+                futures = {pool.submit(self._backfill_chunk,sym,interval,s,e): (sym,s,e) for sym,s,e in jobs}
+                for future in as_completed(futures):
+                    sym,s,e = futures[future]
+                    try:
+                        rows[sym] += future.result()
+                    except Exception:
+                        failed.append((sym,s,e))
+        finally:
+            self._pool.close_all()
+
+        elapsed = perf_counter() - started
+        total = sum(rows.values())
+        msg = f'Backfill done: {total:,} rows in {elapsed:.1f} s ({total / max(elapsed,1e-9):,.0f} rows/sec), {len(failed)} chunks failed'
+        self._logger.log(msg,how='tfp')
+        for sym,s,e in failed:
+            self._logger.log(f'Backfill FAILED: {sym} {s}-{e}',how='fp')
+        return rows
+
+    def chunks(self,start_date,end_date):
+        ''' (start, end) YYYYMMDD pairs covering the range, chunk_days per pair '''
+        out = []
+        day = pd.Timestamp(str(start_date))
+        last = pd.Timestamp(str(end_date))
+        step = pd.Timedelta(self._chunk_days - 1,'D')
+        while day <= last:
+            chunk_end = min(day + step,last)
+            out.append((day.strftime('%Y%m%d'),chunk_end.strftime('%Y%m%d')))
+            day = chunk_end + pd.Timedelta(1,'D')
+        return out
+
+    def _backfill_chunk(self,symbol,interval,start_date,end_date):
+        df = self._download(symbol,interval,start_date,end_date)
+        if df is None:
+            return 0
+        df = df.rename(columns={'openinterest':'cumvol'})
+        rows = self._db.write_frame(symbol,df)
+        # Chunks are whole days, so every derived bucket is complete
+        for k in self._derived.get(symbol,[]):
+            if k % interval == 0:
+                self._db.write_frame(symbol,resample.resample_frame(df,k),k)
+        return rows
+
+    def _download(self,symbol,interval,start_date,end_date):
+        for attempt in range(self._retries + 1):
+            try:
+                with self._pool.connection() as sock:
+                    return historical_data_pull.download_ticker(symbol,interval,start_date,end_date,sock=sock)
+            except Exception as e:
+                if attempt == self._retries:
+                    self._logger.log(f'Backfill chunk {symbol} {start_date}-{end_date} failed: {e}',how='fp')
+                    print(traceback.format_exc())
+                    raise
+                sleep(2 ** attempt)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Parallel historical bar backfill')
+    parser.add_argument('start_date',help='YYYYMMDD')
+    parser.add_argument('end_date',help='YYYYMMDD')
+    parser.add_argument('--interval',type=int,default=None,help='seconds per bar (default: config.ini)')
+    parser.add_argument('--symbols',default=None,help='comma separated (default: config.ini)')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+
+    pwd = configparser.ConfigParser()
+    pwd.read('user.pwd')
+
+    mylog = mylogger.Logger(    pwd['telegram']['botToken'],
+                                pwd['telegram']['chatID'],
+                                config['system']['log_path'])
+
+    symbols = (args.symbols or config['market']['symbols']).split(',')
+    interval = args.interval or config['market'].getint('interval_seconds')
+
+    db = dbpool.database_writer(None,mylog)
+    db.connect(start_thread=False)
+    try:
+        engine = BackfillEngine(db,mylog,
+                                connections=config['backfill'].getint('connections',fallback=8),
+                                chunk_days=config['backfill'].getint('chunk_days',fallback=5),
+                                retries=config['backfill'].getint('retries',fallback=3),
+                                derived=resample.intervals_from_config(config,symbols))
+        engine.run(symbols,interval,args.start_date,args.end_date)
+    finally:
+        db.disconnect()
+        mylog.close()
@@ -0,0 +1,309 @@
+'''
+Bounded queues between pipeline stages, with an overload policy per queue
+
+    block     put waits for room - the stage before stalls (for iq_queue the
+              socket stops being read and TCP holds IQFeed back)
+    spill     items beyond the bound go to a temporary file and come back in
+              order once the consumer catches up - nothing waits, memory is flat
+    coalesce  iq_queue only: when full, BU updates superseded by a later BU of
+              the same request ID still in the queue are dropped; if that does
+              not free room the put waits as with block
+
+No policy ever drops a BC or BH bar. Crossing high_water of the bound logs a
+warning through the Logger (re-armed below half of high_water), and every
+spill episode is logged when it starts and ends. The asyncio runtime's queues
+(AsyncBoundedQueue) and the per-writer queues of dbpool.WriterPool always block.
+
+    [queues]
+    iq_size = 50000         messages per shard iq_queue
+    iq_policy = block       block, spill or coalesce
+    db_size = 100000        bars in db_queue
+    db_policy = block       block or spill
+    high_water = 0.8
+    spill_path = spill/
+'''
+
+import asyncio
+import os
+import pickle
+import queue
+import tempfile
+from time import monotonic
+
+POLICIES = ('block','spill','coalesce')
+
+class _DiskSpill():
+    ''' Append-only temporary file of pickled items read back in order - truncated whenever it empties '''
+
+    def __init__(self,directory):
+        os.makedirs(directory,exist_ok=True)
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._read_at = 0
+        self._write_at = 0
+        self.count = 0
+
+    def push(self,item):
+        self._file.seek(self._write_at)
+        pickle.dump(item,self._file,pickle.HIGHEST_PROTOCOL)
+        self._write_at = self._file.tell()
+        self.count += 1
+
+    def pop(self):
+        self._file.seek(self._read_at)
+        item = pickle.load(self._file)
+        self._read_at = self._file.tell()
+        self.count -= 1
+        if self.count == 0:
+            self._file.seek(0)
+            self._file.truncate()
+            self._read_at = self._write_at = 0
+        return item
+
+    def close(self):
+        self._file.close()
+
+class _HighWater():
+    ''' Peak & high water mark alerts on self._weight - notes are logged by the queue '''
+
+    def _init_high_water(self,size,name,logger,high_water,weigh):
+        self.size = size
+        self.name = name
+        self._logger = logger
+        self._weigh = weigh
+        self._high = max(1,int(size * high_water))
+        self._low = self._high // 2
+        self._alerted = False
+        self._notes = []        # log messages, logged once the queue is released
+
+        # Overload counters (read by maybe_report / metrics)
+        self.peak = 0
+        self.waits = 0          # puts that waited for room
+
+    def _check_high_water(self):
+        if self._weight > self.peak:
+            self.peak = self._weight
+        if not self._alerted and self._weight >= self._high:
+            self._alerted = True
+            self._notes.append(f'WARNING: {self.name} above high water mark: {self._weight:,}/{self.size:,} ({self.policy})')
+        elif self._alerted and self._weight <= self._low:
+            self._alerted = False
+            self._notes.append(f'{self.name} back under high water mark: {self._weight:,}/{self.size:,}')
+
+    def _emit_notes(self,notes):
+        for msg in notes:
+            if self._logger is not None:
+                self._logger.log(msg,how='tfp')
+            else:
+                print(msg)
+
+class BoundedQueue(_HighWater,queue.Queue):
+    '''
+    queue.Queue bounded by the total weight of its items (weigh(item), default 1)
+    with an overload policy - get, task_done & join work as usual, qsize()
+    counts items in memory and spilled, depth() is the weight in memory
+    '''
+
+    def __init__(self,size,policy='block',name='queue',logger=None,high_water=0.8,
+                 weigh=None,spill_path='spill/'):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown queue policy {policy} (one of {POLICIES})')
+        super().__init__()
+        self._init_high_water(size,name,logger,high_water,weigh)
+        self.policy = policy
+        self._spill_path = spill_path
+        self._spill = None
+
+        self.spilled = 0        # items written to disk
+        self.coalesced = 0      # BU messages dropped
+
+    ###########################################################################
+    # queue.Queue hooks - called with self.mutex held
+
+    def _init(self,maxsize):
+        super()._init(maxsize)
+        self._weight = 0
+
+    def _qsize(self):
+        return len(self.queue) + (self._spill.count if self._spill else 0)
+
+    def _put(self,item):
+        self.queue.append(item)
+        self._weight += self._weigh(item) if self._weigh else 1
+
+    def _get(self):
+        if self.queue:
+            item = self.queue.popleft()
+            self._weight -= self._weigh(item) if self._weigh else 1
+            self._check_high_water()
+            return item
+        item = self._spill.pop()
+        if self._spill.count == 0:
+            self._notes.append(f'{self.name}: spill drained ({self.spilled:,} items spilled so far)')
+        self._check_high_water()
+        return item
+
+    ###########################################################################
+
+    def put(self,item,block=True,timeout=None):
+        with self.not_full:
+            if self.policy == 'spill' and ((self._spill and self._spill.count) or self._weight >= self.size):
+                # Once spilling, everything goes to disk until it drains - keeps the order
+                if self._spill is None:
+                    self._spill = _DiskSpill(self._spill_path)
+                if self._spill.count == 0:
+                    self._notes.append(f'WARNING: {self.name} full ({self._weight:,}/{self.size:,}) - spilling to disk')
+                self._spill.push(item)
+                self.spilled += 1
+            else:
+                if self._weight >= self.size and self.policy == 'coalesce':
+                    dropped = coalesce_updates(self.queue)
+                    self._weight -= dropped
+                    self.coalesced += dropped
+                if self._weight >= self.size:
+                    if not block:
+                        raise queue.Full
+                    self.waits += 1
+                    deadline = None if timeout is None else monotonic() + timeout
+                    while self._weight >= self.size:
+                        remaining = None if deadline is None else deadline - monotonic()
+                        if remaining is not None and remaining <= 0:
+                            raise queue.Full
+                        self.not_full.wait(remaining)
+                self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            self._check_high_water()
+        if self._notes:
+            self._log_notes()
+
+    def get(self,block=True,timeout=None):
+        item = super().get(block,timeout)
+        if self._notes:
+            self._log_notes()
+        return item
+
+    def depth(self):
+        ''' Weight held in memory '''
+        with self.mutex:
+            return self._weight
+
+    def stats(self):
+        return {'depth': self._weight,'size': self.size,'peak': self.peak,'waits': self.waits,
+                'spilled': self.spilled,'on_disk': self._spill.count if self._spill else 0,
+                'coalesced': self.coalesced}
+
+    def _log_notes(self):
+        # Logged outside the mutex
+        with self.mutex:
+            notes, self._notes = self._notes, []
+        self._emit_notes(notes)
+
+class AsyncBoundedQueue(_HighWater,asyncio.Queue):
+    '''
+    asyncio.Queue bounded by the total weight of its items (weigh(item), default 1)
+    - put waits for room (policy block only), depth() is the weight queued
+    '''
+
+    policy = 'block'
+
+    def __init__(self,size,name='queue',logger=None,high_water=0.8,weigh=None):
+        super().__init__()
+        self._init_high_water(size,name,logger,high_water,weigh)
+
+    # asyncio.Queue hooks
+
+    def _init(self,maxsize):
+        super()._init(maxsize)
+        self._weight = 0
+
+    def _put(self,item):
+        super()._put(item)
+        self._weight += self._weigh(item) if self._weigh else 1
+        self._check_high_water()
+
+    def _get(self):
+        item = super()._get()
+        self._weight -= self._weigh(item) if self._weigh else 1
+        self._check_high_water()
+        return item
+
+    def full(self):
+        return self._weight >= self.size
+
+    async def put(self,item):
+        if self.full():
+            self.waits += 1
+        await super().put(item)
+
+    def put_nowait(self,item):
+        super().put_nowait(item)
+        self._flush_notes()
+
+    def get_nowait(self):
+        item = super().get_nowait()
+        self._flush_notes()
+        return item
+
+    def depth(self):
+        return self._weight
+
+    def _flush_notes(self):
+        if self._notes:
+            notes, self._notes = self._notes, []
+            self._emit_notes(notes)
+
+def coalesce_updates(items):
+    '''
+    items = iq_queue batches (receipt time, list of messages) oldest first -
+    drops every BU message with a later BU of the same request ID in items,
+    in place, and returns how many were dropped (other messages are kept)
+    '''
+    seen = set()
+    dropped = 0
+    for _,messages in reversed(items):
+        keep = []
+        for fields in reversed(messages):
+            if len(fields) > 1 and fields[1] == 'BU' and fields[0][:1] == 'B':
+                if fields[0] in seen:
+                    dropped += 1
+                    continue
+                seen.add(fields[0])
+            keep.append(fields)
+        if len(keep) != len(messages):
+            keep.reverse()
+            messages[:] = keep
+    return dropped
+
+def batch_messages(item):
+    ''' weigh for iq_queue: messages in one socket read '''
+    return len(item[1])
+
+def queue_from_config(config,stage,logger,name=None,parts=1,policy=None):
+    '''
+    BoundedQueue for stage 'iq' (weighed in messages) or 'db' (bars) from
+    [queues] - an unbounded queue.Queue if the section is missing
+    parts = queues sharing the bound (each gets 1/parts of it), policy = instead of the configured one
+    '''
+    if not config.has_section('queues'):
+        return queue.Queue()
+    section = config['queues']
+    policy = policy or section.get(f'{stage}_policy','block')
+    if stage != 'iq' and policy == 'coalesce':
+        print(f'WARNING: coalesce only applies to iq_queue - {stage}_queue blocks instead')
+        policy = 'block'
+    return BoundedQueue(max(1,_stage_size(section,stage) // parts),
+                        policy,name or f'{stage}_queue',logger,section.getfloat('high_water',fallback=0.8),
+                        batch_messages if stage == 'iq' else None,section.get('spill_path','spill/'))
+
+def async_queue_from_config(config,stage,logger,name=None):
+    ''' AsyncBoundedQueue as queue_from_config - an unbounded asyncio.Queue if [queues] is missing '''
+    if not config.has_section('queues'):
+        return asyncio.Queue()
+    section = config['queues']
+    if section.get(f'{stage}_policy','block') != 'block':
+        print(f'WARNING: the asyncio runtime only blocks - {stage}_policy ignored')
+    return AsyncBoundedQueue(_stage_size(section,stage),name or f'{stage}_queue',logger,
+                             section.getfloat('high_water',fallback=0.8),batch_messages if stage == 'iq' else None)
+
+def _stage_size(section,stage):
+    return section.getint(f'{stage}_size',fallback=50000 if stage == 'iq' else 100000)
@@ -0,0 +1,183 @@
+import json
+import socketserver
+import threading
+import numpy as np
+
+class SymbolRing():
+    '''
+    The most recent `depth` bars of one symbol/interval as NumPy ring buffers
+    Older bars than the newest one are ignored; a bar with the same timestamp
+    replaces the newest one (history replays, corrections)
+    '''
+
+    columns = ('ts','open','high','low','close','volume')
+
+    def __init__(self,depth):
+        self._depth = depth
+        self._lock = threading.Lock()
+        self._ts = np.zeros(depth,dtype=np.int64)
+        self._open = np.zeros(depth,dtype=np.float64)
+        self._high = np.zeros(depth,dtype=np.float64)
+        self._low = np.zeros(depth,dtype=np.float64)
+        self._close = np.zeros(depth,dtype=np.float64)
+        self._volume = np.zeros(depth,dtype=np.int64)
+        self._next = 0      # slot the next bar is written to
+        self._count = 0
+
+    def append(self,bar):
+        with self._lock:
+            if self._count:
+                newest = (self._next - 1) % self._depth
+                if bar.ts < self._ts[newest]:
+                    return
+                i = newest if bar.ts == self._ts[newest] else self._next
+            else:
+                i = self._next
+            self._ts[i] = bar.ts
+            self._open[i] = bar.open
+            self._high[i] = bar.high
+            self._low[i] = bar.low
+            self._close[i] = bar.close
+            self._volume[i] = bar.volume
+            if i == self._next:
+                self._next = (self._next + 1) % self._depth
+                self._count = min(self._count + 1,self._depth)
+
+    def latest(self):
+        ''' dict of the newest bar's values, or None '''
+        with self._lock:
+            if not self._count:
+                return None
+            i = (self._next - 1) % self._depth
+            return {'ts': int(self._ts[i]),'open': float(self._open[i]),'high': float(self._high[i]),
+                    'low': float(self._low[i]),'close': float(self._close[i]),'volume': int(self._volume[i])}
+
+    def last(self,n):
+        ''' dict of column arrays (copies, oldest first) of the last n bars '''
+        with self._lock:
+            n = min(n,self._count)
+            idx = (np.arange(self._next - n,self._next)) % self._depth
+            return {'ts': self._ts[idx],'open': self._open[idx],'high': self._high[idx],
+                    'low': self._low[idx],'close': self._close[idx],'volume': self._volume[idx]}
+
+    def vwap(self,n):
+        ''' Volume weighted typical price (H+L+C)/3 of the last n bars, None without volume '''
+        cols = self.last(n)
+        volume = cols['volume']
+        total = volume.sum()
+        if total == 0:
+            return None
+        typical = (cols['high'] + cols['low'] + cols['close']) / 3
+        return float((typical * volume).sum() / total)
+
+class BarCache():
+    '''
+    Rolling in-memory cache of recent bars per (symbol, interval), fed with
+    every complete bar from MessageHandler (see add_bar_listener)
+
+    depths = {interval seconds: bars kept}, default_depth for other intervals
+    Reads are thread safe and never touch the database.
+    '''
+
+    def __init__(self,default_depth=1000,depths=None):
+        self._default_depth = default_depth
+        self._depths = depths or {}
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def update(self,bar):
+        self._ring(bar.symbol,bar.interval,create=True).append(bar)
+
+    def latest(self,symbol,interval):
+        ring = self._ring(symbol,interval)
+        return ring.latest() if ring else None
+
+    def last(self,symbol,interval,n):
+        ring = self._ring(symbol,interval)
+        return ring.last(n) if ring else None
+
+    def vwap(self,symbol,interval,n):
+        ring = self._ring(symbol,interval)
+        return ring.vwap(n) if ring else None
+
+    def keys(self):
+        with self._lock:
+            return list(self._rings)
+
+    def _ring(self,symbol,interval,create=False):
+        key = (symbol,interval)
+        ring = self._rings.get(key)
+        if ring is None and create:
+            with self._lock:
+                ring = self._rings.get(key)
+                if ring is None:
+                    ring = SymbolRing(self._depths.get(interval,self._default_depth))
+                    self._rings[key] = ring
+        return ring
+
+def cache_from_config(config):
+    '''
+    [cache]
+    depth = 1000            bars kept per symbol/interval
+    depths = 60:2000,300:500  per interval overrides
+    '''
+    section = config['cache'] if config.has_section('cache') else {}
+    depths = {}
+    for item in section.get('depths','').split(','):
+        if item.strip():
+            interval, depth = item.split(':')
+            depths[int(interval)] = int(depth)
+    return BarCache(int(section.get('depth',1000)),depths)
+
+###############################################################################
+# Local endpoint for other processes
+
+class _CacheHandler(socketserver.StreamRequestHandler):
+    '''
+    One JSON reply line per request line:
+    LATEST <symbol> <interval>
+    LAST <symbol> <interval> <n>
+    VWAP <symbol> <interval> <n>
+    '''
+
+    def handle(self):
+        for raw in self.rfile:
+            parts = raw.decode().split()
+            try:
+                reply = self._answer(parts)
+            except (ValueError,IndexError,KeyError) as e:
+                reply = {'error': str(e)}
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+
+    def _answer(self,parts):
+        cache = self.server.cache
+        cmd, symbol, interval = parts[0].upper(), parts[1], int(parts[2])
+        if cmd == 'LATEST':
+            return cache.latest(symbol,interval)
+        if cmd == 'LAST':
+            cols = cache.last(symbol,interval,int(parts[3]))
+            return {k: v.tolist() for k,v in cols.items()} if cols else None
+        if cmd == 'VWAP':
+            return cache.vwap(symbol,interval,int(parts[3]))
+        raise ValueError(f'Unknown request {cmd}')
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class CacheServer():
+    ''' Serves a BarCache on a localhost port (see _CacheHandler for the protocol) '''
+
+    def __init__(self,cache,port,host='127.0.0.1'):
+        self._server = _Server((host,port),_CacheHandler)
+        self._server.cache = cache
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,name='CacheServer',daemon=True)
+
+    def start(self):
+        self._thread.start()
+        print(f'Bar cache served on port {self.port}')
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,87 @@
+from datetime import date
+from functools import lru_cache
+
+# Days from 0001-01-01 (ordinal 1) to 1970-01-01
+_EPOCH_ORDINAL = date(1970,1,1).toordinal()
+
+class Bar():
+    '''
+    One interval bar on the hot path, parsed once from the derivative port
+
+    ts = bar timestamp in epoch seconds of the exchange wall clock (no time zone
+         conversion - 2021-01-04 09:31:00 is stored as if it were UTC)
+    open/high/low/close = float, volume/cumvol = int
+    kind = 'H' history, 'C' complete live bar, 'U' update
+    interval = bar length in seconds (None if unknown)
+    received/dequeued = perf_counter() at socket receipt & queue pull (latency metrics only)
+    '''
+
+    __slots__ = ('symbol','kind','ts','open','high','low','close','volume','cumvol',
+                 'interval','received','dequeued')
+
+    def __init__(self,symbol,kind,ts,open,high,low,close,volume,cumvol,interval=None,
+                 received=None,dequeued=None):
+        self.symbol = symbol
+        self.kind = kind
+        self.ts = ts
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.cumvol = cumvol
+        self.interval = interval
+        self.received = received
+        self.dequeued = dequeued
+
+    def __repr__(self):
+        return (f'Bar({self.symbol} {self.kind} {self.date} {self.time} '
+                f'O={self.open} H={self.high} L={self.low} C={self.close} V={self.volume} CV={self.cumvol})')
+
+    @property
+    def date(self):
+        ''' 'YYYY-MM-DD' '''
+        return day_string(self.ts // 86400)
+
+    @property
+    def time(self):
+        ''' 'HH:MM:SS' '''
+        secs = self.ts % 86400
+        return f'{secs // 3600:02d}:{secs // 60 % 60:02d}:{secs % 60:02d}'
+
+    def row(self):
+        ''' Column values in DatabaseConnection.bar_columns order '''
+        return (self.symbol,self.date,self.time,self.open,self.high,self.low,
+                self.close,self.volume,self.cumvol)
+
+def parse_bar(fields,received=None,dequeued=None):
+    '''
+    fields = [RequestID],B[type],[Symbol],[YYYY-MM-DD HH:MM:SS],[Open],[High],[Low],
+             [Close],[CumulativeVolume],[IntervalVolume],[NumberOfTrades]
+    The interval is read from the request ID (B-[Symbol]-[Interval], see connection.watch_commands)
+    '''
+    return Bar( fields[2],fields[1][1],stamp_epoch(fields[3]),
+                float(fields[4]),float(fields[5]),float(fields[6]),float(fields[7]),
+                int(fields[9]),int(fields[8]),request_interval(fields[0]),received,dequeued)
+
+def stamp_epoch(stamp):
+    ''' 'YYYY-MM-DD HH:MM:SS' -> epoch seconds (see Bar.ts) '''
+    return (day_epoch(stamp[:10])
+            + int(stamp[11:13]) * 3600 + int(stamp[14:16]) * 60 + int(stamp[17:19]))
+
+@lru_cache(maxsize=4096)
+def request_interval(request_id):
+    ''' 'B-SPY-60' -> 60 '''
+    suffix = request_id[request_id.rfind('-') + 1:]
+    return int(suffix) if suffix.isdigit() else None
+
+@lru_cache(maxsize=4096)
+def day_epoch(day):
+    ''' 'YYYY-MM-DD' -> epoch seconds at midnight '''
+    d = date(int(day[:4]),int(day[5:7]),int(day[8:10]))
+    return (d.toordinal() - _EPOCH_ORDINAL) * 86400
+
+@lru_cache(maxsize=4096)
+def day_string(days):
+    ''' Days since epoch -> 'YYYY-MM-DD' '''
+    return date.fromordinal(days + _EPOCH_ORDINAL).isoformat()
@@ -0,0 +1,159 @@
+'''
+Micro-benchmark: old str framer vs LineFramer on derivative-port traffic
+
+Record live traffic (needs IQConnect running):
+    python bench_framing.py record traffic.bin --seconds 60 --symbols SPY,QQQ
+
+Compare framers on a recording (or on synthetic bars if no file is given):
+    python bench_framing.py run [traffic.bin] --chunk 1024 --repeat 5
+'''
+
+import argparse
+import socket
+import time
+from time import perf_counter
+
+from connection import BarsConnection, LineFramer
+
+###############################################################################
+# The framing code BarsConnection used before LineFramer, kept for comparison
+
+class StrFramer():
+
+    def __init__(self):
+        self._buffered_data = ''
+
+    def recv(self,sock,size=1024):
+        data_received = sock.recv(size).decode()
+        self._buffered_data += data_received
+        return len(data_received)
+
+    def lines(self):
+        out = []
+        message = self._next_message()
+        while message != '':
+            out.append(message)
+            message = self._next_message()
+        return out
+
+    def _next_message(self):
+        next_delim = self._buffered_data.find('\n')
+        if next_delim != -1:
+            message = self._buffered_data[:next_delim].strip()
+            self._buffered_data = self._buffered_data[(next_delim + 1):]
+            return message
+        else:
+            return ''
+
+###############################################################################
+
+class ReplaySocket():
+    ''' Serves recorded bytes through recv / recv_into, at most chunk bytes per call '''
+
+    def __init__(self,data,chunk):
+        self._data = memoryview(data)
+        self._pos = 0
+        self._chunk = chunk
+
+    def done(self):
+        return self._pos >= len(self._data)
+
+    def recv(self,size):
+        n = min(size,self._chunk,len(self._data) - self._pos)
+        out = self._data[self._pos:self._pos + n].tobytes()
+        self._pos += n
+        return out
+
+    def recv_into(self,buff):
+        n = min(len(buff),self._chunk,len(self._data) - self._pos)
+        buff[:n] = self._data[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+def synthetic_traffic(symbols=50,bars=200000):
+    ''' Derivative-port style BH/BC lines, interleaved across symbols '''
+    lines = []
+    for i in range(bars):
+        sym = f'SYM{i % symbols}'
+        minute = (i // symbols) % 390
+        ts = f'2021-01-04 {9 + (30 + minute) // 60:02d}:{(30 + minute) % 60:02d}:00'
+        lines.append(f'B-{sym}-60,BH,{sym},{ts},101.25,101.50,101.00,101.40,{1000 * i},{100 + i % 50},0,\r\n')
+    return ''.join(lines).encode()
+
+def time_framer(data,chunk,make_framer,read):
+    sock = ReplaySocket(data,chunk)
+    framer = make_framer()
+    count = 0
+    started = perf_counter()
+    while not sock.done():
+        read(framer,sock)
+        count += len(framer.lines())
+    return count, perf_counter() - started
+
+def run(args):
+    if args.file:
+        with open(args.file,'rb') as f:
+            data = f.read()
+    else:
+        data = synthetic_traffic()
+
+    print(f'{len(data):,} bytes, read in chunks of {args.chunk} bytes')
+
+    framers = {
+        'str (old)': (StrFramer,lambda f,s: f.recv(s,args.chunk)),
+        'LineFramer': (lambda: LineFramer(args.buffer),lambda f,s: f.recv_into(s)),
+    }
+    for name,(make_framer,read) in framers.items():
+        best = None
+        for _ in range(args.repeat):
+            count, elapsed = time_framer(data,args.chunk,make_framer,read)
+            best = elapsed if best is None else min(best,elapsed)
+        print(f'{name:>12}: {count:,} lines in {best:.3f} s  ({count / best:,.0f} lines/sec, {len(data) / best / 1e6:.1f} MB/sec)')
+
+def record(args):
+    ''' Dump raw derivative-port bytes to a file while watching symbols '''
+    sock = socket.create_connection((BarsConnection.iqfeed_host,BarsConnection.deriv_port))
+    sock.settimeout(1)
+    sock.sendall(f'S,SET PROTOCOL,{BarsConnection.protocol_version}\r\n'.encode())
+    for sym in args.symbols.split(','):
+        sock.sendall(f'BW,{sym},{args.interval},,{args.days},,,,B-{sym}-{args.interval},s,,\r\n'.encode())
+
+    total = 0
+    stop_at = time.time() + args.seconds
+    with open(args.file,'wb') as f:
+        while time.time() < stop_at:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            f.write(data)
+            total += len(data)
+
+    sock.sendall(b'S,UNWATCH ALL\r\n')
+    sock.close()
+    print(f'Recorded {total:,} bytes to {args.file}')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Derivative-port framing benchmark')
+    sub = parser.add_subparsers(dest='cmd',required=True)
+
+    p_run = sub.add_parser('run')
+    p_run.add_argument('file',nargs='?',help='recorded traffic (default: synthetic)')
+    p_run.add_argument('--chunk',type=int,default=1024,help='max bytes per recv call')
+    p_run.add_argument('--buffer',type=int,default=BarsConnection.recv_buffer_size)
+    p_run.add_argument('--repeat',type=int,default=3)
+
+    p_rec = sub.add_parser('record')
+    p_rec.add_argument('file')
+    p_rec.add_argument('--seconds',type=float,default=60)
+    p_rec.add_argument('--symbols',default='SPY,QQQ')
+    p_rec.add_argument('--interval',type=int,default=60)
+    p_rec.add_argument('--days',type=int,default=5,help='days of BH history to request')
+
+    args = parser.parse_args()
+    if args.cmd == 'run':
+        run(args)
+    else:
+        record(args)
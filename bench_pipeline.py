@@ -0,0 +1,149 @@
+'''
+End-to-end benchmark against replay_server.ReplayServer:
+BarsConnection -> Listener -> DatabaseConnection (or the asyncio runtime)
+
+    python bench_pipeline.py --runtime threads --symbols 200 --rate 20000 --seconds 30
+    python bench_pipeline.py --runtime asyncio --no-db
+
+Bars go to the database configured in config.ini (tables SYM0..SYMn are
+created there - use a scratch database). --no-db keeps the batching but
+skips the SQL, to measure the feed and parsing side alone.
+'''
+
+import argparse
+import asyncio
+import configparser
+import queue
+import tempfile
+from time import sleep, perf_counter
+
+import aio_pipeline
+import connection
+import listener
+import metrics
+import mylogger
+import postgres
+from replay_server import ReplayServer
+
+class NullDatabase(postgres.DatabaseConnection):
+    ''' DatabaseConnection with batching & stats intact but no database behind it '''
+
+    def connect(self,start_thread=True):
+        self._tables = set(self._symbols)
+        if start_thread:
+            self._start_db_thread()
+
+    def disconnect(self):
+        if self._queue is not None:
+            self._queue.join()
+        self._stop.set()
+        if self._database_thread.is_alive():
+            self._database_thread.join()
+
+    def ensure_table(self,symbol,interval=None):
+        target = self._target_for(symbol,interval)
+        if target not in self._tables:
+            self._tables.add(target)
+
+    def latest_bars(self,symbols):
+        return {}
+
+    def _write_batch(self,groups):
+        pass
+
+def make_db(args,db_queue,logger):
+    if args.no_db:
+        return NullDatabase(db_queue,logger)
+    return postgres.database_connection(db_queue,logger)
+
+def measure(db,seconds,warmup):
+    ''' Rows committed per second and latency over the measuring window '''
+    sleep(warmup)
+    metrics.pipeline.snapshot(reset=True)
+    rows_start = db._rows_written
+    started = perf_counter()
+    sleep(seconds)
+    elapsed = perf_counter() - started
+    return (db._rows_written - rows_start) / elapsed, metrics.pipeline.snapshot(reset=True)
+
+def run_threads(args,config,logger,symbols):
+    db_queue = queue.Queue()
+    iq_queue = queue.Queue()
+
+    db = make_db(args,db_queue,logger)
+    db.connect()
+    for sym in symbols:
+        db.ensure_table(sym)
+
+    listen = listener.Listener(iq_queue,db_queue,logger,symbols)
+    listen.start_listening()
+
+    conn = connection.BarsConnection(iq_queue,logger)
+    conn.connect()
+    try:
+        conn.subscribe_to_symbols(symbols,config)
+        return measure(db,args.seconds,args.warmup)
+    finally:
+        conn.disconnect()
+        listen.stop_listening()
+        db.disconnect()
+
+def run_asyncio(args,config,logger,symbols):
+
+    async def go():
+        db = make_db(args,None,logger)
+        pipeline = aio_pipeline.AsyncPipeline(config,logger,symbols,db=db)
+        try:
+            await pipeline.start()
+            for sym in symbols:
+                db.ensure_table(sym)
+            return await asyncio.to_thread(measure,db,args.seconds,args.warmup)
+        finally:
+            await pipeline.stop()
+
+    return asyncio.run(go())
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='End-to-end pipeline benchmark on replayed bars')
+    parser.add_argument('--runtime',choices=['threads','asyncio'],default='threads')
+    parser.add_argument('--symbols',type=int,default=100)
+    parser.add_argument('--rate',type=float,default=10000,help='live bars/sec offered by the server')
+    parser.add_argument('--history-bars',type=int,default=0,help='BH bars per symbol on subscribe')
+    parser.add_argument('--seconds',type=float,default=20)
+    parser.add_argument('--warmup',type=float,default=3)
+    parser.add_argument('--record',default=None,help='replay a derivative-port capture instead')
+    parser.add_argument('--no-db',action='store_true')
+    args = parser.parse_args()
+
+    symbols = [f'SYM{i}' for i in range(args.symbols)]
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    config['market']['symbols'] = ','.join(symbols)
+    config['market']['catchup'] = 'false'
+
+    logger = mylogger.Logger('','',tempfile.gettempdir() + '/')
+
+    recorded = None
+    if args.record:
+        from replay_server import load_recording
+        recorded = load_recording(args.record)
+
+    server = ReplayServer(deriv_port=0,hist_port=0,level1_port=0,rate=args.rate,history_bars=args.history_bars,recorded=recorded)
+    server.start()
+    connection.BarsConnection.iqfeed_host = server.host
+    connection.BarsConnection.deriv_port = server.deriv_port
+
+    try:
+        if args.runtime == 'threads':
+            rate, latency = run_threads(args,config,logger,symbols)
+        else:
+            rate, latency = run_asyncio(args,config,logger,symbols)
+    finally:
+        server.stop()
+
+    print(f'\n{args.runtime}: {args.symbols} symbols, offered {args.rate:,.0f} bars/sec -> committed {rate:,.0f} bars/sec')
+    for stage,snap in latency.items():
+        print(f"  {stage:>16}: n={snap['count']:>8}  mean={snap['mean']*1000:7.2f}ms  "
+              f"p50={snap['p50']*1000:7.2f}ms  p99={snap['p99']*1000:7.2f}ms  max={snap['max']*1000:7.2f}ms")
@@ -0,0 +1,71 @@
+'''
+Level 1 trade capture benchmark against replay_server.ReplayServer:
+TradesConnection -> TickListener -> TickBarBuilder + TickStore
+
+    python bench_ticks.py --symbols 1000 --rate 100000 --seconds 30 [--intervals 5,60] [--no-store]
+
+Reports trades/sec handled against the offered rate, the peak tick queue
+backlog (it must stay under --queue-batches) and how often the reader had to
+wait on a full queue. Ticks are stored in a temporary directory.
+'''
+
+import argparse
+import tempfile
+from time import sleep, perf_counter
+
+import connection
+import mylogger
+import ticks
+from replay_server import ReplayServer
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Level 1 trade capture benchmark on synthetic trades')
+    parser.add_argument('--symbols',type=int,default=500)
+    parser.add_argument('--rate',type=float,default=50000,help='trades/sec offered by the server')
+    parser.add_argument('--intervals',default='5,60',help='bar seconds built from the trades')
+    parser.add_argument('--queue-batches',type=int,default=2000)
+    parser.add_argument('--seconds',type=float,default=20)
+    parser.add_argument('--warmup',type=float,default=3)
+    parser.add_argument('--no-store',action='store_true')
+    args = parser.parse_args()
+
+    symbols = [f'SYM{i}' for i in range(args.symbols)]
+    logger = mylogger.Logger('','',tempfile.gettempdir() + '/')
+
+    server = ReplayServer(deriv_port=0,hist_port=0,level1_port=0,trade_rate=args.rate)
+    server.start()
+    connection.BarsConnection.iqfeed_host = server.host
+    connection.TradesConnection.level1_port = server.level1_port
+
+    bars = []
+    with tempfile.TemporaryDirectory() as root:
+        store = None if args.no_store else ticks.TickStore(root)
+        intervals = [int(k) for k in args.intervals.split(',') if k.strip()]
+        feed = ticks.TickFeed(logger,symbols,intervals,[bars.append],args.queue_batches,store)
+        feed.start_listening()
+        feed.connect()
+        try:
+            feed.subscribe_to_symbols()
+            sleep(args.warmup)
+
+            start_trades = feed.listener.trades
+            start_full = feed.conn.queue_full
+            peak = 0
+            started = perf_counter()
+            while perf_counter() - started < args.seconds:
+                peak = max(peak,feed.tick_queue.qsize())
+                sleep(0.05)
+            elapsed = perf_counter() - started
+            rate = (feed.listener.trades - start_trades) / elapsed
+            waited = feed.conn.queue_full - start_full
+        finally:
+            feed.disconnect()
+            feed.stop_listening()
+            server.stop()
+
+        print(f'\n{args.symbols} symbols, offered {args.rate:,.0f} trades/sec -> handled {rate:,.0f} trades/sec')
+        print(f'  tick queue peak {peak}/{args.queue_batches} reads, {waited} reads waited on a full queue')
+        print(f'  {len(bars):,} bars built')
+        if store is not None:
+            print(f'  {store.rows_written:,} ticks stored')
@@ -0,0 +1,146 @@
+'''
+Database write path benchmark on the Postgres configured in config.ini
+
+    python bench_writers.py --symbols 50 --rows 200000 --batch 500 [--methods copy,binary] [--upsert]
+
+Writes the same synthetic bars with each method, one transaction per batch:
+
+    insert        one interpolated INSERT per bar (the original _insert_record)
+    executemany   cursor.executemany with %s parameters
+    values        execute_values                      (write_method = values)
+    prepared      EXECUTE of a per-table prepared INSERT (write_method = prepared)
+    copy          text COPY                           (write_method = copy)
+    binary        COPY FORMAT binary                  (write_method = binary)
+
+Tables BENCH0..BENCHn are created (or cleared) in the database - use a
+scratch database. After each method the stored rows are summarised, so every
+method must print the same check value.
+'''
+
+import argparse
+import random
+import tempfile
+from time import perf_counter
+
+import mylogger
+import postgres
+from bars import Bar, stamp_epoch
+
+METHODS = ('insert','executemany','values','prepared','copy','binary')
+
+def synthetic_bars(symbols,rows,interval=60):
+    ''' rows bars round robin over symbols, in time order per symbol '''
+    rand = random.Random(7)
+    start = stamp_epoch('2021-01-04 09:31:00')
+    state = {sym: (100.0,0) for sym in symbols}
+    out = []
+    for i in range(rows):
+        sym = symbols[i % len(symbols)]
+        price, cumvol = state[sym]
+        o = price
+        c = max(0.01,round(o + rand.gauss(0,0.05),2))
+        vol = rand.randint(100,5000)
+        cumvol += vol
+        state[sym] = (c,cumvol)
+        out.append(Bar(sym,'C',start + (i // len(symbols)) * interval,o,max(o,c) + 0.01,min(o,c) - 0.01,c,vol,cumvol,interval))
+    return out
+
+def write_insert(db,batch):
+    ''' One statement per bar built by string interpolation, as _insert_record did '''
+    cols = ','.join(db.bar_columns)
+    for row in db._value_rows(batch):
+        vals = ','.join(f"'{v}'" for v in row)
+        db._cursor.execute(f"insert into {db._table_for(row[0])} ({cols}) values ({vals});")
+    db._conn.commit()
+
+def write_executemany(db,batch):
+    cols = ','.join(db.bar_columns)
+    params = ','.join(['%s'] * len(db.bar_columns))
+    groups = {}
+    for bar in batch:
+        groups.setdefault(db._table_for(bar.symbol),[]).append(bar)
+    for table_name,bars in groups.items():
+        db._cursor.executemany(f"insert into {table_name} ({cols}) values ({params})",db._value_rows(bars))
+    db._conn.commit()
+
+def clear_tables(db,symbols):
+    tables = sorted({db._table_for(sym) for sym in symbols})
+    with db._cursor_lock:
+        for table_name in tables:
+            if table_name == 'bars':
+                db._cursor.execute("delete from bars where symbol like 'BENCH%'")
+            else:
+                db._cursor.execute(f"truncate {table_name}")
+        db._conn.commit()
+
+def check_value(db,symbols):
+    ''' Row count & sums over the stored bench rows - identical for every method '''
+    count, total, volume = 0, 0.0, 0
+    with db._cursor_lock:
+        for table_name in sorted({db._table_for(sym) for sym in symbols}):
+            where = " where symbol like 'BENCH%'" if table_name == 'bars' else ''
+            db._cursor.execute(f"select count(*),coalesce(sum(open + high + low + close),0),"
+                               f"coalesce(sum(volume + cumvol),0) from {table_name}{where}")
+            n, t, v = db._cursor.fetchone()
+            count += n
+            total += float(t)
+            volume += int(v)
+        db._conn.commit()
+    return f'{count} rows / {total:.2f} / {volume}'
+
+def run(db,method,bars,batch_rows):
+    started = perf_counter()
+    for i in range(0,len(bars),batch_rows):
+        batch = bars[i:i + batch_rows]
+        if method == 'insert':
+            write_insert(db,batch)
+        elif method == 'executemany':
+            write_executemany(db,batch)
+        else:
+            db.write_bars(batch)
+    return perf_counter() - started
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Text INSERT vs executemany vs execute_values vs prepared vs COPY text/binary')
+    parser.add_argument('--symbols',type=int,default=50)
+    parser.add_argument('--rows',type=int,default=100000)
+    parser.add_argument('--batch',type=int,default=500,help='bars per transaction')
+    parser.add_argument('--methods',default=','.join(METHODS))
+    parser.add_argument('--upsert',action='store_true',help='ON CONFLICT DO NOTHING writes (catch-up mode)')
+    args = parser.parse_args()
+
+    logger = mylogger.Logger('','',tempfile.gettempdir() + '/')
+    symbols = [f'BENCH{i}' for i in range(args.symbols)]
+    bars = synthetic_bars(symbols,args.rows)
+
+    db = postgres.database_connection(None,logger)
+    db._settings['upsert'] = args.upsert
+    db.connect(start_thread=False,check_tables=False)
+    for sym in symbols:
+        db.ensure_table(sym)
+    if isinstance(db,postgres.PartitionedDatabaseConnection):
+        # insert & executemany do not go through _write_batch, which adds partitions
+        db._ensure_partitions('bars',{bar.date[:7] for bar in bars})
+
+    results = []
+    try:
+        for method in args.methods.split(','):
+            if method not in METHODS:
+                raise ValueError(f'Unknown method {method} (one of {METHODS})')
+            clear_tables(db,symbols)
+            if method not in ('insert','executemany'):
+                db._settings['write_method'] = method
+            elapsed = run(db,method,bars,args.batch)
+            results.append((method,elapsed,check_value(db,symbols)))
+            print(f'{method:>12}: {args.rows / elapsed:10,.0f} rows/sec')
+    finally:
+        db.disconnect()
+        logger.close()
+
+    print(f"\n{args.rows:,} bars, {args.symbols} symbols, {args.batch} bars per transaction"
+          f"{' (upsert)' if args.upsert else ''}")
+    print(f"{'method':>12} {'rows/sec':>12} {'ms/batch':>9}  check")
+    batches = -(-args.rows // args.batch)
+    for method,elapsed,check in results:
+        print(f'{method:>12} {args.rows / elapsed:12,.0f} {1000 * elapsed / batches:9.2f}  {check}')
@@ -1,18 +1,103 @@
 import socket
 import threading
+import queue
 import pandas as pd
 import os
-from time import sleep
+from time import sleep, perf_counter, monotonic
+import metrics
+
+class LineFramer():
+    '''
+    Splits a socket byte stream into newline terminated messages
+
+    Reads land directly in a preallocated bytearray (recv_into). Complete lines
+    are decoded in one pass per read, and a trailing partial line stays where
+    it is until the buffer runs out of room - it is not re-sliced per message.
+    '''
+
+    def __init__(self,size=65536):
+        self._buff = bytearray(size)
+        self._start = 0     # first unconsumed byte
+        self._end = 0       # end of received data
+
+    def recv_into(self,sock):
+        ''' Read from sock into the free space of the buffer - returns bytes read (0 = EOF) '''
+        self._make_room()
+        with memoryview(self._buff) as view:
+            nbytes = sock.recv_into(view[self._end:])
+        self._end += nbytes
+        return nbytes
+
+    def feed(self,data):
+        ''' Append bytes that were read elsewhere (e.g. by an asyncio stream) '''
+        while len(self._buff) - self._end < len(data):
+            self._make_room(len(data))
+        self._buff[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def lines(self):
+        ''' Consume and return all complete lines received so far (list of str) '''
+        last_delim = self._buff.rfind(b'\n',self._start,self._end)
+        if last_delim == -1:
+            return []
+
+        with memoryview(self._buff) as view:
+            chunk = view[self._start:last_delim].tobytes()
+
+        if last_delim + 1 == self._end:
+            self._start = self._end = 0
+        else:
+            self._start = last_delim + 1
+
+        return [line for line in map(str.strip,chunk.decode().split('\n')) if line]
+
+    def pending(self):
+        ''' Number of buffered bytes not yet returned as a line '''
+        return self._end - self._start
+
+    def _make_room(self,needed=1):
+        free = len(self._buff) - self._end
+        if free >= needed:
+            return
+        tail = self._end - self._start
+        if self._start > 0 and (len(self._buff) - tail) >= needed:
+            # Move the partial line to the front - happens at most once per fill
+            self._buff[:tail] = self._buff[self._start:self._end]
+        else:
+            # A single line longer than the buffer - grow it
+            grown = bytearray(max(2 * len(self._buff),tail + needed))
+            grown[:tail] = self._buff[self._start:self._end]
+            self._buff = grown
+        self._start = 0
+        self._end = tail
 
 class BarsConnection():
+    '''
+    Derivative port (9400) reader feeding msgqueue with one item per socket read
+
+    The reader thread supervises the socket: EOF, a socket error or no data
+    (not even a T heartbeat) for stale_seconds close it and reconnect with
+    backoff (reconnect_delay doubling up to reconnect_max_delay). Once
+    reconnected the protocol is set again and every watched symbol is
+    re-watched from resume_from(symbols) - {symbol: (date, time)}, e.g.
+    Listener.resume_points - so only the missing bars are sent again.
+    '''
 
     # IQ Feed settings
     protocol_version = "6.1"
     iqfeed_host = os.getenv('IQFEED_HOST', "127.0.0.1")
     deriv_port = int(os.getenv('IQFEED_PORT_DERIV', 9400))
+    recv_buffer_size = int(os.getenv('IQFEED_RECV_BUFFER', 65536))
+
+    # Supervision - IQFeed sends a T heartbeat every second
+    stale_seconds = float(os.getenv('IQFEED_STALE_SECONDS', 10))
+    reconnect_delay = 1
+    reconnect_max_delay = 30
+    # Seconds to let msgqueue drain before asking resume_from where to restart
+    drain_seconds = 5
 
-    def __init__(self,msgqueue,logger):
-        self._name = 'LiveBarListener'
+    def __init__(self,msgqueue,logger,buffer_size=None,name='LiveBarListener',resume_from=None):
+        self._name = name
         self._host = BarsConnection.iqfeed_host
         self._port = BarsConnection.deriv_port
         self._version = BarsConnection.protocol_version
@@ -22,8 +107,22 @@ class BarsConnection():
 
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._sock_lock = threading.RLock()
-        self._buff_lock = threading.RLock()
-        self._buffered_data = ''
+        self._buffer_size = buffer_size or BarsConnection.recv_buffer_size
+        self._framer = LineFramer(self._buffer_size)
+        self._received = None
+
+        # Watch state replayed after a reconnect
+        self._resume_from = resume_from
+        self._watched = []
+        self._config = None
+        self._latest = {}
+
+        # Throughput counters (read by shards.ShardedFeed)
+        self.bytes_read = 0
+        self.lines_read = 0
+        # Supervision counters
+        self.disconnects = 0
+        self.reconnects = 0
 
         self._stop = threading.Event()
         self._reader_thread = threading.Thread(target=self,name=self._name)
@@ -32,16 +131,21 @@ class BarsConnection():
     # Callable looped by the new thread (target), listening at the socket
     def __call__(self):
         while not self._stop.is_set():
-            if self._read_socket():
-                self._process_messages()
+            try:
+                if self._read_socket():
+                    self._process_messages()
+                elif perf_counter() - self._received > self.stale_seconds:
+                    raise ConnectionError(f'no data or heartbeat for {self.stale_seconds:.0f} s')
+            except OSError as e:
+                if self._stop.is_set():
+                    break
+                self._reconnect(e)
 
     ###########################################################################
     # Starting and stopping socket & thread
     def connect(self):
         try:
-            self._sock.connect((self._host,self._port))
-            self._sock.settimeout(2)
-            self._set_protocol()
+            self._open_socket()
             self._start_reader()
             print('Socket connected & reader thread started!')
         except Exception as e:
@@ -49,13 +153,32 @@ class BarsConnection():
             raise
 
     def disconnect(self):
-        self._send_cmd('S,UNWATCH ALL\r\n')
+        try:
+            self._send_cmd('S,UNWATCH ALL\r\n')
+        except OSError:
+            pass    # already down
         print('Disconnecting from IQFeed socket and killing thread')
         self._stop_reader()
-        if self._sock:
-            self._sock.shutdown(socket.SHUT_RDWR)
-            self._sock.close()
-            self._sock = None
+        self._close_socket()
+
+    def _open_socket(self):
+        with self._sock_lock:
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.connect((self._host,self._port))
+            self._sock.settimeout(2)
+            self._received = perf_counter()
+            self._set_protocol()
+
+    def _close_socket(self):
+        with self._sock_lock:
+            if self._sock:
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self._sock.close()
+                self._sock = None
 
     def _start_reader(self):
         self._stop.clear()
@@ -69,44 +192,84 @@ class BarsConnection():
         if self._reader_thread.is_alive():
             print('ERROR! Reader thread still ALIVE!')
 
+    ###########################################################################
+    # Supervision
+
+    def _reconnect(self,reason):
+        ''' Reader thread: reopen the socket with backoff until it connects or the reader is stopped '''
+        self.disconnects += 1
+        metrics.disconnects.inc()
+        dropped = perf_counter()
+        self._logger.log(f'WARNING: {self._name} lost the IQFeed connection ({reason}) - reconnecting',how='tfp')
+        self._close_socket()
+        # A partial line from the old socket would corrupt the first new one
+        self._framer = LineFramer(self._buffer_size)
+
+        delay = self.reconnect_delay
+        while not self._stop.is_set():
+            try:
+                self._open_socket()
+                self._resubscribe()
+            except OSError as e:
+                self._close_socket()
+                print(f'{self._name}: reconnect failed ({e}) - retrying in {delay:.0f} s')
+                self._stop.wait(delay)
+                delay = min(2 * delay,self.reconnect_max_delay)
+                continue
+            self.reconnects += 1
+            self._logger.log(f'{self._name} reconnected after {perf_counter() - dropped:.1f} s - '
+                             f'{len(self._watched)} symbols re-watched',how='tfp')
+            return
+
+    def _resubscribe(self):
+        ''' BW every watched symbol again from where its bars stopped '''
+        if not self._watched:
+            return
+        symbols = list(self._watched)
+        latest = dict(self._latest)
+        if self._resume_from is not None:
+            # Bars already read must reach the Listener before asking where to resume
+            backlog = getattr(self._msgqueue,'qsize',lambda: 0)
+            deadline = monotonic() + self.drain_seconds
+            while backlog() and monotonic() < deadline and not self._stop.is_set():
+                sleep(0.05)
+            latest.update(self._resume_from(symbols))
+        for _,cmd in watch_commands(symbols,self._config,latest):
+            self._send_cmd(cmd,echo=False)
+        print(f'{self._name}: re-sent {len(symbols)} BW watches')
+
     ###########################################################################
     # Reading from & writing to socket
 
     def _read_socket(self):
-        data_received = None
         try:
-            data_received = self._sock.recv(1024).decode()
+            nbytes = self._framer.recv_into(self._sock)
         except socket.timeout:
             return False
-        else:
-            with self._buff_lock:
-                self._buffered_data += data_received
-            return True
+        if nbytes == 0:
+            raise ConnectionResetError('connection closed by IQFeed')
+        self._received = perf_counter()
+        self.bytes_read += nbytes
+        metrics.socket_bytes.inc(nbytes)
+        return True
 
     def _process_messages(self):
-        message = self._next_message()
-        while message != '':
-            self._queue_message(message)            
-            message = self._next_message()
-
-    def _next_message(self):
-        with self._buff_lock:
-            next_delim = self._buffered_data.find('\n')
-            if next_delim != -1:
-                message = self._buffered_data[:next_delim].strip()
-                self._buffered_data = self._buffered_data[(next_delim + 1):]
-                return message
-            else:
-                return ''
-
-    def _send_cmd(self,cmd):
+        lines = self._framer.lines()
+        if lines:
+            self.lines_read += len(lines)
+            self._queue_messages(lines)
+
+    def _send_cmd(self,cmd,echo=True):
         with self._sock_lock:
+            if self._sock is None:
+                raise ConnectionError('not connected to IQFeed')
             self._sock.sendall(cmd.encode())
+        if echo:
             print('>>>>>>>>>>>>> Sent command:',cmd[:-2])
 
-    def _queue_message(self,msg):
-        fields = msg.split(',')
-        self._msgqueue.put(fields)
+    def _queue_messages(self,lines):
+        # One queue item per read: (receipt time, list of messages, each a list of fields)
+        self._msgqueue.put((self._received,[line.split(',') for line in lines]))
 
     ###########################################################################
     # IQFeed protocols
@@ -115,25 +278,132 @@ class BarsConnection():
         '''  S,SET PROTOCOL,[MAJOR VERSION].[MINOR VERSION]<CR><LF> '''
         self._send_cmd(f'S,SET PROTOCOL,{str(self._version)}\r\n')
 
-    def subscribe_to_symbols(self,symbols,config):
+    def subscribe_to_symbols(self,symbols,config,latest=None):
         '''
         symbols = list of string symbols
         config = configparser object with symbol/market settings
+        latest = {symbol: (date, time)} of stored bars - history starts there (catch-up)
         '''
+        self._remember_watches(symbols,config,latest)
+
+        try:
+            for sym,cmd in watch_commands(symbols,config,latest):
+                self._send_cmd(cmd)
+                msg = f'Subscribing to symbol {sym}'
+                self._logger.log(msg,how='pf')
 
-        in_sec = config['market']['interval_seconds']
-        start = config['market']['start_time']
-        end = config['market']['end_time']
+            sleep(2)
+
+            self._send_cmd('S,REQUEST WATCHES\r\n')
+        except OSError as e:
+            self._logger.log(f'{self._name}: subscribing while disconnected ({e}) - '
+                             f'the watches are sent on reconnect',how='fp')
+
+    def unwatch_symbols(self,symbols):
+        ''' BR,[Symbol] - stop the interval watch of each symbol '''
+        self._forget_watches(symbols)
+        try:
+            for sym in symbols:
+                self._send_cmd(f'BR,{sym}\r\n')
+                self._logger.log(f'Unwatching symbol {sym}',how='pf')
+        except OSError:
+            pass    # not re-watched on reconnect
+
+    def _remember_watches(self,symbols,config,latest):
+        # Recorded before sending, so a reconnect mid-subscription still watches them
+        with self._sock_lock:
+            self._config = config
+            self._watched += [sym for sym in symbols if sym not in self._watched]
+            self._latest.update(latest or {})
+
+    def _forget_watches(self,symbols):
+        with self._sock_lock:
+            self._watched = [sym for sym in self._watched if sym not in symbols]
 
-        #startday = pd.Timestamp.now().strftime('%Y%m%d') # current day
-        startday = (pd.Timestamp.now() - pd.Timedelta(1,'D')).strftime('%Y%m%d')
+class TradesConnection(BarsConnection):
+    '''
+    Level 1 port (5009) reader for every trade of the watched symbols
 
-        for sym in symbols:
-            cmd = f'BW,{sym},{in_sec},{startday} 072000,,,{start},{end},B-{sym}-{in_sec},s,,\r\n'
-            self._send_cmd(cmd)
-            msg = f'Subscribing to symbol {sym}'
-            self._logger.log(msg,how='pf')
+    Symbols are watched trades only (t[Symbol]) with the update fields cut down
+    to update_fields, so each trade is one short Q message:
+    Q,[Symbol],[Price],[Size],[HH:MM:SS.ffffff],[MM/DD/YYYY],[TotalVolume],[MessageContents]
 
-        sleep(2)
+    msgqueue should be bounded (queue.Queue(maxsize)): when it is full the
+    reader blocks, the socket stops being read and TCP holds IQFeed back.
+    '''
 
-        self._send_cmd('S,REQUEST WATCHES\r\n')
\ No newline at end of file
+    level1_port = int(os.getenv('IQFEED_PORT_LEVEL1', 5009))
+    update_fields = ('Symbol','Most Recent Trade','Most Recent Trade Size','Most Recent Trade Time',
+                     'Most Recent Trade Date','Total Volume','Message Contents')
+
+    def __init__(self,msgqueue,logger,buffer_size=None,name='LiveTradeListener'):
+        super().__init__(msgqueue,logger,buffer_size,name)
+        self._port = TradesConnection.level1_port
+        # Reads that found msgqueue full (the reader waited for the consumer)
+        self.queue_full = 0
+
+    def subscribe_to_symbols(self,symbols,config=None,latest=None):
+        ''' t[Symbol] per symbol - config & latest are accepted for BarsConnection compatibility '''
+        self._remember_watches(symbols,config,None)
+        try:
+            self._select_fields()
+            for sym in symbols:
+                self._send_cmd(f't{sym}\r\n')
+                self._logger.log(f'Watching trades of {sym}',how='pf')
+        except OSError as e:
+            self._logger.log(f'{self._name}: subscribing while disconnected ({e}) - '
+                             f'the watches are sent on reconnect',how='fp')
+
+    def unwatch_symbols(self,symbols):
+        self._forget_watches(symbols)
+        try:
+            for sym in symbols:
+                self._send_cmd(f'r{sym}\r\n')
+                self._logger.log(f'Unwatching trades of {sym}',how='pf')
+        except OSError:
+            pass
+
+    def _resubscribe(self):
+        ''' Level 1 has no history - trades during the outage are lost, only the watches come back '''
+        if not self._watched:
+            return
+        self._select_fields()
+        for sym in list(self._watched):
+            self._send_cmd(f't{sym}\r\n',echo=False)
+        print(f'{self._name}: re-sent {len(self._watched)} trade watches (trades while disconnected are not recovered)')
+
+    def _select_fields(self):
+        self._send_cmd(f"S,SELECT UPDATE FIELDS,{','.join(TradesConnection.update_fields[1:])}\r\n")
+
+    def _queue_messages(self,lines):
+        item = (self._received,[line.split(',') for line in lines])
+        try:
+            self._msgqueue.put_nowait(item)
+        except queue.Full:
+            self.queue_full += 1
+            self._msgqueue.put(item)
+
+def watch_commands(symbols,config,latest=None):
+    '''
+    (symbol, BW command) for each symbol - shared by the threaded & asyncio runtimes
+    Symbols in latest only request history from their newest stored bar onwards
+    '''
+    latest = latest or {}
+
+    in_sec = config['market']['interval_seconds']
+    start = config['market']['start_time']
+    end = config['market']['end_time']
+
+    #startday = pd.Timestamp.now().strftime('%Y%m%d') # current day
+    startday = (pd.Timestamp.now() - pd.Timedelta(1,'D')).strftime('%Y%m%d')
+
+    cmds = []
+    for sym in symbols:
+        if sym in latest:
+            last_date, last_time = latest[sym]
+            begin = f"{last_date.strftime('%Y%m%d')} {last_time.strftime('%H%M%S')}"
+        else:
+            begin = f'{startday} 072000'
+        cmd = f'BW,{sym},{in_sec},{begin},,,{start},{end},B-{sym}-{in_sec},s,,\r\n'
+        cmds.append((sym,cmd))
+    return cmds
\ No newline at end of file
@@ -0,0 +1,254 @@
+'''
+Parallel database writers on a psycopg2 ThreadedConnectionPool
+
+Bars are partitioned by symbol over K writer threads, each with its own
+pooled connection & DatabaseConnection, so a symbol's bars are always written
+by the same writer and stay in order. Frames handed to write_frame go through
+the symbol's writer queue in arrival order.
+
+A backfill (backfill.py) runs as its own process with its own connections,
+so live bars never queue behind backfill frames - the two only share the
+database server.
+
+With [queues], each writer queue holds at most db_size / K bars: a full one
+blocks the dispatcher, so db_queue fills up behind it and its own db_policy
+and high water alerts apply. Writer queues never spill (frame jobs carry a Future).
+
+    [database]
+    writers = 4         1 = the single DatabaseConnection writer thread
+'''
+
+import configparser
+import os
+import queue
+import threading
+import traceback
+import zlib
+from concurrent.futures import Future
+from time import monotonic
+
+from psycopg2.pool import ThreadedConnectionPool
+
+import backpressure
+import postgres
+
+class _FrameJob():
+    ''' A DataFrame for write_frame and the Future its row count is reported on '''
+
+    __slots__ = ('symbol','df','interval','future')
+
+    def __init__(self,symbol,df,interval):
+        self.symbol = symbol
+        self.df = df
+        self.interval = interval
+        self.future = Future()
+
+class Writer():
+    ''' One writer thread draining its queue through its own DatabaseConnection '''
+
+    def __init__(self,index,db,logger,batch_rows,flush_seconds,write_queue=None):
+        self.index = index
+        self.db = db
+        self._logger = logger
+        self.queue = write_queue if write_queue is not None else queue.Queue()
+        self._batch_rows = batch_rows
+        self._flush_seconds = flush_seconds
+        self._pending = []
+        self._deadline = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self,name=f'DatabaseWriter-{index}')
+
+    def put(self,item):
+        ''' item = bars.Bar or _FrameJob '''
+        self.queue.put(item)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __call__(self):
+        while not self._stop.is_set():
+            try:
+                self._pull_queue()
+                self.db.service_spool(self.queue.qsize())
+            except Exception as e:
+                # Keep consuming - a dead writer would stall the dispatcher & every producer
+                self._logger.log(f'ERROR! Database writer {self.index}: {e}',how='tfp')
+                print(traceback.format_exc())
+        self._flush()
+
+    def _pull_queue(self):
+        ''' Micro-batch bars as DatabaseConnection._pull_queue does - a frame job flushes the bars before it '''
+        if self._deadline is None:
+            timeout = self._flush_seconds
+        else:
+            timeout = max(0,self._deadline - monotonic())
+
+        job = None
+        try:
+            item = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            pass
+        else:
+            if isinstance(item,_FrameJob):
+                job = item
+            else:
+                if not self._pending:
+                    self._deadline = monotonic() + self._flush_seconds
+                self._pending.append(item)
+                while len(self._pending) < self._batch_rows:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if isinstance(item,_FrameJob):
+                        job = item
+                        break
+                    self._pending.append(item)
+
+        if self._pending:
+            if job is not None or len(self._pending) >= self._batch_rows or monotonic() >= self._deadline:
+                self._flush()
+        if job is not None:
+            self._write_job(job)
+
+    def _flush(self):
+        batch = self._pending
+        self._pending = []
+        self._deadline = None
+        if not batch:
+            return
+        try:
+            self.db.write_or_spool(batch,self.queue.qsize())
+        except Exception as e:
+            self.db.recover_batch(batch,e)
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def _write_job(self,job):
+        try:
+            rows = self.db.write_frame(job.symbol,job.df,job.interval)
+        except Exception as e:
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(rows)
+        finally:
+            self.queue.task_done()
+
+class WriterPool():
+    '''
+    Drop-in for DatabaseConnection where bars are written in parallel:
+    consumes msg_queue, write_frame, ensure_table, latest_bars, connect/disconnect
+    '''
+
+    def __init__(self,msg_queue,logger,writers=4):
+        self._queue = msg_queue
+        self._logger = logger
+        self._size = max(1,writers)
+
+        config = configparser.ConfigParser()
+        config.read('config.ini')
+        self._batch_rows = config['database'].getint('batch_rows',fallback=500)
+        self._flush_seconds = config['database'].getfloat('flush_seconds',fallback=0.5)
+        self._spool_path = None
+        if config.has_section('spool') and config['spool'].getboolean('enabled',fallback=True):
+            self._spool_path = config['spool'].get('path','spool/')
+        self._config = config
+
+        self._pool = None
+        self._writers = []
+        self._route = {}
+        self._stop = threading.Event()
+        self._dispatch_thread = threading.Thread(target=self,name='DatabaseDispatchThread')
+
+    ###########################################################################
+    # Starting and stopping
+
+    def __call__(self):
+        ''' Dispatcher: bars from msg_queue to their symbol's writer '''
+        while not self._stop.is_set():
+            try:
+                bar = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if bar:
+                self._writer_for(bar.symbol).put(bar)
+            self._queue.task_done()
+
+    def connect(self,start_thread=True):
+        '''
+        start_thread=False leaves msg_queue alone - the writers still run for write_frame
+        '''
+        dbs = [postgres.database_connection(None,self._logger) for _ in range(self._size)]
+        self._pool = ThreadedConnectionPool(self._size,self._size,**dbs[0].connect_args())
+        # The first connection checks & creates the tables, the others only read them
+        for i,db in enumerate(dbs):
+            db.connect(start_thread=False,conn=self._pool.getconn(),check_tables=(i == 0))
+            if self._spool_path:
+                db.enable_spool(os.path.join(self._spool_path,f'writer-{i}'))
+            write_queue = backpressure.queue_from_config(self._config,'db',self._logger,f'db_queue-writer-{i}',
+                                                         parts=self._size,policy='block')
+            self._writers.append(Writer(i,db,self._logger,self._batch_rows,self._flush_seconds,write_queue))
+        for writer in self._writers:
+            writer.start()
+        if start_thread and self._queue is not None:
+            self._dispatch_thread.start()
+        print(f'{self._size} database writers on a connection pool')
+
+    def disconnect(self):
+        for writer in self._writers:
+            writer.db.cancel_retries()
+        if self._queue is not None:
+            print('Waiting for database queue to clear')
+            self._queue.join()
+        for writer in self._writers:
+            writer.queue.join()
+        print('Closing database connections and killing writer threads')
+        self._stop.set()
+        if self._dispatch_thread.is_alive():
+            self._dispatch_thread.join()
+        for writer in self._writers:
+            writer.stop()
+            try:
+                writer.db.disconnect()
+            except Exception:
+                print(traceback.format_exc())
+        self._pool.closeall()
+
+    ###########################################################################
+    # DatabaseConnection calls
+
+    def ensure_table(self,symbol,interval=None):
+        for writer in self._writers:
+            writer.db.ensure_table(symbol,interval)
+
+    def latest_bars(self,symbols):
+        return self._writers[0].db.latest_bars(symbols)
+
+    def write_frame(self,symbol,df,interval=None):
+        ''' Written by the symbol's writer after the bars queued before it - blocks until written, returns rows '''
+        if df is None or len(df) == 0:
+            return 0
+        job = _FrameJob(symbol,df,interval)
+        self._writer_for(symbol).put(job)
+        return job.future.result()
+
+    def _writer_for(self,symbol):
+        writer = self._route.get(symbol)
+        if writer is None:
+            writer = self._writers[zlib.crc32(symbol.encode()) % self._size]
+            self._route[symbol] = writer
+        return writer
+
+def database_writer(msg_queue,logger):
+    ''' WriterPool if [database] writers > 1, else the single DatabaseConnection for the configured schema '''
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    writers = config['database'].getint('writers',fallback=1)
+    if writers > 1:
+        return WriterPool(msg_queue,logger,writers)
+    return postgres.database_connection(msg_queue,logger)
@@ -1,10 +1,25 @@
 import pandas as pd
+import numpy as np
 import socket
+import os
+import io
 
 TICKERS = [ 'SPY','QQQ',            # Base Indexes
             'TQQQ','SVXY',          # Long Equities
             'SPXS','UVXY','SQQQ']   # Long Volatility
 
+IQFEED_HOST = os.getenv('IQFEED_HOST', "127.0.0.1")     # Localhost
+HIST_PORT = int(os.getenv('IQFEED_PORT_HIST', 9100))    # Historical data socket port
+
+ENDMSG = b"!ENDMSG!"
+
+# HIT response fields once the date/time space is made a comma (trailing comma -> '_')
+HIST_FIELDS = ['date','time','high','low','open','close','openinterest','volume','_']
+HIST_DTYPES = { 'date':str,'time':str,
+                'high':np.float64,'low':np.float64,'open':np.float64,'close':np.float64,
+                'openinterest':np.int64,'volume':np.int64}
+OHLC_COLUMNS = ['date','time','open','high','low','close','volume','openinterest']
+
 #==============================================================================
 
 def read_historical_data_socket(sock, recv_buffer=10000):
@@ -15,48 +30,64 @@ def read_historical_data_socket(sock, recv_buffer=10000):
     sock - The socket object
     recv_buffer - Amount in bytes to receive per read
     """
-    data = []
+    data = b''.join(iter_historical_blocks(sock,recv_buffer))
 
-    while True:
+    # Convert bytes to string & remove the final line ending
+    datastr = data.decode()
+    datastr = datastr[:-1]
+    return datastr
 
-        # Append each new byte string to data
-        buff = sock.recv(recv_buffer)
-        data.append(buff)
+def iter_historical_blocks(sock, recv_buffer=65536, block_bytes=1<<20):
+    """
+    Yield the response as it arrives, in blocks (bytes) of complete lines of
+    roughly block_bytes, stopping at the !ENDMSG! line
 
-        # Check if the end message string arrived in most recent read
-        if b"!ENDMSG!" in buff:
-            break
+    The marker is searched across the boundary with the previous read, so it
+    is found even when it is split over two recv calls
+    """
+    pending = bytearray()
 
-    # Convert bytes to string & remove the end message string
-    bstr = b''.join(data)
-    datastr = bstr.decode()
-    datastr = datastr[:-12]
-    return datastr
+    while True:
 
-#==============================================================================
+        buff = sock.recv(recv_buffer)
+        if not buff:
+            raise ConnectionError('Historical socket closed before !ENDMSG!')
 
-def download_ticker(ticker,interval,start_date,end_date):
-    '''
-    ticker: self explanatory, e.g. 'SPY' [string]
-    interval: number of seconds per bar [int]
-    start & end dates: YYYYMMDD [int]
+        searched = len(pending)
+        pending += buff
 
-    #####################################################################################
-    # WARNING:
-    # FOR SOME SICK FUCKING REASON THE PRICE DATA COMES BACK HLOC instead of OHLC!
+        end_at = pending.find(ENDMSG,max(0,searched - len(ENDMSG) + 1))
+        if end_at != -1:
+            if end_at > 0:
+                yield bytes(pending[:end_at])
+            return
 
-    Data returned as:
-    [YYYY-MM-DD HH:mm:SS],[HIGH],[LOW],[OPEN],[CLOSE],[OPEN INTEREST],[VOLUME]
-    #####################################################################################
-    '''
+        if len(pending) >= block_bytes:
+            last_delim = pending.rfind(b'\n')
+            if last_delim != -1:
+                yield bytes(pending[:last_delim + 1])
+                del pending[:last_delim + 1]   # only the partial last line is moved
 
-    host = "127.0.0.1"  # Localhost
-    port = 9100  # Historical data socket port
+def parse_historical_block(block):
+    """
+    Parse a block of complete HIT lines with the pandas C parser into typed columns
 
-    print(f'Downloading historical data for symbol: {ticker}')
+    Columns are labelled by position at parse time, so the HLOC field order needs
+    no reshuffle - select OHLC_COLUMNS by name where order matters
+    Returns None for a !NO_DATA! response
+    """
+    if block.startswith(b'E,'):
+        if b'!NO_DATA!' in block:
+            return None
+        raise ValueError(f'IQFeed history error: {block[:200].decode(errors="replace")}')
 
-    # Construct the message to call for intraday data
+    return pd.read_csv( io.BytesIO(block.replace(b' ',b',')),
+                        header=None,names=HIST_FIELDS,usecols=HIST_FIELDS[:-1],
+                        dtype=HIST_DTYPES,engine='c')
+
+#==============================================================================
 
+def hit_request(ticker,interval,start_date,end_date):
     '''
     Construction of call string:
     HIT,
@@ -71,61 +102,91 @@ def download_ticker(ticker,interval,start_date,end_date):
     Interval Type
     <CR><LF>
     '''
+    return f'HIT,{ticker},{str(interval)},{str(start_date)} 075000,{str(end_date)} 161500,,093000,160000,1\n'
 
-    message = f'HIT,{ticker},{str(interval)},{str(start_date)} 075000,{str(end_date)} 161500,,093000,160000,1\n'
-
-    try:
-        # Open a streaming socket to the IQFeed local gateway
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(20)
-        sock.connect((host, port))
+def open_historical_socket(timeout=20):
+    ''' Open a streaming socket to the IQFeed local gateway (historical data port) '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect((IQFEED_HOST, HIST_PORT))
+    return sock
 
-        # Send the historical data request message and buffer the data
-        data = ''
-        sock.sendall(message.encode())
-        data = read_historical_data_socket(sock)
-        sock.close
-    except Exception as e:
-        print('\n=======================================\n')
-        print(f'SOCKET ERROR downloading ticker {ticker}')
-        print(e)
-        print('\n=======================================\n')
-        raise
+#==============================================================================
 
-    if len(data) > 0:
-        # Replace spaces between fields with commas
-        data = data.replace(' ',',')
-        # Remove all the endlines and line-ending comma delimiter from each record
-        data = data.replace(',\r','')
+def download_ticker(ticker,interval,start_date,end_date,sock=None):
+    '''
+    ticker: self explanatory, e.g. 'SPY' [string]
+    interval: number of seconds per bar [int]
+    start & end dates: YYYYMMDD [int]
+    sock: open historical socket to reuse - opened & closed here if None
 
-        # Split data into rows & fields for conversion to dataframe
-        split_data = [s.split(',') for s in data.split('\n')]
+    #####################################################################################
+    # WARNING:
+    # FOR SOME SICK FUCKING REASON THE PRICE DATA COMES BACK HLOC instead of OHLC!
 
-        cols = ['date','time','high','low','open','close','openinterest','volume']
-        numeric_list = ['high','low','open','close','volume']
+    Data returned as:
+    [YYYY-MM-DD HH:mm:SS],[HIGH],[LOW],[OPEN],[CLOSE],[OPEN INTEREST],[VOLUME]
+    #####################################################################################
 
-        df = pd.DataFrame(data=split_data,columns=cols)
+    Returns one DataFrame (OHLC column order) - use stream_ticker for long ranges
+    '''
 
-        # Reorder columns and drop 'openinterest'
-        df = df[['date','time','open','high','low','close','volume']]
-        
-        # Convert strings to numerics for price & volume data (date & time left as strings)
-        for c in numeric_list:
-            df[c] = pd.to_numeric(df[c])
+    frames = list(stream_ticker(ticker,interval,start_date,end_date,sock))
 
-        return df
+    if len(frames) > 0:
+        df = pd.concat(frames,ignore_index=True)
+        return df[OHLC_COLUMNS]
 
     else:
         print('\n=======================================\n')
         print(f'No data to save for ticker: {ticker}!')
         print('\n=======================================\n')
 
+def stream_ticker(ticker,interval,start_date,end_date,sock=None,block_bytes=1<<20):
+    '''
+    Same request as download_ticker, but yields typed DataFrames of ~block_bytes
+    of response each while the data arrives - memory stays flat for long ranges
+    A reused sock must be read to the end (or discarded) before its next request
+    '''
+
+    print(f'Downloading historical data for symbol: {ticker}')
+
+    # Construct the message to call for intraday data
+    message = hit_request(ticker,interval,start_date,end_date)
+
+    own_socket = sock is None
+    try:
+        if own_socket:
+            sock = open_historical_socket()
+
+        # Send the historical data request message and parse the data as it arrives
+        sock.sendall(message.encode())
+        for block in iter_historical_blocks(sock,block_bytes=block_bytes):
+            df = parse_historical_block(block)
+            if df is not None and len(df) > 0:
+                yield df
+    except Exception as e:
+        print('\n=======================================\n')
+        print(f'SOCKET ERROR downloading ticker {ticker}')
+        print(e)
+        print('\n=======================================\n')
+        raise
+    finally:
+        if own_socket and sock:
+            sock.close()
+
 #==============================================================================
 
-def main():
+def main(interval=60,days=5):
+    ''' Download the last few days of bars for TICKERS (see backfill.py to store them) '''
+
+    end_date = pd.Timestamp.now()
+    start_date = end_date - pd.Timedelta(days,'D')
 
+    frames = {}
     for tkr in TICKERS:
-        download_ticker(tkr)
+        frames[tkr] = download_ticker(tkr,interval,start_date.strftime('%Y%m%d'),end_date.strftime('%Y%m%d'))
+    return frames
 
 #==============================================================================
 
@@ -1,71 +1,105 @@
 import pandas as pd
-from collections import namedtuple
 import threading
 import queue
-from time import sleep
+from datetime import datetime, timedelta
+from time import perf_counter
+import metrics
+from bars import parse_bar
 
-class Listener():
-    def __init__(self,iq_queue,db_queue,logger,symbols):
-        '''
-        For logging:
-        logger.log(msg,how)
-        how = string = comination of 'f','p','t'
-        'f' = write to file; 'p' = print; 't' = Telegram message
-        '''
-        self._symbol_list = symbols
+class MessageHandler():
+    '''
+    Parses IQFeed derivative-port messages and hands complete bars to bar_sink
+    Shared by the threaded Listener and the asyncio runtime (aio_pipeline.py)
 
-        self._db_queue = db_queue
-        self._Bar = namedtuple('Bar',['symbol','date','time','open',
-                                'high','low','close','volume','cumvol'])
+    bar_sink = callable taking one bars.Bar
+    Complete bars also go to every callable added with add_bar_listener
+    symbols = the valid symbols, usually the shared universe.SymbolRegistry -
+    bars of other symbols (e.g. removed at runtime, still in flight) are dropped
+    BU updates are dropped unless an updates.UpdateAggregator is set (aggregate_updates)
+    H/C bars at or before the newest bar already handled for their symbol
+    (replays after a reconnect or a move to another shard) are dropped
+    last_ts = {symbol: Bar.ts} of the newest bars, shared by handlers that take
+    symbols over from each other (shards.ShardedFeed)
 
-        self._logger = logger
+    For logging:
+    logger.log(msg,how)
+    how = string = comination of 'f','p','t'
+    'f' = write to file; 'p' = print; 't' = Telegram message
+    '''
 
-        self._iq_queue = iq_queue
-        self._listener_thread = threading.Thread(target=self,name='ListenerThread')
-        self._stop = threading.Event()
+    def __init__(self,bar_sink,logger,symbols,last_ts=None):
+        # Hashed membership - a list would be scanned for every bar
+        self._symbols = set(symbols) if isinstance(symbols,(list,tuple)) else symbols
+        self._dropped = set()
+
+        self._bar_sink = bar_sink
+        self._bar_listeners = []
+        self._updates = None
+        # perf_counter() at socket receipt & queue pull of the batch being handled
+        self._received = None
+        self._dequeued = None
+        # Wall clock on the Bar.ts scale at the pull (bar staleness)
+        self._wall = None
+        # Newest H/C bar per symbol (Bar.ts) - where a reconnect resumes
+        self._last_ts = {} if last_ts is None else last_ts
+        self.replayed = 0
+
+        self._logger = logger
 
         self._process_funcs = {}
         self._set_message_mappings()
 
-    ###########################################################################
-    # Threading functions
-    def __call__(self):
-        while not self._stop.is_set():
-            self._pull_queue()
+    def add_bar_listener(self,listener):
+        ''' listener = callable taking one bars.Bar, called for every H & C bar (e.g. BarCache.update) '''
+        self._bar_listeners.append(listener)
 
-    def start_listening(self):
-        self._stop.clear()
-        if not self._listener_thread.is_alive():
-            self._listener_thread.start()
-            print('Listening on queue...')
+    def aggregate_updates(self,aggregator):
+        ''' aggregator = updates.UpdateAggregator fed with every BU message '''
+        self._updates = aggregator
 
-    def stop_listening(self):
-        # Main thread calls to stop - wait until all items are processed
-        print('Waiting for listener queue to clear before killing thread')
-        self._iq_queue.join()
-        print('Killing Listener thread')
-        self._stop.set()
-        if self._listener_thread.is_alive():
-            self._listener_thread.join(30)
-        if self._listener_thread.is_alive():
-            print('ERROR! Listener thread may still be alive!')
+    def resume_points(self,symbols):
+        '''
+        {symbol: (date, time)} one second after the newest bar handled, for the
+        symbols that had one - a BW from there only sends the bars missed
+        (connection.BarsConnection resume_from)
+        '''
+        points = {}
+        for sym in symbols:
+            ts = self._last_ts.get(sym)
+            if ts is not None:
+                resume = datetime(1970,1,1) + timedelta(seconds=ts + 1)
+                points[sym] = (resume.date(),resume.time())
+        return points
 
-    ###########################################################################
-    # Message parsing
-    def _pull_queue(self):
+    def handle_batches(self,batches):
         '''
-        Keep pulling so long as items are in queue - sleep if queue is empty
-        Queue items should only be a list of fields
+        batches = list of (receipt time, list of messages, each a list of fields)
+        as produced by the connection reader
         '''
-        fields = None
-        try:
-            fields = self._iq_queue.get(block=False)
-            handle_func = self._process_function(fields)
-            handle_func(fields)
-            self._iq_queue.task_done()
-        except queue.Empty:
-            sleep(1)
+        self._dequeued = perf_counter()
+        self._wall = metrics.wall_epoch()
+        metrics.pipeline.record('socket_to_get',[self._dequeued - received for received,_ in batches if received])
+
+        counts = {}
+        for received,messages in batches:
+            self._received = received
+            for fields in messages:
+                kind = fields[0][0]
+                if kind == 'B':
+                    kind = fields[1]
+                counts[kind] = counts.get(kind,0) + 1
+                handle_func = self._process_function(fields)
+                handle_func(fields)
+
+        if self._updates:
+            self._updates.publish_due()
 
+        metrics.parse_seconds.observe(perf_counter() - self._dequeued)
+        for kind,n in counts.items():
+            metrics.messages.inc_label(kind,n)
+
+    ###########################################################################
+    # Message parsing
     def _set_message_mappings(self):
 
         self._process_funcs['n'] = self._process_wrong_symbol
@@ -84,21 +118,22 @@ class Listener():
     def _process_bar(self,fields):
 
         assert fields[0][0] == 'B'
-        assert fields[2] in self._symbol_list
-
-        dt = fields[3].split(' ') # split datetime into 2 fields ('YYYY-MM-DD HH:MM:SS')
-
-        bar = self._Bar(
-        symbol=fields[2],
-        date=dt[0],
-        time=dt[1],
-        open=fields[4],
-        high=fields[5],
-        low=fields[6],
-        close=fields[7],
-        volume=fields[9],
-        cumvol=fields[8],
-        )
+        if fields[2] not in self._symbols:
+            self._process_untracked_symbol(fields)
+            return
+
+        if fields[1] == 'BU':
+            # Folded in place - no Bar per update
+            if self._updates:
+                self._updates.update(fields)
+            return
+
+        bar = parse_bar(fields,self._received,self._dequeued)
+        last = self._last_ts.get(bar.symbol)
+        if last is not None and bar.ts <= last:
+            self.replayed += 1
+            return
+        self._last_ts[bar.symbol] = bar.ts
 
         #########################################################################
         # THIS IS WHERE I NEED TO CHANGE FOR PRODCUTION
@@ -106,18 +141,24 @@ class Listener():
         # Type = field[1] = 'B[type]'
         # types: U = update, H = complete from history, C = complete new live bar
 
-        if fields[1][1] == 'U':
-            pass
-        elif fields[1][1] == 'H':
-            self._db_queue.put(bar) # in future, will not want to put historical bars in database
-        elif fields[1][1] == 'C':
-            self._db_queue.put(bar)
+        if bar.kind == 'H':
+            self._publish_bar(bar) # in future, will not want to put historical bars in database
+        elif bar.kind == 'C':
+            metrics.bar_staleness.observe(self._wall - bar.ts)
+            if self._updates:
+                self._updates.check(fields[0],bar)
+            self._publish_bar(bar)
         else:
-            msg = f'Unidentified Bar Type Field! == {fields[1][1]}\n{fields}'
-            self._logger(msg,how='tfp')
+            msg = f'Unidentified Bar Type Field! == {bar.kind}\n{fields}'
+            self._logger.log(msg,how='tfp')
             raise Exception(msg)
         #########################################################################
 
+    def _publish_bar(self,bar):
+        self._bar_sink(bar)
+        for listener in self._bar_listeners:
+            listener(bar)
+
     def _process_system_msg(self,fields):
         assert len(fields) > 1
         assert fields[0] == 'S'
@@ -143,11 +184,16 @@ class Listener():
         self._logger.log(f'Heartbeat: {fields[1]}',how='p')
 
     def _process_wrong_symbol(self,fields):
-        assert field[0] == 'n'
+        assert fields[0] == 'n'
         assert len(fields) > 1
         msg = f'IQFeed: Invalid symbol {fields[1]}'
         self._logger.log(msg,how='tfp')
 
+    def _process_untracked_symbol(self,fields):
+        if fields[2] not in self._dropped:
+            self._dropped.add(fields[2])
+            self._logger.log(f'Dropping bars of untracked symbol {fields[2]}',how='fp')
+
     def _process_unregistered_message(self,fields):
         msg = ','.join(fields)
         self._logger.log(f'UNREGISTERED MESSAGE: {msg}',how='tfp')
@@ -161,4 +207,61 @@ class Listener():
             intv = elements.pop(0)
             reqid = elements.pop(0)
             msg = f'WATCHING: Symbol: {sym}   Interval: {intv}   RequestID: {reqid}'
-            self._logger.log(msg,how='fp')
\ No newline at end of file
+            self._logger.log(msg,how='fp')
+
+class Listener(MessageHandler):
+
+    # Seconds to block on an empty queue before checking for shutdown
+    poll_timeout = 0.5
+
+    def __init__(self,iq_queue,db_queue,logger,symbols,name='ListenerThread',last_ts=None):
+        super().__init__(db_queue.put,logger,symbols,last_ts)
+
+        self._db_queue = db_queue
+
+        self._iq_queue = iq_queue
+        self._listener_thread = threading.Thread(target=self,name=name)
+        self._stop = threading.Event()
+
+    ###########################################################################
+    # Threading functions
+    def __call__(self):
+        while not self._stop.is_set():
+            self._pull_queue()
+
+    def start_listening(self):
+        self._stop.clear()
+        if not self._listener_thread.is_alive():
+            self._listener_thread.start()
+            print('Listening on queue...')
+
+    def stop_listening(self):
+        # Main thread calls to stop - wait until all items are processed
+        print('Waiting for listener queue to clear before killing thread')
+        self._iq_queue.join()
+        print('Killing Listener thread')
+        self._stop.set()
+        if self._listener_thread.is_alive():
+            self._listener_thread.join(30)
+        if self._listener_thread.is_alive():
+            print('ERROR! Listener thread may still be alive!')
+
+    def _pull_queue(self):
+        '''
+        Block until a batch arrives (with a timeout so stop_listening is noticed),
+        then drain every batch already waiting and process them together
+        '''
+        try:
+            batches = [self._iq_queue.get(timeout=Listener.poll_timeout)]
+        except queue.Empty:
+            return
+
+        while True:
+            try:
+                batches.append(self._iq_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        self.handle_batches(batches)
+        for _ in batches:
+            self._iq_queue.task_done()
\ No newline at end of file
@@ -1,13 +1,21 @@
 from time import sleep
+import os
 import configparser
 import subprocess
 import threading
-import queue
 import logging
-import connection
-import listener
+import shards
+import backpressure
+import mp_pipeline
 import mylogger
 import postgres
+import dbpool
+import barcache
+import updates
+import resample
+import metrics
+import ticks
+import universe
 import traceback
 
 def start_iqconnect(pID,uID,pw):
@@ -24,12 +32,91 @@ def start_iqconnect(pID,uID,pw):
 def iq_thread(exe_args):
     subprocess.run(exe_args)
 
+def check_processes_mode(config,symbols):
+    ''' Raise if a feature that needs the threaded pipeline is enabled together with [pipeline] mode = processes '''
+    enabled = []
+    if config.has_section('cache') and config['cache'].getint('port',fallback=0):
+        enabled.append('[cache] port')
+    if resample.intervals_from_config(config,symbols):
+        enabled.append('[resample] intervals')
+    if updates.aggregator_from_config(config,None):
+        enabled.append('[updates] enabled')
+    if config.has_section('ticks') and config['ticks'].getboolean('enabled',fallback=False):
+        enabled.append('[ticks] enabled')
+    if enabled:
+        raise ValueError(f"[pipeline] mode = processes does not support {', '.join(enabled)} - "
+                         f"disable them or use mode = threads")
+
+def add_bar_consumers(config,feed,db,db_queue,symbols,logger):
+    ''' Bar cache, resampling & update aggregation on the threaded feed - returns the cache, its server & the resampler (or None) '''
+    cache_server = None
+    resampler = None
+
+    # Recent bars in memory for strategy code (optionally served on a local port)
+    cache = barcache.cache_from_config(config)
+    feed.add_bar_listener(cache.update)
+    if config.has_section('cache') and config['cache'].getint('port',fallback=0):
+        cache_server = barcache.CacheServer(cache,config['cache'].getint('port'))
+        cache_server.start()
+
+    # Coarser intervals derived from the base bars (one BW watch per symbol)
+    derived = resample.intervals_from_config(config,symbols)
+    if derived:
+        resampler = resample.Resampler(config['market'].getint('interval_seconds'),derived,
+                                       [db_queue.put,cache.update])
+        for sym,interval in resampler.targets():
+            db.ensure_table(sym,interval)
+        feed.add_bar_listener(resampler.add)
+
+    # Forming bars from BU updates, snapshotted into the cache at a throttled rate
+    for listen in feed.listeners:
+        aggregator = updates.aggregator_from_config(config,logger)
+        if aggregator:
+            if config['updates'].getboolean('cache',fallback=True):
+                aggregator.subscribe(cache.update)
+            listen.aggregate_updates(aggregator)
+
+    return cache, cache_server, resampler
+
+def track_symbol_changes(config,registry,feed,db,resampler,tick_feed,logger):
+    '''
+    Tables, resampling & watches for symbols added to / removed from the
+    registry at runtime - returns the started watchers ([universe])
+    '''
+
+    def added(symbols):
+        derived = resample.intervals_from_config(config,symbols)
+        for sym in symbols:
+            db.ensure_table(sym)
+            for k in derived.get(sym,[]):
+                db.ensure_table(sym,k)
+            if tick_feed:
+                for k in tick_feed.intervals:
+                    db.ensure_table(sym,k)
+        if resampler:
+            resampler.add_symbols(derived)
+        feed.add_symbols(symbols)
+        if tick_feed:
+            tick_feed.add_symbols(symbols)
+
+    def removed(symbols):
+        feed.remove_symbols(symbols)
+        if tick_feed:
+            tick_feed.remove_symbols(symbols)
+
+    registry.subscribe(added,removed)
+    return universe.watchers_from_config(config,registry,logger)
+
 if __name__ == "__main__":
 
-    conn = None         # socket to IQFeed
+    feed = None         # sockets to IQFeed & parsers between IQFeed & Database (one pair per shard)
     db = None           # database connection
-    listen = None       # intermediary parser between IQFeed & Database
     iqthread = None     # thread for running IQconnect.exe (gateway)
+    mylog = None        # logger (background thread)
+    cache_server = None # local endpoint for the bar cache
+    metrics_server = None   # local /metrics endpoint
+    tick_feed = None    # level 1 trades -> locally built bars & tick store
+    watchers = []       # config.ini / control port sources of symbol changes
 
     try:
 
@@ -42,30 +129,77 @@ if __name__ == "__main__":
         symbols = config['market']['symbols']
         symbols = symbols.split(',')
         print('Tracking symbols:',symbols)
+        # Shared by the feed, Listeners & symbol watchers - changes at runtime
+        registry = universe.SymbolRegistry(symbols)
+        resampler = None
 
-        iqthread = start_iqconnect( pwd['iqfeed']['productID'],
-                                    pwd['iqfeed']['iq_user'],
-                                    pwd['iqfeed']['iq_pass'])
+        # IQCONNECT_SKIP=1 -> use a gateway that is already running (or replay_server.py)
+        if not os.getenv('IQCONNECT_SKIP'):
+            iqthread = start_iqconnect( pwd['iqfeed']['productID'],
+                                        pwd['iqfeed']['iq_user'],
+                                        pwd['iqfeed']['iq_pass'])
 
         mylog = mylogger.Logger(    pwd['telegram']['botToken'],
                                     pwd['telegram']['chatID'],
                                     config['system']['log_path'])
 
-        db_queue = queue.Queue()
-        iq_queue = queue.Queue()
-
-        db = postgres.DatabaseConnection(db_queue,mylog)
-        db.connect()
+        if config.has_section('pipeline') and config['pipeline'].get('mode',fallback='threads') == 'processes':
+            # Parsing & database writes run in worker processes (mp_pipeline.py) -
+            # this connection only answers the catch-up query
+            check_processes_mode(config,symbols)
+            db = postgres.database_connection(None,mylog)
+            db.connect(start_thread=False)
+            feed = mp_pipeline.ProcessFeed(mylog,symbols,config,config['pipeline'].getint('workers',fallback=2),
+                                           resume_from=db.latest_bars)
+            metrics.registry.gauge('iqfeed_ring_backlog_bytes','Bytes waiting in each parse worker ring',
+                                   feed.queue_depths,'worker')
+        else:
+            db_queue = backpressure.queue_from_config(config,'db',mylog)
+
+            db = dbpool.database_writer(db_queue,mylog)
+            db.connect()
+
+            feed = shards.ShardedFeed(  db_queue,mylog,registry,shards.shard_count(config,symbols),
+                                        latest_bars=db.latest_bars,config=config)
+            cache, cache_server, resampler = add_bar_consumers(config,feed,db,db_queue,symbols,mylog)
+
+            # Bars built from every trade on the level 1 port
+            derived = resample.intervals_from_config(config,symbols)
+            exclude = {config['market'].getint('interval_seconds')}.union(*derived.values())
+            tick_feed = ticks.feed_from_config(config,symbols,[db_queue.put,cache.update],mylog,exclude)
+            if tick_feed:
+                for sym in symbols:
+                    for k in tick_feed.intervals:
+                        db.ensure_table(sym,k)
+                metrics.registry.gauge('iqfeed_tick_queue_depth','Socket reads waiting in the tick queue',
+                                       tick_feed.queue_depths,'queue')
+            metrics.registry.gauge('iqfeed_db_queue_depth','Bars waiting in db_queue',db_queue.qsize)
+            metrics.registry.gauge('iqfeed_iq_queue_depth','Socket reads waiting in each shard iq_queue',
+                                   feed.queue_depths,'shard')
+
+        metrics_server = metrics.server_from_config(config)
+
+        feed.start_listening()
+        feed.connect()
+        if tick_feed:
+            tick_feed.start_listening()
+            tick_feed.connect()
 
-        listen = listener.Listener(iq_queue,db_queue,mylog,symbols)
-        listen.start_listening()
+        sleep(2)
 
-        conn = connection.BarsConnection(iq_queue,mylog)
-        conn.connect()
+        latest = None
+        if config['market'].getboolean('catchup',fallback=False):
+            # Only ask IQFeed for bars newer than what is already stored
+            latest = db.latest_bars(symbols)
 
-        sleep(2)
+        feed.subscribe_to_symbols(config,latest)
+        if tick_feed:
+            tick_feed.subscribe_to_symbols()
 
-        conn.subscribe_to_symbols(symbols,config)
+        if isinstance(feed,shards.ShardedFeed):
+            watchers = track_symbol_changes(config,registry,feed,db,resampler,tick_feed,mylog)
+        else:
+            print('Symbols are fixed in processes mode - runtime changes need [pipeline] mode = threads')
 
         print('Application initialized - main() looping...')
 
@@ -73,6 +207,10 @@ if __name__ == "__main__":
         run = True
         while run:
             sleep(5)
+            feed.maybe_report()
+            if tick_feed:
+                tick_feed.maybe_report()
+            metrics.registry.maybe_report(mylog)
 
 
     except KeyboardInterrupt:
@@ -85,16 +223,26 @@ if __name__ == "__main__":
         print(traceback.format_exc())
     finally:
         print('Shutting threads down...')
-        if conn:
-            conn.disconnect()
-        if listen:
-            listen.stop_listening()
+        for watcher in watchers:
+            watcher.stop()
+        if tick_feed:
+            tick_feed.disconnect()
+            tick_feed.stop_listening()
+        if feed:
+            feed.disconnect()
+            feed.stop_listening()
         if db:
             db.disconnect()
+        if cache_server:
+            cache_server.stop()
+        if metrics_server:
+            metrics_server.stop()
         if iqthread:
             print('Waiting for IQconnect.exe to shut down')
             if iqthread.is_alive():
                 iqthread.join(timeout=30)
             if iqthread.is_alive():
                 print('ERROR iqthread is still alive!')
+        if mylog:
+            mylog.close()
         print('Shutting down...')
\ No newline at end of file
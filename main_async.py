@@ -0,0 +1,64 @@
+import asyncio
+import os
+import configparser
+import logging
+import traceback
+import aio_pipeline
+import mylogger
+from main import start_iqconnect
+
+async def run(config,mylog,symbols):
+    pipeline = aio_pipeline.AsyncPipeline(config,mylog,symbols)
+    try:
+        await pipeline.start()
+        print('Application initialized - event loop running...')
+        await pipeline.wait()
+    finally:
+        print('Shutting pipeline down...')
+        await pipeline.stop()
+
+if __name__ == "__main__":
+
+    iqthread = None     # thread for running IQconnect.exe (gateway)
+    mylog = None        # logger (background thread)
+
+    try:
+
+        config = configparser.ConfigParser()
+        config.read('config.ini')
+
+        pwd = configparser.ConfigParser()
+        pwd.read('user.pwd')
+
+        symbols = config['market']['symbols']
+        symbols = symbols.split(',')
+        print('Tracking symbols:',symbols)
+
+        if not os.getenv('IQCONNECT_SKIP'):
+            iqthread = start_iqconnect( pwd['iqfeed']['productID'],
+                                        pwd['iqfeed']['iq_user'],
+                                        pwd['iqfeed']['iq_pass'])
+
+        mylog = mylogger.Logger(    pwd['telegram']['botToken'],
+                                    pwd['telegram']['chatID'],
+                                    config['system']['log_path'])
+
+        # Runs until a stage fails or user --> CTRL-C (a dropped feed is reconnected)
+        asyncio.run(run(config,mylog,symbols))
+
+    except KeyboardInterrupt:
+        print('User terminating application...')
+    except Exception:
+        msg = 'Main Loop Exception!'
+        logging.exception(msg)
+        print(traceback.format_exc())
+    finally:
+        if iqthread:
+            print('Waiting for IQconnect.exe to shut down')
+            if iqthread.is_alive():
+                iqthread.join(timeout=30)
+            if iqthread.is_alive():
+                print('ERROR iqthread is still alive!')
+        if mylog:
+            mylog.close()
+        print('Shutting down...')
@@ -0,0 +1,351 @@
+'''
+Pipeline instrumentation
+
+PipelineLatency - per-stage latency percentiles of bars (socket -> commit)
+Registry        - counters, gauges & histograms in the Prometheus text format,
+                  served on a local /metrics endpoint (MetricsServer) and
+                  summarised to the log every report_seconds
+
+Hot path updates are plain attribute/list increments without a lock; an
+increment racing another thread can be lost, which only makes a rate a
+little low. Queue depths are gauges read only when scraped or reported.
+
+    [metrics]
+    port = 9108             0 = no HTTP endpoint
+    report_seconds = 60
+'''
+
+import bisect
+import http.server
+import threading
+from collections import deque
+from time import perf_counter, time, localtime
+
+class LatencyStats():
+    '''
+    Running latency summary (seconds) for one pipeline stage
+    Keeps count/total/max since the last report plus a bounded sample for percentiles
+    '''
+
+    def __init__(self,name,samples=10000):
+        self.name = name
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=samples)
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def extend(self,values):
+        with self._lock:
+            for v in values:
+                self._count += 1
+                self._total += v
+                if v > self._max:
+                    self._max = v
+                self._samples.append(v)
+
+    def snapshot(self,reset=False):
+        with self._lock:
+            ordered = sorted(self._samples)
+            snap = {'count': self._count,
+                    'mean': self._total / self._count if self._count else 0.0,
+                    'p50': _percentile(ordered,0.50),
+                    'p99': _percentile(ordered,0.99),
+                    'max': self._max}
+            if reset:
+                self._samples.clear()
+                self._count = 0
+                self._total = 0.0
+                self._max = 0.0
+        return snap
+
+def _percentile(ordered,q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1,int(q * len(ordered)))]
+
+class PipelineLatency():
+    '''
+    Per-stage latency of bars moving through the pipeline:
+    socket_to_get    = socket receipt -> Listener pulls the batch off iq_queue
+    get_to_commit    = Listener pull -> DatabaseConnection commits the bar
+    socket_to_commit = socket receipt -> commit (end to end)
+    '''
+
+    stages = ('socket_to_get','get_to_commit','socket_to_commit')
+
+    def __init__(self,report_seconds=60):
+        self.report_seconds = report_seconds
+        self._stats = {name: LatencyStats(name) for name in PipelineLatency.stages}
+        self._last_report = perf_counter()
+
+    def record(self,stage,values):
+        self._stats[stage].extend(values)
+
+    def snapshot(self,reset=False):
+        return {name: stats.snapshot(reset) for name,stats in self._stats.items()}
+
+    def maybe_report(self,logger):
+        ''' Log (and reset) the stage summaries once every report_seconds '''
+        now = perf_counter()
+        if now - self._last_report < self.report_seconds:
+            return
+        self._last_report = now
+        for name,snap in self.snapshot(reset=True).items():
+            if snap['count'] == 0:
+                continue
+            msg = (f"Latency {name}: n={snap['count']} mean={snap['mean']*1000:.1f}ms "
+                   f"p50={snap['p50']*1000:.1f}ms p99={snap['p99']*1000:.1f}ms max={snap['max']*1000:.1f}ms")
+            logger.log(msg,how='f')
+
+###############################################################################
+# Counters, gauges & histograms
+
+class Counter():
+    ''' Monotonic total, optionally split by one label (e.g. message type) '''
+
+    def __init__(self,name,description,label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.value = 0
+        self.values = {}
+
+    def inc(self,n=1):
+        self.value += n
+
+    def inc_label(self,key,n=1):
+        self.values[key] = self.values.get(key,0) + n
+
+    def samples(self):
+        if self.label is None:
+            return {None: self.value}
+        return dict(self.values)
+
+class Gauge():
+    '''
+    Value read when scraped: fn() returns a number, or {label value: number}
+    when the gauge has a label (e.g. one iq_queue per shard)
+    '''
+
+    def __init__(self,name,description,fn,label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self._fn = fn
+
+    def samples(self):
+        value = self._fn()
+        if self.label is None:
+            return {None: value}
+        return dict(value)
+
+class Histogram():
+    ''' Fixed bucket histogram - observe() is one bisect and two adds '''
+
+    def __init__(self,name,description,buckets):
+        self.name = name
+        self.description = description
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)     # last = above every bound (+Inf)
+        self.sum = 0.0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.bounds,value)] += 1
+        self.sum += value
+
+    def observe_many(self,values):
+        bounds, counts = self.bounds, self.counts
+        for value in values:
+            counts[bisect.bisect_left(bounds,value)] += 1
+            self.sum += value
+
+    def quantile(self,q,counts=None):
+        ''' Upper bound of the bucket holding quantile q (of counts, default all observations) '''
+        counts = counts if counts is not None else self.counts
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i,n in enumerate(counts):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+class Registry():
+    ''' All metrics of the process - rendered for /metrics and summarised to the log '''
+
+    def __init__(self,report_seconds=60):
+        self.report_seconds = report_seconds
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._last_report = perf_counter()
+        self._last = {}     # name -> counter samples / histogram counts at the last report
+
+    def counter(self,name,description,label=None):
+        return self._add(Counter(name,description,label))
+
+    def gauge(self,name,description,fn,label=None):
+        ''' Registering a name again replaces the gauge (e.g. a new feed) '''
+        with self._lock:
+            self._metrics[name] = Gauge(name,description,fn,label)
+            return self._metrics[name]
+
+    def histogram(self,name,description,buckets):
+        return self._add(Histogram(name,description,buckets))
+
+    def _add(self,metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name,metric)
+
+    ###########################################################################
+    # Prometheus text format
+
+    def render(self,latency=None):
+        ''' Text exposition format 0.0.4 - latency = PipelineLatency added as summaries '''
+        with self._lock:
+            items = list(self._metrics.values())
+        out = []
+        for metric in items:
+            if isinstance(metric,Histogram):
+                out.append(f'# HELP {metric.name} {metric.description}')
+                out.append(f'# TYPE {metric.name} histogram')
+                counts = list(metric.counts)
+                cumulative = 0
+                for bound,n in zip(metric.bounds + (float('inf'),),counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    out.append(f'{metric.name}_bucket{{le="{le}"}} {cumulative}')
+                out.append(f'{metric.name}_sum {metric.sum}')
+                out.append(f'{metric.name}_count {cumulative}')
+                continue
+            try:
+                samples = metric.samples()
+            except Exception:
+                continue    # a gauge whose source is gone
+            out.append(f'# HELP {metric.name} {metric.description}')
+            out.append(f"# TYPE {metric.name} {'counter' if isinstance(metric,Counter) else 'gauge'}")
+            for key,value in samples.items():
+                labels = '' if key is None else f'{{{metric.label}="{key}"}}'
+                out.append(f'{metric.name}{labels} {value}')
+
+        if latency is not None:
+            name = 'iqfeed_pipeline_latency_seconds'
+            out.append(f'# HELP {name} Bar latency by pipeline stage since the last log report')
+            out.append(f'# TYPE {name} summary')
+            for stage,snap in latency.snapshot().items():
+                out.append(f'{name}{{stage="{stage}",quantile="0.5"}} {snap["p50"]}')
+                out.append(f'{name}{{stage="{stage}",quantile="0.99"}} {snap["p99"]}')
+                out.append(f'{name}_sum{{stage="{stage}"}} {snap["mean"] * snap["count"]}')
+                out.append(f'{name}_count{{stage="{stage}"}} {snap["count"]}')
+        return '\n'.join(out) + '\n'
+
+    ###########################################################################
+    # Log summary
+
+    def maybe_report(self,logger):
+        ''' Log rates, gauges & histogram quantiles since the last report once every report_seconds '''
+        now = perf_counter()
+        elapsed = now - self._last_report
+        if elapsed < self.report_seconds:
+            return
+        self._last_report = now
+        with self._lock:
+            items = list(self._metrics.values())
+
+        for metric in items:
+            if isinstance(metric,Histogram):
+                counts = list(metric.counts)
+                last_counts, last_sum = self._last.get(metric.name,([0] * len(counts),0.0))
+                delta = [n - m for n,m in zip(counts,last_counts)]
+                total = metric.sum
+                self._last[metric.name] = (counts,total)
+                n = sum(delta)
+                if n:
+                    msg = (f'{metric.name}: n={n} mean={(total - last_sum) / n:.4g} '
+                           f'p50<={metric.quantile(0.5,delta):.4g} p99<={metric.quantile(0.99,delta):.4g}')
+                    logger.log(msg,how='f')
+                continue
+            try:
+                samples = metric.samples()
+            except Exception:
+                continue
+            if isinstance(metric,Counter):
+                last = self._last.get(metric.name,{})
+                self._last[metric.name] = samples
+                rates = {key: (value - last.get(key,0)) / elapsed for key,value in samples.items()}
+                text = ', '.join(f'{key}={rate:,.1f}/s' if key is not None else f'{rate:,.1f}/s'
+                                 for key,rate in sorted(rates.items(),key=lambda kv: str(kv[0])))
+            else:
+                text = ', '.join(f'{key}={value:,}' if key is not None else f'{value:,}'
+                                 for key,value in sorted(samples.items(),key=lambda kv: str(kv[0])))
+            if text:
+                logger.log(f'{metric.name}: {text}',how='f')
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render(self.server.latency).encode()
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass    # no line per scrape
+
+class MetricsServer():
+    ''' Serves a Registry as GET /metrics on a localhost port '''
+
+    def __init__(self,registry,port,host='127.0.0.1',latency=None):
+        self._server = http.server.ThreadingHTTPServer((host,port),_MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self._server.latency = latency
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,name='MetricsServer',daemon=True)
+
+    def start(self):
+        self._thread.start()
+        print(f'Metrics served on http://127.0.0.1:{self.port}/metrics')
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def wall_epoch():
+    ''' Local wall clock as epoch seconds on the same (exchange time as UTC) scale as Bar.ts '''
+    return time() + localtime().tm_gmtoff
+
+def server_from_config(config):
+    ''' Sets the report interval and starts a MetricsServer if [metrics] port is set - returns it or None '''
+    if not config.has_section('metrics'):
+        return None
+    registry.report_seconds = config['metrics'].getint('report_seconds',fallback=60)
+    port = config['metrics'].getint('port',fallback=0)
+    if not port:
+        return None
+    server = MetricsServer(registry,port,latency=pipeline)
+    server.start()
+    return server
+
+# Shared by BarsConnection, Listener and DatabaseConnection
+pipeline = PipelineLatency()
+registry = Registry()
+
+socket_bytes = registry.counter('iqfeed_socket_bytes_total','Bytes read from the IQFeed derivative port')
+disconnects = registry.counter('iqfeed_disconnects_total','IQFeed socket drops & stale heartbeats')
+messages = registry.counter('iqfeed_messages_total','Messages parsed by type','type')
+parse_seconds = registry.histogram( 'iqfeed_parse_seconds','MessageHandler time per iq_queue pull',
+                                    (0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1))
+db_rows = registry.counter('iqfeed_db_rows_total','Bars committed to the database')
+db_batch_seconds = registry.histogram(  'iqfeed_db_batch_seconds','Database write time per batch',
+                                        (0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5))
+bar_staleness = registry.histogram( 'iqfeed_bar_staleness_seconds','Wall clock minus bar timestamp of complete live bars',
+                                    (0.1,0.25,0.5,1,2,5,10,30,60,300))
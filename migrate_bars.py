@@ -0,0 +1,105 @@
+'''
+Move the per-symbol bar tables into the partitioned `bars` tables
+
+    python migrate_bars.py [--symbols SPY,QQQ] [--drop]
+    python migrate_bars.py --dedupe [--symbols SPY,QQQ]
+
+Each table is copied server side (INSERT ... SELECT, no rows through the
+client) in its own transaction. Bars already migrated are skipped, so the
+migration can be re-run. Derived interval tables go to their own table
+(spy_300 -> bars_300s). --drop removes a per-symbol table once every one of
+its distinct (date,time) bars is in the table it migrated to. Then set schema = partitioned in config.ini.
+
+--dedupe migrates nothing: it deletes duplicate (date,time) bars from the
+per-symbol tables (keeping the oldest row) and adds the unique index that
+[market] catchup = true needs, logging the rows deleted per table. Catch-up
+refuses to start on a table with duplicates until this has been run.
+'''
+
+import argparse
+import configparser
+from time import perf_counter
+
+import mylogger
+import postgres
+
+def legacy_tables(db):
+    ''' Public tables with the per-symbol bar layout '''
+    with db._cursor_lock:
+        db._cursor.execute("""select table_name from information_schema.columns
+                              where table_schema = 'public' and column_name in ('date','time','cumvol')
+                              group by table_name having count(*) = 3""")
+        tables = [row[0] for row in db._cursor.fetchall()]
+        db._conn.commit()
+    return sorted(tables)
+
+def distinct_bars(db,table_name):
+    with db._cursor_lock:
+        db._cursor.execute(f"select count(*) from (select distinct symbol,date,time from {table_name}) d")
+        count = db._cursor.fetchone()[0]
+        db._conn.commit()
+    return count
+
+def migrated_bars(db,table_name):
+    target = db.migration_target(table_name)
+    with db._cursor_lock:
+        db._cursor.execute(f"""select count(*) from (select distinct symbol,date,time from {table_name}) d
+                               where exists (select 1 from {target} b
+                                             where b.symbol = d.symbol and b.ts = d.date + d.time)""")
+        count = db._cursor.fetchone()[0]
+        db._conn.commit()
+    return count
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Migrate per-symbol bar tables into the partitioned bars table')
+    parser.add_argument('--symbols',default=None,help='comma separated, with their derived tables (default: every per-symbol table)')
+    parser.add_argument('--drop',action='store_true',help='drop each table after it is verified')
+    parser.add_argument('--dedupe',action='store_true',help='only remove duplicate bars from the per-symbol tables')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+
+    pwd = configparser.ConfigParser()
+    pwd.read('user.pwd')
+
+    mylog = mylogger.Logger(    pwd['telegram']['botToken'],
+                                pwd['telegram']['chatID'],
+                                config['system']['log_path'])
+
+    if args.dedupe:
+        db = postgres.DatabaseConnection(None,mylog)
+    else:
+        db = postgres.PartitionedDatabaseConnection(None,mylog)
+    db.connect(start_thread=False,check_tables=not args.dedupe)
+    try:
+        tables = legacy_tables(db)
+        if args.symbols:
+            wanted = {sym.lower() for sym in args.symbols.split(',')}
+            # spy_300 is SPY's derived 5 minute table
+            tables = [t for t in tables if t in wanted or t.rpartition('_')[0] in wanted]
+
+        for table_name in tables:
+            if args.dedupe:
+                rows, removed = db.dedupe_table(table_name)
+                mylog.log(f'Deduped {table_name}: deleted {removed:,} of {rows:,} rows',how='fp')
+                continue
+
+            started = perf_counter()
+            count, inserted = db.migrate_table(table_name)
+            elapsed = perf_counter() - started
+            mylog.log(f'Migrated {table_name} -> {db.migration_target(table_name)}: {inserted:,} of {count:,} rows in {elapsed:.1f} s '
+                      f'({count / max(elapsed,1e-9):,.0f} rows/sec)',how='fp')
+
+            if args.drop:
+                if migrated_bars(db,table_name) == distinct_bars(db,table_name):
+                    with db._cursor_lock:
+                        db._cursor.execute(f"drop table {table_name};")
+                        db._conn.commit()
+                    mylog.log(f'Dropped {table_name}',how='fp')
+                else:
+                    mylog.log(f'WARNING: {table_name} not fully migrated - kept',how='tfp')
+    finally:
+        db.disconnect()
+        mylog.close()
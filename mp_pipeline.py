@@ -0,0 +1,433 @@
+'''
+Process pool pipeline - parsing and SQL formatting off the reader's GIL
+
+    reader (main process)  --shared memory rings-->  parser workers  --columnar batches-->  writer process
+
+The BarsConnection reader thread routes raw lines to the workers by request ID
+(so every symbol always goes to the same worker and its bars keep their order)
+and copies them into one shared_memory ring per worker. Each worker parses
+with MessageHandler and sends column lists of the bars it parsed to the writer
+process, which writes them with DatabaseConnection.write_bars.
+
+Selected with [pipeline] mode = processes (workers = N). The bar cache port,
+resampling, update aggregation and tick bars need the threaded pipeline -
+main.py refuses to start processes mode with any of them enabled. Parse &
+database metrics are logged by the worker processes but are not on the
+/metrics endpoint. A writer process that dies is restarted (at most
+writer_restarts times); a dead parser process stops the application.
+
+With [queues], the parsed bars waiting for the writer process are bounded to
+about db_size bars (db_size / batch_rows column batches): a full queue blocks
+the parsers, their rings fill and the reader waits. db_policy is always block.
+'''
+
+import multiprocessing as mp
+import os
+import queue
+import struct
+import threading
+import zlib
+from multiprocessing import shared_memory
+from time import sleep, monotonic, perf_counter
+
+import connection
+import listener
+import metrics
+import postgres
+from bars import Bar
+
+_POS = struct.Struct('<Q')
+_LEN = struct.Struct('<I')
+_RECEIVED = struct.Struct('<d')
+_WRAP = 0xFFFFFFFF
+
+class ShmRing():
+    '''
+    Single producer / single consumer ring of length prefixed records in a
+    multiprocessing.shared_memory block
+
+    Header: read position, write position (uint64 byte counts that only grow -
+    each is written by one side only). A semaphore counts unread records so
+    the consumer can block. A record that does not fit before the end of the
+    buffer starts over at offset 0.
+    '''
+
+    header = 16
+
+    def __init__(self,size,name=None,items=None):
+        self._size = size
+        self._shm = shared_memory.SharedMemory(name=name,create=name is None,size=size + ShmRing.header)
+        self._buf = self._shm.buf
+        self._items = items if items is not None else mp.Semaphore(0)
+        if name is None:
+            _POS.pack_into(self._buf,0,0)
+            _POS.pack_into(self._buf,8,0)
+
+    def __reduce__(self):
+        # Workers attach to the same block by name
+        return (ShmRing,(self._size,self._shm.name,self._items))
+
+    def put(self,payload,timeout=None):
+        ''' Copy payload into the ring - waits while the consumer is behind, queue.Full after timeout (None = forever) '''
+        need = _LEN.size + len(payload)
+        if need > self._size // 2:
+            raise ValueError(f'Record of {len(payload)} bytes too large for a {self._size} byte ring')
+
+        tail = _POS.unpack_from(self._buf,8)[0]
+        offset = tail % self._size
+        to_end = self._size - offset
+        skip = to_end if to_end < need else 0
+
+        deadline = None
+        while tail + skip + need - _POS.unpack_from(self._buf,0)[0] > self._size:
+            if timeout is not None:
+                deadline = deadline or monotonic() + timeout
+                if monotonic() > deadline:
+                    raise queue.Full
+            sleep(0.0005)
+
+        if skip:
+            if to_end >= _LEN.size:
+                _LEN.pack_into(self._buf,ShmRing.header + offset,_WRAP)
+            tail += skip
+            offset = 0
+
+        start = ShmRing.header + offset
+        _LEN.pack_into(self._buf,start,len(payload))
+        self._buf[start + _LEN.size:start + need] = payload
+        _POS.pack_into(self._buf,8,tail + need)
+        self._items.release()
+
+    def get(self,timeout=None):
+        ''' Next record (bytes), or None if none arrived within timeout '''
+        if not self._items.acquire(timeout=timeout):
+            return None
+
+        head = _POS.unpack_from(self._buf,0)[0]
+        offset = head % self._size
+        to_end = self._size - offset
+        if to_end < _LEN.size or _LEN.unpack_from(self._buf,ShmRing.header + offset)[0] == _WRAP:
+            head += to_end
+            offset = 0
+
+        start = ShmRing.header + offset
+        n = _LEN.unpack_from(self._buf,start)[0]
+        payload = bytes(self._buf[start + _LEN.size:start + _LEN.size + n])
+        _POS.pack_into(self._buf,0,head + _LEN.size + n)
+        return payload
+
+    def used(self):
+        ''' Bytes written but not yet read '''
+        return _POS.unpack_from(self._buf,8)[0] - _POS.unpack_from(self._buf,0)[0]
+
+    def close(self,unlink=False):
+        self._buf.release()
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+class QueueLogger():
+    ''' Logger stand-in for worker processes - messages go back to the main process Logger '''
+
+    def __init__(self,log_queue):
+        self._queue = log_queue
+
+    def log(self,msg,how='tfp'):
+        self._queue.put((msg,how))
+
+###############################################################################
+# Worker processes
+
+def _parse_worker(ring,out_queue,log_queue,symbols):
+    '''
+    Ring records: received perf_counter (double) + newline separated lines;
+    a record without lines stops the worker. Parsed bars leave as one tuple of
+    column lists (Bar.__slots__ order) per record.
+    '''
+    logger = QueueLogger(log_queue)
+    columns = tuple([] for _ in Bar.__slots__)
+
+    def to_columns(bar):
+        for column,name in zip(columns,Bar.__slots__):
+            column.append(getattr(bar,name))
+
+    handler = listener.MessageHandler(to_columns,logger,symbols)
+    try:
+        while True:
+            record = ring.get()
+            if len(record) == _RECEIVED.size:
+                break
+            received = _RECEIVED.unpack_from(record)[0]
+            lines = record[_RECEIVED.size:].decode().split('\n')
+            handler.handle_batches([(received,[line.split(',') for line in lines])])
+            if columns[0]:
+                out_queue.put(tuple(list(column) for column in columns))
+                for column in columns:
+                    column.clear()
+            metrics.pipeline.maybe_report(logger)
+            metrics.registry.maybe_report(logger)
+    finally:
+        ring.close()
+
+def _write_worker(in_queue,log_queue,batch_rows,flush_seconds,spool_path=None):
+    ''' Writes column batches until a None arrives - the DatabaseConnection lives in this process '''
+    logger = QueueLogger(log_queue)
+    db = postgres.database_connection(None,logger)
+    db.connect(start_thread=False)
+    if spool_path:
+        db.enable_spool(os.path.join(spool_path,'processes'))
+    try:
+        pending = []
+        deadline = None
+        while True:
+            timeout = flush_seconds if deadline is None else max(0.0,deadline - monotonic())
+            try:
+                columns = in_queue.get(timeout=timeout)
+            except queue.Empty:
+                columns = ()
+            if columns is None:
+                break
+            if columns:
+                pending.extend(Bar(*values) for values in zip(*columns))
+                deadline = deadline or monotonic() + flush_seconds
+            if pending and (len(pending) >= batch_rows or monotonic() >= deadline):
+                _write_pending(db,pending)
+                pending = []
+                deadline = None
+            db.service_spool()
+            metrics.registry.maybe_report(logger)
+        if pending:
+            _write_pending(db,pending)
+    finally:
+        db.disconnect()
+
+def _write_pending(db,pending):
+    # As dbpool.Writer._flush - a rejected bar must not take the batch (and the process) with it
+    try:
+        db.write_or_spool(pending)
+    except Exception as e:
+        db.recover_batch(pending,e)
+
+###############################################################################
+# Main process side
+
+class RawBarsConnection(connection.BarsConnection):
+    ''' BarsConnection that hands raw lines to a ProcessFeed instead of splitting them '''
+
+    def _queue_messages(self,lines):
+        self._msgqueue.put((self._received,lines))
+
+class ProcessFeed():
+    '''
+    Reader + parser worker processes + writer process, with the same calls as
+    a BarsConnection + Listener pair (see shards.ShardedFeed):
+    start_listening, connect, subscribe_to_symbols, disconnect, stop_listening
+
+    stop_listening drains the rings, stops the workers and then the writer,
+    so every bar read before disconnect() is committed.
+    '''
+
+    ring_bytes = 4 << 20
+    # Writer process restarts before giving up
+    writer_restarts = 3
+
+    def __init__(self,logger,symbols,config,workers=2,resume_from=None):
+        '''
+        resume_from = callable {symbol: (date, time)} (DatabaseConnection.latest_bars) -
+        where watches restart after a reconnect, as bars are parsed in the workers
+        '''
+        self._logger = logger
+        self._symbols = list(symbols)
+        self._workers = max(1,workers)
+        self._batch_rows = config['database'].getint('batch_rows',fallback=500)
+        self._flush_seconds = config['database'].getfloat('flush_seconds',fallback=0.5)
+        self._spool_path = None
+        if config.has_section('spool') and config['spool'].getboolean('enabled',fallback=True):
+            self._spool_path = config['spool'].get('path','spool/')
+
+        self._rings = [ShmRing(ProcessFeed.ring_bytes) for _ in range(self._workers)]
+        self._route = {}        # request ID -> worker
+        self._routed = [0] * self._workers
+        self._ring_waits = [0] * self._workers     # puts that found the ring full
+        self._queue_size = self._queue_batches(config)
+        self._bars_queue = mp.Queue(self._queue_size)
+        self._high_water = None
+        self._alerted = False
+        if self._queue_size:
+            self._high_water = max(1,int(self._queue_size * config['queues'].getfloat('high_water',fallback=0.8)))
+        self._log_queue = mp.Queue()
+
+        self._parsers = [mp.Process(target=_parse_worker,name=f'ParseWorker-{i}',
+                                    args=(ring,self._bars_queue,self._log_queue,self._symbols))
+                         for i,ring in enumerate(self._rings)]
+        self._writer = self._new_writer()
+        self._restarts = 0
+        self._stopping = False
+        self._log_thread = threading.Thread(target=self._forward_logs,name='WorkerLogThread',daemon=True)
+
+        self._resume_from = resume_from
+        self._conn = RawBarsConnection(self,logger,resume_from=resume_from and self._resume_points)
+        self._last_report = perf_counter()
+
+    @property
+    def listeners(self):
+        return []
+
+    ###########################################################################
+    # Starting and stopping
+
+    def start_listening(self):
+        self._log_thread.start()
+        self._writer.start()
+        for worker in self._parsers:
+            worker.start()
+        print(f'{self._workers} parser processes and 1 writer process started')
+
+    def stop_listening(self):
+        self._stopping = True
+        print('Waiting for parser processes to drain their rings')
+        for worker,ring in zip(self._parsers,self._rings):
+            try:
+                ring.put(_RECEIVED.pack(0.0),timeout=30)
+            except queue.Full:
+                print(f'ERROR! {worker.name} is not draining its ring')
+        for worker in self._parsers:
+            worker.join(30)
+        self._bars_queue.put(None)
+        self._writer.join(60)
+        for process in self._parsers + [self._writer]:
+            if process.is_alive():
+                print(f'ERROR! {process.name} still alive - terminating')
+                process.terminate()
+        self._log_queue.put(None)
+        self._log_thread.join(5)
+        for ring in self._rings:
+            ring.close(unlink=True)
+
+    def connect(self):
+        self._conn.connect()
+
+    def disconnect(self):
+        self._conn.disconnect()
+
+    def subscribe_to_symbols(self,config,latest=None):
+        self._conn.subscribe_to_symbols(self._symbols,config,latest)
+
+    def check_workers(self):
+        '''
+        Restart a writer process that died - bars it had not written are lost
+        unless spooled, the ones still in the queue are written by the new one.
+        Raises when a parser died or the writer died writer_restarts times
+        '''
+        if self._stopping:
+            return
+        for process in self._parsers:
+            if not process.is_alive():
+                raise RuntimeError(f'{process.name} exited (code {process.exitcode})')
+        if self._writer.is_alive():
+            return
+        if self._restarts >= ProcessFeed.writer_restarts:
+            raise RuntimeError(f'{self._writer.name} exited (code {self._writer.exitcode}) - '
+                               f'already restarted {self._restarts} times')
+        self._restarts += 1
+        self._logger.log(f'ERROR! {self._writer.name} exited (code {self._writer.exitcode}) - '
+                         f'restarting ({self._restarts}/{ProcessFeed.writer_restarts})',how='tfp')
+        self._writer = self._new_writer()
+        self._writer.start()
+
+    def _new_writer(self):
+        return mp.Process(  target=_write_worker,name='WriteWorker',
+                            args=(self._bars_queue,self._log_queue,self._batch_rows,self._flush_seconds,
+                                  self._spool_path))
+
+    ###########################################################################
+    # Reader thread -> rings
+
+    def put(self,item):
+        ''' Called by the reader thread with (receipt time, list of lines) '''
+        received, lines = item
+        per_worker = [[] for _ in self._rings]
+        for line in lines:
+            request_id = line[:line.find(',')]
+            worker = self._route.get(request_id)
+            if worker is None:
+                # Bars by request ID (one per symbol & interval), everything else to worker 0
+                worker = zlib.crc32(request_id.encode()) % self._workers if request_id[:1] == 'B' else 0
+                self._route[request_id] = worker
+            per_worker[worker].append(line)
+
+        stamp = _RECEIVED.pack(received)
+        for worker,worker_lines in enumerate(per_worker):
+            if worker_lines:
+                self._put_record(worker,stamp + '\n'.join(worker_lines).encode())
+                self._routed[worker] += len(worker_lines)
+
+    def _put_record(self,worker,record):
+        '''
+        Waits while the worker's ring is full - the socket is not read meanwhile
+        and TCP holds IQFeed back. A full ring is backpressure, not a socket error:
+        nothing here raises OSError, which would make the reader reconnect
+        '''
+        try:
+            self._rings[worker].put(record,timeout=0)
+            return
+        except queue.Full:
+            self._ring_waits[worker] += 1
+        while True:
+            try:
+                self._rings[worker].put(record,timeout=1)
+                return
+            except queue.Full:
+                if not self._parsers[worker].is_alive():
+                    raise RuntimeError(f'{self._parsers[worker].name} exited with its ring full')
+
+    def _resume_points(self,symbols):
+        # Called once qsize() drained - give the writer its flush deadline to commit the last batch
+        sleep(self._flush_seconds)
+        return self._resume_from(symbols)
+
+    def qsize(self):
+        ''' Records in the rings & batches waiting for the writer - drained before a reconnect asks where to resume '''
+        return sum(1 for ring in self._rings if ring.used()) + self._bars_queue.qsize()
+
+    def queue_depths(self):
+        ''' {worker: ring backlog in bytes} - metrics gauge '''
+        return {i: ring.used() for i,ring in enumerate(self._rings)}
+
+    def maybe_report(self,report_seconds=60):
+        ''' Check the worker processes & the bars queue, then log lines routed & ring backlog per worker once every report_seconds '''
+        self.check_workers()
+        self._check_high_water()
+        now = perf_counter()
+        if now - self._last_report < report_seconds:
+            return
+        self._last_report = now
+        for i,ring in enumerate(self._rings):
+            self._logger.log(f'Parse worker {i}: {self._routed[i]:,} lines routed, ring backlog {ring.used():,} bytes, '
+                             f'{self._ring_waits[i]:,} waits for room',how='f')
+
+    def _queue_batches(self,config):
+        ''' Column batches the bars queue holds - 0 (unbounded) without [queues] '''
+        if not config.has_section('queues'):
+            return 0
+        if config['queues'].get('db_policy','block') != 'block':
+            print('WARNING: processes mode only blocks - db_policy ignored')
+        return max(1,config['queues'].getint('db_size',fallback=100000) // self._batch_rows)
+
+    def _check_high_water(self):
+        if self._high_water is None:
+            return
+        depth = self._bars_queue.qsize()
+        if not self._alerted and depth >= self._high_water:
+            self._alerted = True
+            self._logger.log(f'WARNING: bars queue above high water mark: {depth:,}/{self._queue_size:,} batches',how='tfp')
+        elif self._alerted and depth <= self._high_water // 2:
+            self._alerted = False
+            self._logger.log(f'Bars queue back under high water mark: {depth:,}/{self._queue_size:,} batches',how='tfp')
+
+    def _forward_logs(self):
+        while True:
+            item = self._log_queue.get()
+            if item is None:
+                return
+            self._logger.log(*item)
@@ -1,50 +1,138 @@
 import requests
 import threading
+import queue
+import atexit
+from collections import OrderedDict
 from datetime import datetime
+from time import monotonic
+from requests.adapters import HTTPAdapter
 
 class Telegram_Bot():
     '''
     token: controls the bot
     chat: ID for recipient user or channel
+
+    Messages are sent from a background thread through one pooled Session,
+    at most `burst` at once and `per_minute` per minute. While the limit is
+    reached, identical messages are coalesced into one "(xN)" message.
     '''
 
     DEBUG = True
 
+    burst = 5
+    per_minute = 20
+    max_pending = 1000
+
     def __init__(self,token,chat):
-        self._base = f'https://api.telegram.org/bot{token}/sendMessage?chat_id={chat}&text='
+        self._url = f'https://api.telegram.org/bot{token}/sendMessage'
+        self._chat = chat
+
+        self._session = requests.Session()
+        self._session.mount('https://',HTTPAdapter(pool_connections=1,pool_maxsize=2,max_retries=2))
+
+        self._queue = queue.Queue(maxsize=Telegram_Bot.max_pending)
+        self._pending = OrderedDict()   # message -> number of times it was logged
+        self._tokens = Telegram_Bot.burst
+        self._refilled = monotonic()
+
+        self._stop = threading.Event()
+        self._sender_thread = threading.Thread(target=self,name='TelegramThread',daemon=True)
+        self._sender_thread.start()
 
     def send_message(self,msg):
         if msg is not None:
-            url = self._base + msg
-            self._get_url(url)
+            try:
+                self._queue.put_nowait(msg)
+            except queue.Full:
+                print('WARNING: Telegram queue full - message dropped:',msg)
 
     def wake_up(self):
         msg = 'Initializing IQFeed logger... Get that bread!'
-        url = self._base + msg
-        self._get_url(url)
-
-    def _get_url(self,url):
+        self.send_message(msg)
+
+    def close(self,timeout=10):
+        ''' Send what is queued (rate limit permitting) and stop the thread '''
+        self._stop.set()
+        self._sender_thread.join(timeout)
+
+    ###########################################################################
+    # Sender thread
+    def __call__(self):
+        while True:
+            wait = 1.0 if self._tokens >= 1 else self._seconds_to_token()
+            try:
+                self._add(self._queue.get(timeout=wait))
+                while True:
+                    self._add(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            self._refill()
+            while self._pending and self._tokens >= 1:
+                msg, count = self._pending.popitem(last=False)
+                self._tokens -= 1
+                self._get_url(msg if count == 1 else f'{msg} (x{count})')
+
+            if self._stop.is_set() and (self._queue.empty() and not self._pending or self._tokens < 1):
+                return
+
+    def _add(self,msg):
+        self._pending[msg] = self._pending.get(msg,0) + 1
+
+    def _refill(self):
+        now = monotonic()
+        rate = Telegram_Bot.per_minute / 60
+        self._tokens = min(Telegram_Bot.burst,self._tokens + (now - self._refilled) * rate)
+        self._refilled = now
+
+    def _seconds_to_token(self):
+        self._refill()
+        return max(0.05,(1 - self._tokens) * 60 / Telegram_Bot.per_minute)
+
+    def _get_url(self,msg):
         if not Telegram_Bot.DEBUG:
-            requests.get(url)
+            try:
+                self._session.get(self._url,params={'chat_id':self._chat,'text':msg},timeout=10)
+            except requests.RequestException as e:
+                print('ERROR sending Telegram message:',e)
 
 class Txt_Log():
-    ''' For logging to local .txt file '''
+    '''
+    For logging to local .txt file
+    The file stays open and is rotated when the date changes
+    '''
 
     def __init__(self,directory):
         self._directory = directory
+        self._date = None
+        self._file = None
 
-    def log_msg(self,msg):
-        dt = datetime.now()
+    def log_msg(self,msg,dt=None):
+        dt = dt or datetime.now()
         _date = dt.date().isoformat()
         _time = dt.time().isoformat(timespec='seconds')
 
+        if _date != self._date:
+            self._rotate(_date)
+
         prefix = f'{_date}  {_time}  '
+        self._file.write(f'{prefix}{msg}\n')
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
 
+    def _rotate(self,_date):
+        self.close()
         file = _date.replace('-','.') + '_Log'
         path = f'{self._directory}{file}.txt'
-        
-        with open(path,'a+') as f:
-            f.write(f'{prefix}{msg}\n')
+        self._file = open(path,'a+')
+        self._date = _date
 
 class Logger():
 
@@ -53,34 +141,81 @@ class Logger():
     t = telegram
     f = file
     p = print
+
+    log() only enqueues - printing, file writes and Telegram calls happen on
+    a background thread, so callers on the hot path never wait on I/O.
+    If the queue is full the message is dropped and counted.
     '''
     valid_how = ['t','f','p']
+    max_queued = 10000
 
     def __init__(self,botToken,botChat,directory):
         self._bot = Telegram_Bot(botToken,botChat)
         self._file = Txt_Log(directory)
         self._lock = threading.RLock()
 
+        self._queue = queue.Queue(maxsize=Logger.max_queued)
+        self._dropped = 0
+        self._stop = threading.Event()
+        self._log_thread = threading.Thread(target=self,name='LoggerThread',daemon=True)
+        self._log_thread.start()
+        atexit.register(self.close)
+
     def log(self,msg,how='tfp'):
-        
+
         assert msg, "Log received invalid message"
         assert (self._validate_how(how) == True), "Log received invalid method"
 
-        with self._lock:
-            if 'p' in how:
-                self._print_msg(msg)
-            if 'f' in how:
-                self._file.log_msg(msg)
-            if 't' in how:
-                self._bot.send_message(msg)
+        try:
+            self._queue.put_nowait((datetime.now(),msg,how))
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def close(self):
+        ''' Write out everything queued and stop the background threads '''
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._log_thread.join(30)
+        self._file.close()
+        self._bot.close()
 
     def _print_msg(self,msg):
         print('*************',msg)
 
     def wake_bot(self):
-        with self._lock:
-            self._bot.wake_up()
+        self._bot.wake_up()
 
     def _validate_how(self,how):
         letters = [char for char in how]
-        return all([ltr in Logger.valid_how for ltr in letters])
\ No newline at end of file
+        return all([ltr in Logger.valid_how for ltr in letters])
+
+    ###########################################################################
+    # Logging thread
+    def __call__(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                item = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                self._file.flush()
+                continue
+            self._write(*item)
+            self._report_dropped()
+
+    def _write(self,dt,msg,how):
+        try:
+            if 'p' in how:
+                self._print_msg(msg)
+            if 'f' in how:
+                self._file.log_msg(msg,dt)
+            if 't' in how:
+                self._bot.send_message(msg)
+        except Exception as e:
+            print('ERROR in logger thread:',e)
+
+    def _report_dropped(self):
+        with self._lock:
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            self._write(datetime.now(),f'WARNING: Logger queue full - {dropped} messages dropped','fp')
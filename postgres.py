@@ -4,19 +4,34 @@ import threading
 import psycopg2
 import queue
 import traceback
-from time import sleep
+import io
+import os
+from time import monotonic, perf_counter
+from psycopg2.extras import execute_batch, execute_values
+import metrics
+import pgbinary
+import spool
 
 class DatabaseConnection():
 
+    # Columns written for every bar - see bars.Bar.row()
+    bar_columns = ('symbol','date','time','open','high','low','close','volume','cumvol')
+    # Parameter types of the prepared insert (write_method = prepared)
+    bar_types = ('varchar','date','time','numeric','numeric','numeric','numeric','numeric','numeric')
+    # Unique key that makes catch-up writes idempotent
+    conflict_target = '(date,time)'
+
     def __init__(self,msg_queue,logger):
 
         self._settings = {}
         self._symbols = []
-        self._tables = []
+        self._tables = set()        # storage keys with a table (hashed - checked for every bar)
         self._logger = logger
 
         self._queue = msg_queue
         self._stop = threading.Event()
+        # Set by disconnect() - a batch waiting for the database to come back is given up
+        self._closing = threading.Event()
         self._database_thread = threading.Thread(target=self,name='DatabaseThread')
 
         self._cursor_lock = threading.RLock()
@@ -24,6 +39,21 @@ class DatabaseConnection():
         self._conn = None
         self._cursor = None
 
+        # Per-table statement handles for the binary & prepared write paths -
+        # built on first write (or table creation) and kept for the session
+        self._statements = {}
+
+        # Micro-batch of bars pulled from the queue but not yet committed
+        self._pending = []
+        self._deadline = None
+        self._rows_written = 0
+        self._batches_written = 0
+
+        # Outage / backlog spool (see enable_spool)
+        self._spool = None
+        self._db_down = False
+        self._retry_at = 0.0
+
         self._load_settings()
         assert (len(self._symbols) > 0), 'Database class failed to pull symbols from config!'
 
@@ -33,21 +63,40 @@ class DatabaseConnection():
     # Target for thread
     def __call__(self):
         while not self._stop.is_set():
-            self._pull_queue()
-
-    def connect(self):
-        self._conn = psycopg2.connect(  database=self._settings['name'],
-                                        user=self._settings['user'],
-                                        password=self._settings['pass'],
-                                        host=self._settings['host'],
-                                        port=self._settings['port'])
+            try:
+                self._pull_queue()
+                self.service_spool(self._queue.qsize())
+            except Exception as e:
+                # Keep consuming - a dead thread would stall every producer on the queue
+                self._logger.log(f'ERROR! Database thread: {e}',how='tfp')
+                print(traceback.format_exc())
+
+    def connect(self,start_thread=True,conn=None,check_tables=True):
+        '''
+        start_thread=False leaves the queue consumer off - bars are then written
+        by calling write_bars() directly (used by the asyncio runtime)
+        conn = open connection to use instead of a new one (e.g. from a pool, see dbpool.py)
+        check_tables=False only reads the tables - another connection has checked them
+        '''
+        self._conn = conn or psycopg2.connect(**self.connect_args())
         self._cursor = self._conn.cursor()
         assert self._conn is not None
         assert self._cursor is not None
         print('Connected to database')
 
-        self._map_symbols_and_tables()
-        self._start_db_thread()
+        self._map_symbols_and_tables(check_tables)
+        if start_thread:
+            if self._settings['spool']:
+                self.enable_spool(os.path.join(self._settings['spool_path'],'db'))
+            self._start_db_thread()
+
+    def connect_args(self):
+        ''' psycopg2.connect keyword arguments '''
+        return {'database': self._settings['name'],
+                'user': self._settings['user'],
+                'password': self._settings['pass'],
+                'host': self._settings['host'],
+                'port': self._settings['port']}
 
     def _start_db_thread(self):
         self._stop.clear()
@@ -56,16 +105,19 @@ class DatabaseConnection():
             print('Database thread alive')
 
     def disconnect(self):
-        print('Waiting for database queue to clear')
-        self._queue.join()
+        self.cancel_retries()
+        if self._queue is not None:
+            print('Waiting for database queue to clear')
+            self._queue.join()
         print('Closing database connection and killing thread')
         self._stop.set()
-        self._cursor.close()
-        self._conn.close()
         if self._database_thread.is_alive():
             self._database_thread.join()
         if self._database_thread.is_alive():
             print('WARNING: Database thread may still be alive!')
+        self.close_spool()
+        self._cursor.close()
+        self._conn.close()
 
     def _load_settings(self):
         config = configparser.ConfigParser()
@@ -80,12 +132,41 @@ class DatabaseConnection():
         self._settings['host'] = config['database']['db_host']
         self._settings['port'] = config['database']['db_port']
 
+        # Batch writer: flush when batch_rows bars are pending or flush_seconds
+        # after the first pending bar arrived, whichever comes first
+        self._settings['batch_rows'] = config['database'].getint('batch_rows',fallback=500)
+        self._settings['flush_seconds'] = config['database'].getfloat('flush_seconds',fallback=0.5)
+        # copy (text COPY), binary (COPY FORMAT binary), prepared (server-side
+        # prepared INSERT) or values (execute_values)
+        self._settings['write_method'] = config['database'].get('write_method',fallback='copy')
+
+        # Catch-up mode: tables get a unique (date,time) index and writes skip
+        # bars that are already stored, so replays after a restart are idempotent
+        self._settings['upsert'] = config['market'].getboolean('catchup',fallback=False)
+
+        # Partitioned schema only: use a TimescaleDB hypertable when the extension is installed
+        self._settings['timescale'] = config['database'].getboolean('timescale',fallback=True)
+
+        # Live bars go to a local spool while the database is down or behind (spool.py)
+        spool_config = config['spool'] if config.has_section('spool') else {}
+        self._settings['spool'] = config.has_section('spool') and config['spool'].getboolean('enabled',fallback=True)
+        self._settings['spool_path'] = spool_config.get('path','spool/')
+        self._settings['spool_segment'] = int(spool_config.get('segment_mb',64)) << 20
+        self._settings['spool_backlog'] = int(spool_config.get('backlog',50000))
+        self._settings['replay_rows'] = int(spool_config.get('replay_rows',50000))
+        self._settings['retry_seconds'] = float(spool_config.get('retry_seconds',5))
+
+        # Bars of other intervals (resample.py) are stored apart from the base interval
+        self._settings['interval'] = config['market'].getint('interval_seconds')
+
         symbols = config['market']['symbols']
         self._symbols = symbols.split(',')
 
-    def _map_symbols_and_tables(self):
-        self._tables = self._get_tables()
+    def _map_symbols_and_tables(self,check=True):
+        self._tables = set(self._get_tables())
         assert (len(self._tables) > 0), 'Database class failed to pull tables from database!'
+        if not check:
+            return
         
         missing_symbols = []
         for symbol in self._symbols:
@@ -97,42 +178,482 @@ class DatabaseConnection():
         except AssertionError:
             self._logger.log(f"WARNING! Not all tracked symbols are in database! Missing: {missing_symbols}",how='pft')
             for m_symbol in missing_symbols:
-                self._create_table(m_symbol)
+                self.ensure_table(m_symbol)
         else:
             self._logger.log('All tracked symbols are in database',how='tpf')
 
+        if self._settings['upsert']:
+            for symbol in self._symbols:
+                if symbol in self._tables:
+                    self._ensure_unique_index(symbol)
+
+    def ensure_table(self,symbol,interval=None):
+        ''' Create the table for the symbol's bars of interval (None = base interval) if it does not exist yet '''
+        target = self._target_for(symbol,interval)
+        if target not in self._tables:
+            # Another connection (see dbpool.py) may have created it since the tables were read
+            self._tables = set(self._get_tables())
+        if target not in self._tables:
+            if self._create_table(target):
+                self._tables.add(target)
+                if self._settings['upsert']:
+                    self._ensure_unique_index(target)
+        elif self._settings['upsert'] and target not in self._symbols:
+            self._ensure_unique_index(target)
+
+    def latest_bars(self,symbols):
+        ''' {symbol: (date, time)} of the newest stored bar - symbols without bars are left out '''
+        latest = {}
+        with self._cursor_lock:
+            for symbol in symbols:
+                if symbol not in self._tables:
+                    continue
+                self._cursor.execute(f"select date,time from {symbol.lower()} order by date desc,time desc limit 1")
+                row = self._cursor.fetchone()
+                if row is not None:
+                    latest[symbol] = row
+            self._conn.commit()
+        return latest
+
     ###########################################################################
     # Processing bars & database calls
     def _pull_queue(self):
-        ''' Keep pulling so long as items are in queue - sleep if queue is empty '''
-        data = None
+        '''
+        Block until a bar arrives, then drain everything already waiting into the
+        micro-batch - write it once it holds batch_rows bars or its flush deadline
+        has passed
+        '''
+        if self._deadline is None:
+            timeout = self._settings['flush_seconds']
+        else:
+            timeout = max(0,self._deadline - monotonic())
+
         try:
-            data = self._queue.get(block=False)
-            self._process_data(data)
-            self._queue.task_done()
+            data = self._queue.get(timeout=timeout)
         except queue.Empty:
-            sleep(1)
+            pass
+        else:
+            if not self._pending:
+                self._deadline = monotonic() + self._settings['flush_seconds']
+            self._pending.append(data)
+            while len(self._pending) < self._settings['batch_rows']:
+                try:
+                    self._pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+        if self._pending:
+            if (len(self._pending) >= self._settings['batch_rows']) or (monotonic() >= self._deadline):
+                self._flush()
+
+    def _flush(self):
+        batch = self._pending
+        self._pending = []
+        self._deadline = None
+
+        try:
+            self.write_or_spool(batch,self._queue.qsize())
+        except Exception as e:
+            self.recover_batch(batch,e)
+        finally:
+            # Only mark bars done once committed (or given up) so that disconnect() waits for them
+            for _ in batch:
+                self._queue.task_done()
+
+    def recover_batch(self,bars,e):
+        '''
+        bars = a batch write_or_spool raised on (e) - neither written nor spooled
+        A lost connection (no spool) is retried every retry_seconds until the
+        database is back or disconnect() is called - the queue backs up
+        meanwhile. Any other error is retried bar by bar, so only the bars the
+        database rejects are dropped (and logged).
+        '''
+        if isinstance(e,(psycopg2.OperationalError,psycopg2.InterfaceError)):
+            self._database_down(e)
+            while not self._closing.is_set():
+                if self._reconnect():
+                    try:
+                        self.write_bars(bars)
+                        return
+                    except (psycopg2.OperationalError,psycopg2.InterfaceError) as e:
+                        self._database_down(e)
+                self._closing.wait(self._settings['retry_seconds'])
+            self._logger.log(f'ERROR! {len(bars)} bars not written - database unavailable at shutdown',how='tfp')
+            return
+        self._write_each(bars,e)
 
-    def _process_data(self,data):
-        if data:
-            if data.symbol in self._tables:
-                self._insert_record(data)
+    def cancel_retries(self):
+        ''' Stop waiting for the database to come back (recover_batch) '''
+        self._closing.set()
+
+    def _write_each(self,bars,e):
+        self._logger.log(f'ERROR! Batch of {len(bars)} bars failed ({e}) - retrying bar by bar',how='tfp')
+        rejected = 0
+        for bar in bars:
+            try:
+                self.write_bars([bar])
+            except (psycopg2.OperationalError,psycopg2.InterfaceError):
+                raise
+            except Exception as e:
+                rejected += 1
+                self._logger.log(f'Bar rejected by the database: {bar} ({e})',how='f')
+        if rejected:
+            self._logger.log(f'ERROR! {rejected} of {len(bars)} bars rejected by the database (see log file)',how='tfp')
+
+    def write_bars(self,bars):
+        ''' Write bars in one transaction, grouped by target table - returns rows written '''
+        groups = self._group_by_table(bars)
+        rows = sum(len(group) for group in groups.values())
+        if rows == 0:
+            return 0
+
+        started = perf_counter()
+        self._write_batch(groups)
+        committed = perf_counter()
+        elapsed = committed - started
+
+        self._rows_written += rows
+        self._batches_written += 1
+        metrics.db_rows.inc(rows)
+        metrics.db_batch_seconds.observe(elapsed)
+        rate = rows / elapsed if elapsed > 0 else float('inf')
+        msg = f'DB batch: {rows} rows / {len(groups)} tables in {elapsed*1000:.1f} ms ({rate:,.0f} rows/sec)'
+        self._logger.log(msg,how='f')
+        self._record_latency(groups,committed)
+        return rows
+
+    ###########################################################################
+    # Spool - durable local log while the database is down or behind
+
+    def enable_spool(self,directory):
+        ''' Spool bars to directory when writes fail or the backlog passes [spool] backlog '''
+        self._spool = spool.BarSpool(directory,self._settings['spool_segment'])
+        if self._spool.pending():
+            self._logger.log(f'{self._spool.pending():,} bars spooled by an earlier run will be replayed',how='tfp')
+
+    def close_spool(self):
+        ''' Replay what the database will take, leave the rest on disk for the next run '''
+        if self._spool is None:
+            return
+        while self._spool.pending() and not self._db_down:
+            self.service_spool(0)
+        if self._spool.pending():
+            self._logger.log(f'{self._spool.pending():,} bars left in the spool for the next run',how='tfp')
+        self._spool.close()
+        self._spool = None
+
+    def write_or_spool(self,bars,backlog=0):
+        '''
+        Live write path: bars go to the spool while the database is down, while
+        backlog (bars queued behind these) is above [spool] backlog, or while
+        older bars are still spooled (keeps each symbol in order) - else to the database
+        '''
+        if self._spool is None:
+            return self.write_bars(bars)
+        if self._db_down or self._spool.pending() or backlog > self._settings['spool_backlog']:
+            self._spool.append(bars)
+            return 0
+        try:
+            return self.write_bars(bars)
+        except (psycopg2.OperationalError,psycopg2.InterfaceError) as e:
+            self._database_down(e)
+            self._spool.append(bars)
+            return 0
+
+    def service_spool(self,backlog=0):
+        ''' Reconnect after an outage, then replay spooled bars in replay_rows batches once the backlog is gone '''
+        if self._spool is None or not self._spool.pending():
+            return
+        if self._db_down and not self._reconnect():
+            return
+        if backlog > self._settings['spool_backlog']:
+            return
+
+        bars = self._spool.read(self._settings['replay_rows'])
+        try:
+            self.write_bars(bars)
+        except (psycopg2.OperationalError,psycopg2.InterfaceError) as e:
+            self._database_down(e)
+            return
+        except Exception as e:
+            # A bar the database rejects must not block the spool forever
+            try:
+                self._write_each(bars,e)
+            except (psycopg2.OperationalError,psycopg2.InterfaceError) as e:
+                self._database_down(e)
+                return
+        self._spool.commit()
+        if not self._spool.pending():
+            self._logger.log('Spool replayed - writing live bars to the database again',how='tfp')
+
+    def _database_down(self,e):
+        if not self._db_down:
+            if self._spool is not None:
+                self._logger.log(f'Database unavailable - spooling bars locally: {e}',how='tfp')
             else:
-                self._logger.log(f'WARNING: Received unregistered symbol (table not found): {data.symbol} - {data.date} {data.time}',how='fp')
+                self._logger.log(f"Database unavailable - retrying every {self._settings['retry_seconds']} s: {e}",how='tfp')
+        self._db_down = True
+        self._retry_at = monotonic() + self._settings['retry_seconds']
 
-    def _insert_record(self,data):
-        vals = f"'{data.symbol}','{data.date}','{data.time}','{data.open}','{data.high}','{data.low}','{data.close}','{data.volume}','{data.cumvol}'"
-        table_name = data.symbol.lower()
-        instruction = f"insert into {table_name} (symbol,date,time,open,high,low,close,volume,cumvol) values ({vals});"
+    def _reconnect(self):
+        if monotonic() < self._retry_at:
+            return False
         with self._cursor_lock:
             try:
-                self._cursor.execute(instruction)
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            try:
+                self._conn = psycopg2.connect(**self.connect_args())
+                self._cursor = self._conn.cursor()
+                # Prepared statements belong to the old session
+                self._statements = {}
+            except psycopg2.OperationalError:
+                self._retry_at = monotonic() + self._settings['retry_seconds']
+                return False
+        self._db_down = False
+        if self._spool is not None:
+            self._logger.log(f'Database reconnected - replaying {self._spool.pending():,} spooled bars',how='tfp')
+        else:
+            self._logger.log('Database reconnected',how='tfp')
+        return True
+
+    def write_frame(self,symbol,df,interval=None):
+        '''
+        COPY a DataFrame of bars (date,time,open,high,low,close,volume,cumvol
+        columns) into the symbol's table for interval in one transaction - returns rows written
+        '''
+        if df is None or len(df) == 0:
+            return 0
+
+        table_name = self._table_for(self._target_for(symbol,interval))
+        buff = self._frame_buffer(symbol,table_name,df)
+
+        started = perf_counter()
+        with self._cursor_lock:
+            try:
+                self._copy_into(table_name,buff)
+                self._conn.commit()
+            except Exception as e:
+                self._conn.rollback()
+                self._logger.log(f'Database COPY error for {symbol}!',how='tfp')
+                print(e)
+                raise
+        elapsed = perf_counter() - started
+
+        self._rows_written += len(df)
+        self._batches_written += 1
+        rate = len(df) / elapsed if elapsed > 0 else float('inf')
+        self._logger.log(f'DB frame: {len(df)} rows -> {table_name} in {elapsed*1000:.1f} ms ({rate:,.0f} rows/sec)',how='f')
+        return len(df)
+
+    def export_query(self,symbol,interval=None,since=None):
+        '''
+        SQL selecting the symbol's stored bars of interval as ts,open,high,low,
+        close,volume,cumvol in time order - from date since (YYYY-MM-DD) on if given
+        '''
+        table_name = self._table_for(self._target_for(symbol,interval))
+        where = self._cursor.mogrify(" where date >= %s",(since,)).decode() if since else ''
+        return (f"select date + time,open::float8,high::float8,low::float8,close::float8,"
+                f"volume::bigint,cumvol::bigint from {table_name}{where} order by date,time")
+
+    def copy_out(self,query,f):
+        ''' COPY the rows of query TO STDOUT (tab separated text) into file object f '''
+        with self._cursor_lock:
+            try:
+                self._cursor.copy_expert(f"copy ({query}) to stdout",f)
                 self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def _record_latency(self,groups,committed):
+        timed = [bar for bars in groups.values() for bar in bars if bar.received is not None]
+        if timed:
+            metrics.pipeline.record('get_to_commit',[committed - bar.dequeued for bar in timed])
+            metrics.pipeline.record('socket_to_commit',[committed - bar.received for bar in timed])
+        metrics.pipeline.maybe_report(self._logger)
+
+    def _group_by_table(self,batch):
+        groups = {}
+        for data in batch:
+            if not data:
+                continue
+            target = self._target_for(data.symbol,data.interval)
+            if target in self._tables:
+                groups.setdefault(self._table_for(target),[]).append(data)
+            else:
+                self._logger.log(f'WARNING: Received unregistered symbol (table not found): {target} - {data.date} {data.time}',how='fp')
+        return groups
+
+    def _write_batch(self,groups):
+        with self._cursor_lock:
+            try:
+                self._write_groups(groups,self._settings['write_method'])
+            except (psycopg2.OperationalError,psycopg2.InterfaceError):
+                # Connection lost - not a reason to give up on COPY
+                try:
+                    self._conn.rollback()
+                except psycopg2.Error:
+                    pass
+                raise
+            except psycopg2.NotSupportedError as e:
+                self._conn.rollback()
+                if self._settings['write_method'] not in ('copy','binary'):
+                    self._logger.log('Database insertion error!',how='tfp')
+                    print(e)
+                    raise
+                # COPY unavailable (e.g. behind a pooler) - retry batch with execute_values
+                self._logger.log(f'COPY not supported, falling back to execute_values: {e}',how='tfp')
+                self._settings['write_method'] = 'values'
+                try:
+                    self._write_groups(groups,'values')
+                except Exception as e:
+                    self._conn.rollback()
+                    self._logger.log('Database insertion error!',how='tfp')
+                    print(e)
+                    raise
             except Exception as e:
+                # Bad rows (constraint, data errors) - recover_batch isolates them
+                self._conn.rollback()
                 self._logger.log('Database insertion error!',how='tfp')
                 print(e)
                 raise
 
+    def _write_groups(self,groups,method):
+        for table_name, bars in groups.items():
+            if method == 'copy':
+                self._copy_rows(table_name,bars)
+            elif method == 'binary':
+                self._copy_binary(table_name,bars)
+            elif method == 'prepared':
+                self._insert_prepared(table_name,bars)
+            else:
+                self._insert_values(table_name,bars)
+        self._conn.commit()
+
+    def _copy_rows(self,table_name,bars):
+        buff = io.StringIO()
+        buff.writelines(self._text_rows(bars))
+        buff.seek(0)
+        self._copy_into(table_name,buff)
+
+    def _copy_into(self,table_name,buff):
+        ''' COPY tab separated rows into table_name - via a staging table when upserting '''
+        cols = ','.join(self.bar_columns)
+        if not self._settings['upsert']:
+            self._cursor.copy_expert(f"copy {table_name} ({cols}) from stdin",buff)
+            return
+
+        # COPY has no ON CONFLICT - stage the rows, then insert what is new
+        self._cursor.execute(self._stage_ddl())
+        self._cursor.copy_expert(f"copy bar_stage ({cols}) from stdin",buff)
+        self._cursor.execute(f"insert into {table_name} ({cols}) select {cols} from bar_stage on conflict {self.conflict_target} do nothing;")
+        self._cursor.execute("truncate bar_stage;")
+
+    def _copy_binary(self,table_name,bars):
+        ''' COPY FORMAT binary - rows encoded by pgbinary, nothing parsed from text server side '''
+        handle = self._statement(table_name,'binary')
+        buff = io.BytesIO(self._binary_rows(bars))
+        if not self._settings['upsert']:
+            self._cursor.copy_expert(handle['copy'],buff)
+            return
+        self._cursor.execute(self._stage_ddl())
+        self._cursor.copy_expert(handle['stage'],buff)
+        self._cursor.execute(handle['merge'])
+        self._cursor.execute("truncate bar_stage;")
+
+    def _insert_prepared(self,table_name,bars):
+        ''' EXECUTE the table's prepared INSERT, many rows per round trip '''
+        handle = self._statement(table_name,'prepared')
+        execute_batch(self._cursor,handle['execute'],self._value_rows(bars),page_size=len(bars))
+
+    def _statement(self,table_name,method):
+        ''' Cached handle of table_name for method - built (and PREPAREd) once per session '''
+        handle = self._statements.get((table_name,method))
+        if handle is None:
+            handle = self._build_statement(table_name,method)
+            self._statements[(table_name,method)] = handle
+        return handle
+
+    def _build_statement(self,table_name,method):
+        cols = ','.join(self.bar_columns)
+        conflict = f" on conflict {self.conflict_target} do nothing" if self._settings['upsert'] else ''
+        if method == 'binary':
+            return {'copy': f"copy {table_name} ({cols}) from stdin with (format binary)",
+                    'stage': f"copy bar_stage ({cols}) from stdin with (format binary)",
+                    'merge': f"insert into {table_name} ({cols}) select {cols} from bar_stage{conflict};"}
+        name = f'insert_{table_name}'
+        params = ','.join(f'${i + 1}' for i in range(len(self.bar_columns)))
+        # A pooled connection (dbpool.py) may have prepared it in an earlier life
+        self._cursor.execute("select 1 from pg_prepared_statements where name = %s",(name,))
+        if self._cursor.fetchone() is None:
+            self._cursor.execute(f"prepare {name} ({','.join(self.bar_types)}) as "
+                                 f"insert into {table_name} ({cols}) values ({params}){conflict};")
+        return {'execute': f"execute {name} ({','.join(['%s'] * len(self.bar_columns))})"}
+
+    def _rebuild_statements(self,table_name):
+        ''' New table: replace its handles for the configured write method (a failure leaves it to the first write) '''
+        with self._cursor_lock:
+            try:
+                for method in ('binary','prepared'):
+                    if self._statements.pop((table_name,method),None) is not None and method == 'prepared':
+                        self._cursor.execute(f"deallocate insert_{table_name};")
+                if self._settings['write_method'] in ('binary','prepared'):
+                    self._statement(table_name,self._settings['write_method'])
+                self._conn.commit()
+            except Exception as e:
+                self._conn.rollback()
+                self._logger.log(f'WARNING: could not prepare writes to {table_name}: {e}',how='fp')
+
+    def _insert_values(self,table_name,bars):
+        cols = ','.join(self.bar_columns)
+        instruction = f"insert into {table_name} ({cols}) values %s"
+        if self._settings['upsert']:
+            instruction += f" on conflict {self.conflict_target} do nothing"
+        execute_values(self._cursor,instruction,self._value_rows(bars),page_size=len(bars))
+
+    ###########################################################################
+    # Schema specifics - one table per symbol (see PartitionedDatabaseConnection)
+
+    def _target_for(self,symbol,interval):
+        ''' Storage key: 'SPY' for the base interval, 'SPY_300' for derived 5 minute bars '''
+        if interval is None or interval == self._settings['interval']:
+            return symbol
+        return f'{symbol}_{interval}'
+
+    def _table_for(self,target):
+        return target.lower()
+
+    def _text_rows(self,bars):
+        return ['%s\t%s\t%s\t%r\t%r\t%r\t%r\t%d\t%d\n' % bar.row() for bar in bars]
+
+    def _value_rows(self,bars):
+        return [bar.row() for bar in bars]
+
+    def _binary_rows(self,bars):
+        return pgbinary.symbol_rows(bars)
+
+    def _frame_buffer(self,symbol,table_name,df):
+        buff = io.StringIO()
+        df.assign(symbol=symbol).to_csv(buff,sep='\t',header=False,index=False,
+                                        columns=list(self.bar_columns))
+        buff.seek(0)
+        return buff
+
+    def _stage_ddl(self):
+        return """create temp table if not exists bar_stage (
+                                symbol VARCHAR(10),
+                                date DATE,
+                                time TIME(0) WITHOUT TIME ZONE,
+                                open NUMERIC,
+                                high NUMERIC,
+                                low NUMERIC,
+                                close NUMERIC,
+                                volume NUMERIC,
+                                cumvol NUMERIC
+                                ) on commit delete rows;"""
+
     def _get_tables(self):
         results = None
 
@@ -168,9 +689,283 @@ class DatabaseConnection():
                 self._cursor.execute(instruction)
                 self._conn.commit()
             except Exception as e:
+                self._conn.rollback()
                 msg = f'ERROR! Failure to create table for symbol {symbol}!'
                 self._logger.log(msg,how='tpf')
                 print(traceback.format_exc())
+                return False
             else:
+                self._rebuild_statements(name)
                 msg = f'Successfully created table for {symbol}'
-                self._logger.log(msg,how='tpf')
\ No newline at end of file
+                self._logger.log(msg,how='tpf')
+                return True
+
+    def _ensure_unique_index(self,symbol):
+        '''
+        Unique (date,time) index backing ON CONFLICT DO NOTHING (and the latest bar lookup)
+        Tables holding duplicate bars are left alone - dedupe_table (migrate_bars.py --dedupe) removes them
+        '''
+        name = symbol.lower()
+        index = f'{name}_date_time_idx'
+        with self._cursor_lock:
+            try:
+                self._cursor.execute("select 1 from pg_indexes where tablename = %s and indexname = %s",(name,index))
+                if self._cursor.fetchone() is not None:
+                    self._conn.commit()
+                    return
+                duplicates = self._count_duplicates(name)
+                if not duplicates:
+                    self._cursor.execute(f"create unique index {index} on {name} (date,time);")
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                msg = f'ERROR! Failure to index table for symbol {symbol}!'
+                self._logger.log(msg,how='tpf')
+                print(traceback.format_exc())
+                raise
+        if duplicates:
+            msg = (f'ERROR! {name} holds {duplicates} duplicate bars - catch-up needs a unique (date,time) index: '
+                   f'run python migrate_bars.py --dedupe --symbols {symbol} or set catchup = false')
+            self._logger.log(msg,how='tpf')
+            raise Exception(msg)
+        self._logger.log(f'Created (date,time) index for {symbol}',how='tpf')
+
+    def dedupe_table(self,table_name):
+        '''
+        Delete duplicate (date,time) bars of a per-symbol table, keeping the
+        oldest row, and add the unique index - returns (rows before, rows deleted)
+        '''
+        index = f'{table_name}_date_time_idx'
+        with self._cursor_lock:
+            try:
+                self._cursor.execute(f"select count(*) from {table_name};")
+                rows = self._cursor.fetchone()[0]
+                self._cursor.execute(f"delete from {table_name} a using {table_name} b "
+                                     f"where a.id > b.id and a.date = b.date and a.time = b.time;")
+                removed = self._cursor.rowcount
+                self._cursor.execute(f"create unique index if not exists {index} on {table_name} (date,time);")
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        return rows, removed
+
+    def _count_duplicates(self,table_name):
+        # Caller holds _cursor_lock
+        self._cursor.execute(f"select coalesce(sum(n - 1),0) from (select count(*) n from {table_name} "
+                             f"group by date,time having count(*) > 1) d;")
+        return int(self._cursor.fetchone()[0])
+
+class PartitionedDatabaseConnection(DatabaseConnection):
+    '''
+    All symbols in one `bars` table keyed by (symbol, ts), range partitioned by
+    month on ts with a BRIN index on ts - or a TimescaleDB hypertable when the
+    extension is available. Selected with [database] schema = partitioned
+    Derived intervals get their own table of the same layout (bars_300s, ...)
+    '''
+
+    bar_columns = ('symbol','ts','open','high','low','close','volume','cumvol')
+    bar_types = ('varchar','timestamp','float8','float8','float8','float8','int8','int8')
+    conflict_target = '(symbol,ts)'
+
+    # Partition DDL from several connections in this process (dbpool.py) is serialized
+    _ddl_lock = threading.Lock()
+
+    def __init__(self,msg_queue,logger):
+        super().__init__(msg_queue,logger)
+        self._partitions = {}       # table -> set of 'YYYY-MM' months known to have a partition
+        self._hypertable = {}       # table -> True if a TimescaleDB hypertable
+
+    def _map_symbols_and_tables(self,check=True):
+        self._create_bars_table('bars')
+        # _tables holds the storage keys accepted for writing - all base bars share `bars`
+        self._tables = set(self._symbols)
+        if check:
+            self._logger.log(f"Storing bars in partitioned table 'bars'{' (hypertable)' if self._hypertable['bars'] else ''}",how='pf')
+
+    def ensure_table(self,symbol,interval=None):
+        target = self._target_for(symbol,interval)
+        table_name = self._table_for(target)
+        if table_name not in self._hypertable:
+            self._create_bars_table(table_name)
+        if target not in self._tables:
+            self._tables.add(target)
+
+    def latest_bars(self,symbols):
+        latest = {}
+        with self._cursor_lock:
+            for symbol in symbols:
+                self._cursor.execute("select max(ts) from bars where symbol = %s",(symbol,))
+                row = self._cursor.fetchone()
+                if row is not None and row[0] is not None:
+                    latest[symbol] = (row[0].date(),row[0].time())
+            self._conn.commit()
+        return latest
+
+    def migration_target(self,table_name):
+        ''' Table a per-symbol table migrates into: spy -> bars, spy_300 -> bars_300s (created if missing) '''
+        target = self._table_for(table_name)
+        if target not in self._hypertable:
+            self._create_bars_table(target)
+        return target
+
+    def migrate_table(self,table_name):
+        ''' Move one per-symbol table into its bars table server side - returns (rows in table, rows inserted) '''
+        target = self.migration_target(table_name)
+        with self._cursor_lock:
+            try:
+                self._cursor.execute(f"select min(date),max(date),count(*) from {table_name}")
+                first, last, count = self._cursor.fetchone()
+                self._conn.commit()
+                if count == 0:
+                    return 0, 0
+                self._ensure_partitions(target,_months_between(first,last))
+                self._cursor.execute(f"""insert into {target} (symbol,ts,open,high,low,close,volume,cumvol)
+                                         select symbol,date + time,open,high,low,close,volume,cumvol
+                                         from {table_name}
+                                         on conflict (symbol,ts) do nothing;""")
+                inserted = self._cursor.rowcount
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        return count, inserted
+
+    def export_query(self,symbol,interval=None,since=None):
+        table_name = self._table_for(self._target_for(symbol,interval))
+        where = self._cursor.mogrify(" where symbol = %s",(symbol,)).decode()
+        if since:
+            where += self._cursor.mogrify(" and ts >= %s",(since,)).decode()
+        return f"select ts,open,high,low,close,volume,cumvol from {table_name}{where} order by ts"
+
+    ###########################################################################
+    # Schema specifics
+
+    def _table_for(self,target):
+        symbol, _, interval = target.rpartition('_')
+        return f'bars_{interval}s' if symbol and interval.isdigit() else 'bars'
+
+    def _text_rows(self,bars):
+        return ['%s\t%s %s\t%r\t%r\t%r\t%r\t%d\t%d\n' % bar.row() for bar in bars]
+
+    def _value_rows(self,bars):
+        return [(b.symbol,f'{b.date} {b.time}',b.open,b.high,b.low,b.close,b.volume,b.cumvol) for b in bars]
+
+    def _binary_rows(self,bars):
+        return pgbinary.partitioned_rows(bars)
+
+    def _frame_buffer(self,symbol,table_name,df):
+        self._ensure_partitions(table_name,{d[:7] for d in df['date'].unique()})
+        buff = io.StringIO()
+        df.assign(symbol=symbol,ts=df['date'] + ' ' + df['time']).to_csv(
+                        buff,sep='\t',header=False,index=False,columns=list(self.bar_columns))
+        buff.seek(0)
+        return buff
+
+    def _stage_ddl(self):
+        return """create temp table if not exists bar_stage (
+                                symbol VARCHAR(10),
+                                ts TIMESTAMP(0) WITHOUT TIME ZONE,
+                                open DOUBLE PRECISION,
+                                high DOUBLE PRECISION,
+                                low DOUBLE PRECISION,
+                                close DOUBLE PRECISION,
+                                volume BIGINT,
+                                cumvol BIGINT
+                                ) on commit delete rows;"""
+
+    def _write_batch(self,groups):
+        for table_name, group in groups.items():
+            self._ensure_partitions(table_name,{bar.date[:7] for bar in group})
+        super()._write_batch(groups)
+
+    ###########################################################################
+    # Table & partition management
+
+    def _create_bars_table(self,table_name):
+        columns = """   symbol VARCHAR(10) NOT NULL,
+                        ts TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+                        open DOUBLE PRECISION NOT NULL,
+                        high DOUBLE PRECISION NOT NULL,
+                        low DOUBLE PRECISION NOT NULL,
+                        close DOUBLE PRECISION NOT NULL,
+                        volume BIGINT NOT NULL,
+                        cumvol BIGINT NOT NULL,
+                        PRIMARY KEY (symbol,ts)"""
+        with self._cursor_lock:
+            try:
+                self._cursor.execute("select relkind from pg_class where relname = %s",(table_name,))
+                row = self._cursor.fetchone()
+                if row is None:
+                    if self._settings['timescale'] and self._timescale_available():
+                        self._cursor.execute("create extension if not exists timescaledb;")
+                        self._cursor.execute(f"create table {table_name} ({columns});")
+                        self._cursor.execute("""select create_hypertable(%s,'ts',
+                                                chunk_time_interval => interval '1 month',
+                                                create_default_indexes => false);""",(table_name,))
+                    else:
+                        self._cursor.execute(f"create table {table_name} ({columns}) partition by range (ts);")
+                    self._cursor.execute(f"create index if not exists {table_name}_ts_brin on {table_name} using brin (ts);")
+                    self._logger.log(f"Created table '{table_name}'",how='tpf')
+                    self._cursor.execute("select relkind from pg_class where relname = %s",(table_name,))
+                    row = self._cursor.fetchone()
+                # 'p' = declaratively partitioned, 'r' = plain table (TimescaleDB hypertable)
+                self._hypertable[table_name] = (row[0] == 'r')
+                self._partitions[table_name] = set()
+                if not self._hypertable[table_name]:
+                    self._cursor.execute("""select c.relname from pg_inherits i
+                                            join pg_class c on c.oid = i.inhrelid
+                                            join pg_class p on p.oid = i.inhparent
+                                            where p.relname = %s""",(table_name,))
+                    for (name,) in self._cursor.fetchall():
+                        # bars_YYYYMM -> 'YYYY-MM'
+                        month = name[len(table_name) + 1:]
+                        self._partitions[table_name].add(f'{month[:4]}-{month[4:6]}')
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                self._logger.log(f"ERROR! Failure to create table '{table_name}'!",how='tpf')
+                print(traceback.format_exc())
+                raise
+        self._rebuild_statements(table_name)
+
+    def _timescale_available(self):
+        self._cursor.execute("select 1 from pg_available_extensions where name = 'timescaledb'")
+        return self._cursor.fetchone() is not None
+
+    def _ensure_partitions(self,table_name,months):
+        ''' months = iterable of 'YYYY-MM' - creates missing monthly partitions in their own transaction '''
+        if self._hypertable[table_name]:
+            return
+        missing = sorted(set(months) - self._partitions[table_name])
+        if not missing:
+            return
+        with self._cursor_lock, PartitionedDatabaseConnection._ddl_lock:
+            try:
+                for month in missing:
+                    year, mon = int(month[:4]), int(month[5:7])
+                    upper = f'{year + 1}-01-01' if mon == 12 else f'{year}-{mon + 1:02d}-01'
+                    self._cursor.execute(f"""create table if not exists {table_name}_{year}{mon:02d}
+                                             partition of {table_name} for values from ('{month}-01') to ('{upper}');""")
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        self._partitions[table_name].update(missing)
+
+def _months_between(first,last):
+    ''' 'YYYY-MM' for every month from date first to date last '''
+    months = []
+    year, mon = first.year, first.month
+    while (year,mon) <= (last.year,last.month):
+        months.append(f'{year}-{mon:02d}')
+        year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return months
+
+def database_connection(msg_queue,logger):
+    ''' DatabaseConnection for the storage schema selected in config.ini ([database] schema) '''
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    if config['database'].get('schema',fallback='per_symbol') == 'partitioned':
+        return PartitionedDatabaseConnection(msg_queue,logger)
+    return DatabaseConnection(msg_queue,logger)
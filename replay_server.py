@@ -0,0 +1,342 @@
+'''
+Local stand-in for IQConnect's derivative (9400), history (9100) and Level 1 (5009) ports
+
+Speaks the subset of the protocol this project uses:
+    S,SET PROTOCOL / BW / BR / S,REQUEST WATCHES / S,UNWATCH ALL  (derivative port)
+    HIT ... !ENDMSG!                                               (history port)
+    S,SELECT UPDATE FIELDS / t[Symbol] / r[Symbol]                 (level 1 port, trades only)
+
+Watched symbols get `history_bars` BH bars, then live BC bars at `rate`
+bars/sec spread over all watches (synthetic random walk), or the lines of a
+recorded derivative-port capture (see bench_framing.py record) replayed at `rate`.
+
+    python replay_server.py --rate 5000 [--record traffic.bin]
+    IQCONNECT_SKIP=1 IQFEED_PORT_DERIV=9400 python main.py
+'''
+
+import argparse
+import random
+import socket
+import socketserver
+import threading
+from datetime import datetime, timedelta
+from time import sleep, perf_counter
+
+class SyntheticBars():
+    ''' Random-walk OHLCV bars per symbol, timestamps advancing by the interval '''
+
+    def __init__(self,interval=60,start=None,seed=None):
+        self._interval = interval
+        self._start = start or datetime.now().replace(hour=9,minute=30,second=0,microsecond=0)
+        self._rand = random.Random(seed)
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def next_bar(self,symbol):
+        ''' (timestamp, open, high, low, close, cumvol, volume) '''
+        with self._lock:
+            ts, price, cumvol = self._state.get(symbol,(self._start,100.0,0))
+            ts = ts + timedelta(seconds=self._interval)
+            o = price
+            c = max(0.01,round(o + self._rand.gauss(0,0.05),2))
+            h = round(max(o,c) + abs(self._rand.gauss(0,0.02)),2)
+            l = round(min(o,c) - abs(self._rand.gauss(0,0.02)),2)
+            vol = self._rand.randint(100,10000)
+            cumvol += vol
+            self._state[symbol] = (ts,c,cumvol)
+        return ts,o,h,l,c,cumvol,vol
+
+    def bars_between(self,symbol,start,end):
+        ''' History bars within [start, end] during market hours '''
+        ts = start
+        price = 100.0
+        cumvol = 0
+        step = timedelta(seconds=self._interval)
+        while ts <= end:
+            if (ts.hour,ts.minute) >= (9,30) and ts.hour < 16 and ts.weekday() < 5:
+                o = price
+                c = max(0.01,round(o + self._rand.gauss(0,0.05),2))
+                vol = self._rand.randint(100,10000)
+                cumvol += vol
+                yield ts,o,max(o,c),min(o,c),c,cumvol,vol
+                price = c
+            ts += step
+
+###############################################################################
+# Derivative port
+
+class DerivativeHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.request.settimeout(1)
+        self.server.handlers.add(self)
+        self._watches = {}          # symbol -> (interval, request id)
+        self._send_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._streamer = threading.Thread(target=self._stream,name='ReplayStreamer',daemon=True)
+        self._streamer.start()
+
+    def handle(self):
+        buff = b''
+        while not self.server.stopping.is_set():
+            try:
+                data = self.request.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not data:
+                break
+            buff += data
+            while b'\n' in buff:
+                line, buff = buff.split(b'\n',1)
+                line = line.strip().decode()
+                if line:
+                    self._command(line.split(','))
+
+    def finish(self):
+        self.server.handlers.discard(self)
+        self._stop.set()
+        self._streamer.join(5)
+
+    def _command(self,fields):
+        if fields[:2] == ['S','SET PROTOCOL']:
+            self._send([f'S,CURRENT PROTOCOL,{fields[2]}'])
+        elif fields[:2] == ['S','REQUEST WATCHES']:
+            items = []
+            for sym,(interval,reqid) in self._watches.items():
+                items += [sym,str(interval),reqid]
+            self._send(['S,WATCHES,' + ','.join(items)])
+        elif fields[:2] == ['S','UNWATCH ALL']:
+            self._watches.clear()
+        elif fields[0] == 'BW':
+            self._watch(fields)
+        elif fields[0] == 'BR':
+            self._watches.pop(fields[1],None)
+        else:
+            self._send([f'E,Unknown command: {",".join(fields)}'])
+
+    def _watch(self,fields):
+        ''' BW,[Symbol],[Interval],[BeginDate BeginTime],...,[RequestID],... '''
+        sym, interval, reqid = fields[1], int(fields[2]), fields[8]
+        lines = []
+        for _ in range(self.server.history_bars):
+            lines.append(self._bar_line('BH',sym,reqid))
+        self._send(lines)
+        self._watches[sym] = (interval,reqid)
+
+    def _bar_line(self,kind,sym,reqid):
+        ts,o,h,l,c,cumvol,vol = self.server.bars.next_bar(sym)
+        return f'{reqid},{kind},{sym},{ts:%Y-%m-%d %H:%M:%S},{o:.2f},{h:.2f},{l:.2f},{c:.2f},{cumvol},{vol},0,'
+
+    def _live_line(self,sym,watch):
+        interval, reqid = watch
+        return self._bar_line('BC',sym,reqid)
+
+    def _stream(self):
+        ''' Live bars at server.rate bars/sec, sent in ticks of server.tick seconds, plus T heartbeats '''
+        tick = self.server.tick
+        carry = 0.0
+        replay = iter(self.server.recorded) if self.server.recorded else None
+        next_heartbeat = perf_counter()
+        next_tick = perf_counter()
+
+        while not self._stop.is_set() and not self.server.stopping.is_set():
+            now = perf_counter()
+            if now >= next_heartbeat:
+                self._send([f'T,{datetime.now():%Y%m%d %H:%M:%S}'])
+                next_heartbeat = now + 1
+
+            watches = list(self._watches.items())
+            if watches:
+                carry += self.server.rate * tick
+                count, carry = int(carry), carry - int(carry)
+                if replay is not None:
+                    lines = [next(replay,None) for _ in range(count)]
+                    lines = [line for line in lines if line is not None]
+                else:
+                    lines = []
+                    for i in range(count):
+                        sym,watch = watches[i % len(watches)]
+                        lines.append(self._live_line(sym,watch))
+                if lines:
+                    self._send(lines)
+
+            next_tick += tick
+            delay = next_tick - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            else:
+                next_tick = perf_counter()
+
+    def _send(self,lines):
+        data = ('\r\n'.join(lines) + '\r\n').encode()
+        with self._send_lock:
+            try:
+                self.request.sendall(data)
+            except OSError:
+                self._stop.set()
+
+###############################################################################
+# Level 1 port
+
+class Level1Handler(DerivativeHandler):
+    '''
+    Trades only watches (t[Symbol] / r[Symbol]) streaming Q trade messages in
+    the field order of connection.TradesConnection.update_fields, server.rate
+    trades/sec spread over all watches
+    '''
+
+    def _command(self,fields):
+        if fields[:2] == ['S','SET PROTOCOL']:
+            self._send([f'S,CURRENT PROTOCOL,{fields[2]}'])
+        elif fields[:2] == ['S','SELECT UPDATE FIELDS']:
+            self._send(['S,CURRENT UPDATE FIELDNAMES,Symbol,' + ','.join(fields[2:])])
+        elif fields[:2] == ['S','UNWATCH ALL']:
+            self._watches.clear()
+        elif fields[0][:1] == 't':
+            self._watches[fields[0][1:]] = [100.0,0]    # price, total volume
+        elif fields[0][:1] == 'r':
+            self._watches.pop(fields[0][1:],None)
+        else:
+            self._send([f'E,Unknown command: {",".join(fields)}'])
+
+    def _live_line(self,sym,watch):
+        rand = self.server.bars._rand
+        watch[0] = max(0.01,round(watch[0] + rand.gauss(0,0.01),2))
+        size = rand.randint(1,500)
+        watch[1] += size
+        now = datetime.now()
+        return f'Q,{sym},{watch[0]:.2f},{size},{now:%H:%M:%S.%f},{now:%m/%d/%Y},{watch[1]},C,'
+
+###############################################################################
+# History port
+
+class HistoryHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for raw in self.rfile:
+            fields = raw.decode().strip().split(',')
+            if fields[0] != 'HIT':
+                self.wfile.write(b'E,!SYNTAX_ERROR!,\r\n!ENDMSG!,\r\n')
+                continue
+            self._hit(fields)
+
+    def _hit(self,fields):
+        ''' HIT,[Symbol],[Interval],[BeginDate BeginTime],[EndDate EndTime],... '''
+        sym, interval = fields[1], int(fields[2])
+        start = datetime.strptime(fields[3],'%Y%m%d %H%M%S')
+        end = datetime.strptime(fields[4],'%Y%m%d %H%M%S')
+
+        bars = SyntheticBars(interval)
+        out = []
+        sent = 0
+        for ts,o,h,l,c,cumvol,vol in bars.bars_between(sym,start,end):
+            out.append(f'{ts:%Y-%m-%d %H:%M:%S},{h:.2f},{l:.2f},{o:.2f},{c:.2f},{cumvol},{vol},\r\n')
+            sent += 1
+            if len(out) >= 10000:
+                self.wfile.write(''.join(out).encode())
+                out = []
+        if sent == 0:
+            out.append('E,!NO_DATA!,\r\n')
+        out.append('!ENDMSG!,\r\n')
+        self.wfile.write(''.join(out).encode())
+
+###############################################################################
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self,address,handler):
+        super().__init__(address,handler)
+        self.handlers = set()
+
+class ReplayServer():
+    '''
+    Both ports, each served from its own thread
+    port 0 = pick a free port (read back from deriv_port / hist_port)
+    '''
+
+    def __init__(self,host='127.0.0.1',deriv_port=9400,hist_port=9100,rate=1000,
+                 history_bars=0,interval=60,tick=0.01,recorded=None,level1_port=5009,trade_rate=0):
+        self._stopping = threading.Event()
+
+        self._deriv = _Server((host,deriv_port),DerivativeHandler)
+        self._deriv.stopping = self._stopping
+        self._deriv.rate = rate
+        self._deriv.tick = tick
+        self._deriv.history_bars = history_bars
+        self._deriv.bars = SyntheticBars(interval)
+        self._deriv.recorded = recorded
+
+        self._hist = _Server((host,hist_port),HistoryHandler)
+        self._hist.stopping = self._stopping
+
+        self._level1 = _Server((host,level1_port),Level1Handler)
+        self._level1.stopping = self._stopping
+        self._level1.rate = trade_rate
+        self._level1.tick = tick
+        self._level1.bars = SyntheticBars(interval)
+        self._level1.recorded = None
+        self._level1.history_bars = 0
+
+        self.host = host
+        self.deriv_port = self._deriv.server_address[1]
+        self.hist_port = self._hist.server_address[1]
+        self.level1_port = self._level1.server_address[1]
+        self._threads = []
+
+    def start(self):
+        for server,name in ((self._deriv,'ReplayDeriv'),(self._hist,'ReplayHist'),(self._level1,'ReplayLevel1')):
+            thread = threading.Thread(target=server.serve_forever,name=name,daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f'Replay server: derivative port {self.deriv_port}, history port {self.hist_port}, '
+              f'level 1 port {self.level1_port}')
+
+    def drop_connections(self):
+        ''' Close every open derivative & level 1 connection, as when IQConnect goes away (reconnect tests) '''
+        for server in (self._deriv,self._level1):
+            for handler in list(server.handlers):
+                try:
+                    handler.request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def stop(self):
+        self._stopping.set()
+        for server in (self._deriv,self._hist,self._level1):
+            server.shutdown()
+            server.server_close()
+
+def load_recording(path):
+    ''' Bar lines of a raw derivative-port capture '''
+    with open(path,'rb') as f:
+        lines = f.read().decode().split('\n')
+    return [line.strip() for line in lines if ',B' in line[:40]]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='IQFeed derivative/history port stand-in')
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--deriv-port',type=int,default=9400)
+    parser.add_argument('--hist-port',type=int,default=9100)
+    parser.add_argument('--rate',type=float,default=1000,help='live bars/sec across all watches')
+    parser.add_argument('--history-bars',type=int,default=390,help='BH bars sent per BW watch')
+    parser.add_argument('--interval',type=int,default=60)
+    parser.add_argument('--record',default=None,help='replay bar lines from a capture instead')
+    parser.add_argument('--level1-port',type=int,default=5009)
+    parser.add_argument('--trade-rate',type=float,default=1000,help='level 1 trades/sec across all watches')
+    args = parser.parse_args()
+
+    server = ReplayServer(  args.host,args.deriv_port,args.hist_port,args.rate,
+                            args.history_bars,args.interval,
+                            recorded=load_recording(args.record) if args.record else None,
+                            level1_port=args.level1_port,trade_rate=args.trade_rate)
+    server.start()
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,130 @@
+'''
+Coarser bars derived from the single base-interval subscription
+
+IQFeed is watched once per symbol at [market] interval_seconds; 5 minute,
+1 hour, ... bars are built from the base bars instead of separate BW watches.
+Bars are labelled with the end of their interval (as IQFeed does), buckets
+are aligned to midnight, so a derived interval must be a multiple of the base.
+
+    [resample]
+    intervals = 300,3600        derived intervals for every symbol
+    SPY = 300,900,3600          per symbol override (empty = none)
+'''
+
+import pandas as pd
+from bars import Bar
+
+class _Bucket():
+    ''' The derived bar being built for one symbol/interval - reused for every bucket '''
+
+    __slots__ = ('ts','open','high','low','close','volume','cumvol','kind')
+
+    def __init__(self):
+        self.ts = None
+
+class Resampler():
+    '''
+    Incremental resampling - add() each complete base bar (MessageHandler bar
+    listener); a derived bar is emitted to every sink as soon as the last base
+    bar of its interval arrives, or when a later bar shows the interval is over
+
+    Base bars at or before the newest one already added for the symbol are
+    ignored - the same bars come again after catch-up history, re-watches on
+    another shard, reconnects and symbols removed & added back
+    '''
+
+    def __init__(self,base_interval,intervals,sinks):
+        '''
+        intervals = {symbol: list of derived intervals in seconds}
+        sinks = callables taking one bars.Bar (e.g. db_queue.put, BarCache.update)
+        '''
+        self._base = base_interval
+        self._sinks = sinks
+        self._buckets = {sym: [(k,_Bucket()) for k in sorted(ks)] for sym,ks in intervals.items()}
+        self._last = {}     # symbol -> ts of the newest base bar added
+
+    def add_symbols(self,intervals):
+        ''' intervals = {symbol: derived intervals} of symbols tracked from now on (already tracked ones are kept) '''
+        for sym,ks in intervals.items():
+            if sym not in self._buckets:
+                self._buckets[sym] = [(k,_Bucket()) for k in sorted(ks)]
+
+    def targets(self):
+        ''' (symbol, interval) of every derived series '''
+        return [(sym,k) for sym,buckets in self._buckets.items() for k,_ in buckets]
+
+    def add(self,bar):
+        if bar.interval != self._base:
+            return
+        buckets = self._buckets.get(bar.symbol)
+        if not buckets:
+            return
+        last = self._last.get(bar.symbol)
+        if last is not None and bar.ts <= last:
+            return      # replayed
+        self._last[bar.symbol] = bar.ts
+
+        for k,b in buckets:
+            end = -(-bar.ts // k) * k
+            if b.ts is not None and b.ts != end:
+                self._emit(bar,k,b)
+            if b.ts is None:
+                b.ts = end
+                b.open = bar.open
+                b.high = bar.high
+                b.low = bar.low
+                b.volume = bar.volume
+            else:
+                b.high = max(b.high,bar.high)
+                b.low = min(b.low,bar.low)
+                b.volume += bar.volume
+            b.close = bar.close
+            b.cumvol = bar.cumvol
+            b.kind = bar.kind
+            if bar.ts == end:
+                self._emit(bar,k,b)
+
+    def _emit(self,bar,k,b):
+        derived = Bar(  bar.symbol,b.kind,b.ts,b.open,b.high,b.low,b.close,b.volume,b.cumvol,k,
+                        bar.received,bar.dequeued)
+        b.ts = None
+        for sink in self._sinks:
+            sink(derived)
+
+def resample_frame(df,interval):
+    '''
+    Vectorized version for history - df of base bars with date,time,open,high,
+    low,close,volume,cumvol columns (e.g. a backfill chunk) -> same columns at
+    interval seconds. Only whole days give complete buckets at the edges.
+    '''
+    ts = pd.to_datetime(df['date'] + ' ' + df['time'])
+    end = ts.dt.ceil(f'{interval}s').rename('end')
+    out = df.groupby(end,sort=True).agg(open=('open','first'),high=('high','max'),low=('low','min'),
+                                         close=('close','last'),volume=('volume','sum'),
+                                         cumvol=('cumvol','last'))
+    out.insert(0,'time',out.index.strftime('%H:%M:%S'))
+    out.insert(0,'date',out.index.strftime('%Y-%m-%d'))
+    return out.reset_index(drop=True)
+
+def intervals_from_config(config,symbols):
+    '''
+    {symbol: derived intervals} from [resample] - intervals that are not a
+    multiple of the base interval are dropped with a warning
+    '''
+    if not config.has_section('resample'):
+        return {}
+    base = config['market'].getint('interval_seconds')
+    section = config['resample']
+    default = section.get('intervals','')
+
+    intervals = {}
+    for sym in symbols:
+        items = section.get(sym,default)
+        ks = sorted({int(k) for k in items.split(',') if k.strip()})
+        for k in ks:
+            if k <= base or k % base:
+                print(f'WARNING: resample interval {k} for {sym} is not a multiple of {base} - ignored')
+        ks = [k for k in ks if k > base and k % base == 0]
+        if ks:
+            intervals[sym] = ks
+    return intervals
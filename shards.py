@@ -0,0 +1,247 @@
+import math
+import queue
+import threading
+from time import perf_counter, monotonic, sleep
+import backpressure
+import connection
+import listener
+import universe
+
+class Shard():
+    ''' One derivative-port connection with its own iq_queue and Listener thread '''
+
+    def __init__(self,index,db_queue,logger,universe,config=None,last_ts=None):
+        self.index = index
+        self.symbols = []
+        # Bounded by [queues] iq_size / iq_policy when configured
+        if config is not None:
+            self.iq_queue = backpressure.queue_from_config(config,'iq',logger,f'iq_queue-{index}')
+        else:
+            self.iq_queue = queue.Queue()
+        self.listener = listener.Listener(self.iq_queue,db_queue,logger,universe,name=f'ListenerThread-{index}',
+                                          last_ts=last_ts)
+        # Reconnects resume each symbol after the newest bar this shard's Listener handled
+        self.conn = connection.BarsConnection(self.iq_queue,logger,name=f'LiveBarListener-{index}',
+                                              resume_from=self.listener.resume_points)
+        self._last = (perf_counter(),0,0)
+
+    def rates(self):
+        ''' (lines/sec, bytes/sec) since the previous call '''
+        now, lines, nbytes = perf_counter(), self.conn.lines_read, self.conn.bytes_read
+        then, last_lines, last_bytes = self._last
+        self._last = (now,lines,nbytes)
+        elapsed = max(now - then,1e-9)
+        return (lines - last_lines) / elapsed, (nbytes - last_bytes) / elapsed
+
+class ShardedFeed():
+    '''
+    The symbol universe split across N derivative-port connections, each with
+    its own reader and Listener thread, all writing into the same db_queue
+
+    A symbol is only ever watched on one shard, so its bars keep their order.
+    Symbols added later go to the shard watching the fewest symbols; shards
+    are then rebalanced so their symbol counts differ by at most one - a moved
+    symbol is unwatched on its old shard before the new one watches it from
+    after the newest bar handled. The Listeners share the newest bar per
+    symbol and drop anything at or before it. Removed symbols are unwatched
+    on their shard (BR).
+
+    symbols = list, or the universe.SymbolRegistry shared with the other stages
+
+    Same start/stop calls as a BarsConnection + Listener pair:
+    start_listening, connect, subscribe_to_symbols, disconnect, stop_listening
+    '''
+
+    def __init__(self,db_queue,logger,symbols,shards=1,latest_bars=None,report_seconds=60,config=None):
+        '''
+        latest_bars = callable {symbol: (date, time)} (DatabaseConnection.latest_bars)
+        used to resume moved symbols from their newest stored bar
+        config = configparser object with [queues] for bounded iq_queues (None = unbounded)
+        '''
+        self._logger = logger
+        self._latest_bars = latest_bars
+        self._report_seconds = report_seconds
+        self._last_report = perf_counter()
+        self._config = None
+
+        # Shared by every Listener for symbol validation
+        if isinstance(symbols,universe.SymbolRegistry):
+            self._universe = symbols
+        else:
+            self._universe = universe.SymbolRegistry(symbols)
+        self._lock = threading.RLock()
+        last_ts = {}
+        self._shards = [Shard(i,db_queue,logger,self._universe,config,last_ts) for i in range(max(1,shards))]
+        self._shard_of = {}
+        for i,sym in enumerate(self._universe.symbols()):
+            shard = self._shards[i % len(self._shards)]
+            shard.symbols.append(sym)
+            self._shard_of[sym] = shard
+
+    @property
+    def listeners(self):
+        return [shard.listener for shard in self._shards]
+
+    def add_bar_listener(self,bar_listener):
+        ''' bar_listener is called from every shard's Listener thread - it must be thread safe '''
+        for shard in self._shards:
+            shard.listener.add_bar_listener(bar_listener)
+
+    ###########################################################################
+    # Starting and stopping
+
+    def start_listening(self):
+        for shard in self._shards:
+            shard.listener.start_listening()
+
+    def stop_listening(self):
+        for shard in self._shards:
+            shard.listener.stop_listening()
+
+    def connect(self):
+        for shard in self._shards:
+            shard.conn.connect()
+        print(f'{len(self._shards)} derivative port connections open')
+
+    def disconnect(self):
+        for shard in self._shards:
+            shard.conn.disconnect()
+
+    def subscribe_to_symbols(self,config,latest=None):
+        ''' BW every shard's symbols - shards subscribe in parallel '''
+        self._config = config
+        threads = []
+        for shard in self._shards:
+            if shard.symbols:
+                thread = threading.Thread(  target=shard.conn.subscribe_to_symbols,
+                                            args=(list(shard.symbols),config,latest),
+                                            name=f'Subscribe-{shard.index}')
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    ###########################################################################
+    # Adding symbols & rebalancing
+
+    def add_symbols(self,symbols):
+        ''' Watch new symbols on the least loaded shards, then rebalance - returns the symbols added '''
+        with self._lock:
+            added = [sym for sym in dict.fromkeys(symbols) if sym not in self._shard_of]
+            placed = {}
+            for sym in added:
+                shard = min(self._shards,key=lambda s: len(s.symbols))
+                shard.symbols.append(sym)
+                self._shard_of[sym] = shard
+                placed.setdefault(shard,[]).append(sym)
+            # Valid for the Listeners before the first bar can arrive
+            self._universe.add(added)
+            latest = self._latest(added)
+            for shard,syms in placed.items():
+                shard.conn.subscribe_to_symbols(syms,self._config,latest)
+            if added:
+                self.rebalance()
+        return added
+
+    def remove_symbols(self,symbols):
+        ''' BR each symbol on its shard - returns the symbols removed (shards are not rebalanced) '''
+        with self._lock:
+            removed = [sym for sym in dict.fromkeys(symbols) if sym in self._shard_of]
+            by_shard = {}
+            for sym in removed:
+                shard = self._shard_of.pop(sym)
+                shard.symbols.remove(sym)
+                by_shard.setdefault(shard,[]).append(sym)
+            for shard,syms in by_shard.items():
+                shard.conn.unwatch_symbols(syms)
+            self._universe.remove(removed)
+        return removed
+
+    def rebalance(self):
+        ''' Move symbols from the fullest to the emptiest shard until counts differ by at most one '''
+        with self._lock:
+            moves = []
+            while True:
+                fullest = max(self._shards,key=lambda s: len(s.symbols))
+                emptiest = min(self._shards,key=lambda s: len(s.symbols))
+                if len(fullest.symbols) - len(emptiest.symbols) <= 1:
+                    break
+                sym = fullest.symbols.pop()
+                emptiest.symbols.append(sym)
+                self._shard_of[sym] = emptiest
+                moves.append((sym,fullest,emptiest))
+
+            if moves:
+                # Drop the old watches first, so a symbol never streams on two shards
+                for sym,source,_ in moves:
+                    source.conn.unwatch_symbols([sym])
+                self._drain({source for _,source,_ in moves})
+
+                latest = self._latest([sym for sym,_,_ in moves]) or {}
+                by_target = {}
+                for sym,source,target in moves:
+                    # Resume after the newest bar the old shard's Listener handled
+                    latest.update(source.listener.resume_points([sym]))
+                    by_target.setdefault(target,[]).append(sym)
+                for target,syms in by_target.items():
+                    target.conn.subscribe_to_symbols(syms,self._config,latest)
+                for sym,source,target in moves:
+                    self._logger.log(f'Rebalanced {sym}: shard {source.index} -> {target.index}',how='fp')
+            return [(sym,source.index,target.index) for sym,source,target in moves]
+
+    def _drain(self,shards):
+        ''' Wait (at most drain_seconds) for bars read before the BR to go through the Listeners '''
+        sleep(0.1)
+        deadline = monotonic() + connection.BarsConnection.drain_seconds
+        for shard in shards:
+            while shard.iq_queue.unfinished_tasks and monotonic() < deadline:
+                sleep(0.05)
+
+    def _latest(self,symbols):
+        if not symbols or self._latest_bars is None:
+            return None
+        return self._latest_bars(symbols)
+
+    ###########################################################################
+    # Throughput
+
+    def stats(self):
+        ''' Per shard: symbols, lines/sec & bytes/sec since the previous call, iq_queue backlog '''
+        out = []
+        for shard in self._shards:
+            lines, nbytes = shard.rates()
+            s = {'shard': shard.index,'symbols': len(shard.symbols),'lines_per_sec': lines,
+                 'bytes_per_sec': nbytes,'backlog': shard.iq_queue.qsize()}
+            if isinstance(shard.iq_queue,backpressure.BoundedQueue):
+                s['overload'] = shard.iq_queue.stats()
+            out.append(s)
+        return out
+
+    def queue_depths(self):
+        ''' {shard: iq_queue backlog} - metrics gauge '''
+        return {shard.index: shard.iq_queue.qsize() for shard in self._shards}
+
+    def maybe_report(self):
+        ''' Log per-shard throughput once every report_seconds '''
+        now = perf_counter()
+        if now - self._last_report < self._report_seconds:
+            return
+        self._last_report = now
+        for s in self.stats():
+            msg = (f"Shard {s['shard']}: {s['symbols']} symbols, {s['lines_per_sec']:,.0f} lines/sec, "
+                   f"{s['bytes_per_sec'] / 1024:,.1f} KB/sec, backlog {s['backlog']}")
+            if 'overload' in s:
+                o = s['overload']
+                msg += (f" (peak {o['peak']:,}/{o['size']:,} messages, {o['waits']} waits, "
+                        f"{o['spilled']} spilled, {o['coalesced']} BU coalesced)")
+            self._logger.log(msg,how='f')
+
+def shard_count(config,symbols):
+    '''
+    [market] shards = N connections, or 0 for one per symbols_per_shard symbols
+    '''
+    shards = config['market'].getint('shards',fallback=1)
+    if shards <= 0:
+        per_shard = config['market'].getint('symbols_per_shard',fallback=100)
+        shards = math.ceil(len(symbols) / per_shard)
+    return max(1,shards)
@@ -0,0 +1,168 @@
+'''
+Durable local spool for bars the database cannot take right now
+
+Bars are appended as fixed size binary records to memory mapped segment
+files (spool_00000001.seg, ...) of segment_bytes each, and replayed oldest
+first once the database is back. A segment is deleted when all of its
+records are replayed. Record & replay counts live in each segment's header,
+so a restart carries on where the last run stopped.
+
+    [spool]
+    enabled = true
+    path = spool/
+    segment_mb = 64
+    backlog = 50000         db queue depth at which live bars go to the spool
+    replay_rows = 50000     bars per replay COPY
+    retry_seconds = 5       between reconnect attempts
+'''
+
+import glob
+import mmap
+import os
+import struct
+from bars import Bar
+
+# magic, version, record size, records written, records replayed
+_HEADER = struct.Struct('<4sHHQQ')
+_MAGIC = b'IQSP'
+_VERSION = 1
+# symbol, kind, ts, open, high, low, close, volume, cumvol, interval (0 = None)
+_RECORD = struct.Struct('<16sBqddddqqi')
+
+class _Segment():
+
+    def __init__(self,path,capacity=None):
+        ''' capacity = records - creates the file; None opens an existing one '''
+        self.path = path
+        if capacity is not None:
+            with open(path,'wb') as f:
+                f.truncate(_HEADER.size + capacity * _RECORD.size)
+        self._file = open(path,'r+b')
+        self._mm = mmap.mmap(self._file.fileno(),0)
+        if capacity is not None:
+            _HEADER.pack_into(self._mm,0,_MAGIC,_VERSION,_RECORD.size,0,0)
+            self._mm.flush()
+        magic, version, size, self.count, self.done = _HEADER.unpack_from(self._mm,0)
+        if magic != _MAGIC or size != _RECORD.size:
+            self.close()
+            raise ValueError(f'{path} is not a version {_VERSION} bar spool segment')
+        self.capacity = (len(self._mm) - _HEADER.size) // _RECORD.size
+
+    def append(self,bars):
+        ''' Write as many bars as fit - returns how many '''
+        n = min(len(bars),self.capacity - self.count)
+        offset = _HEADER.size + self.count * _RECORD.size
+        for bar in bars[:n]:
+            _RECORD.pack_into(self._mm,offset,bar.symbol.encode(),ord(bar.kind),bar.ts,
+                              bar.open,bar.high,bar.low,bar.close,bar.volume,bar.cumvol,bar.interval or 0)
+            offset += _RECORD.size
+        self.count += n
+        self._write_header()
+        return n
+
+    def read(self,max_rows):
+        ''' Up to max_rows bars after the replayed ones '''
+        n = min(max_rows,self.count - self.done)
+        offset = _HEADER.size + self.done * _RECORD.size
+        bars = []
+        for sym,kind,ts,o,h,l,c,vol,cumvol,interval in _RECORD.iter_unpack(self._mm[offset:offset + n * _RECORD.size]):
+            bars.append(Bar(sym.rstrip(b'\0').decode(),chr(kind),ts,o,h,l,c,vol,cumvol,interval or None))
+        return bars
+
+    def mark_done(self,n):
+        self.done += n
+        self._write_header()
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mm,0,_MAGIC,_VERSION,_RECORD.size,self.count,self.done)
+        self._mm.flush()
+
+class BarSpool():
+    '''
+    Segment rotated, memory mapped bar log - one writer thread (append, read, commit)
+
+    append() returns once the bars are flushed to the segment file; read()
+    returns the oldest unreplayed bars and commit() marks them written. The
+    active segment is read in place - it is only rotated once full.
+    '''
+
+    def __init__(self,directory,segment_bytes=64 << 20):
+        os.makedirs(directory,exist_ok=True)
+        self._dir = directory
+        self._capacity = max(1,(segment_bytes - _HEADER.size) // _RECORD.size)
+        self._active = None
+        self._sealed = []       # oldest first
+        self._reading = 0       # bars handed out by read() and not committed yet
+        self._read_from = None  # the segment they came from
+        self._next_seq = 1
+
+        for path in sorted(glob.glob(os.path.join(directory,'spool_*.seg'))):
+            self._next_seq = int(os.path.basename(path)[6:14]) + 1
+            segment = _Segment(path)
+            if segment.done < segment.count:
+                self._sealed.append(segment)
+            else:
+                segment.close()
+                os.remove(path)
+        self._pending = sum(s.count - s.done for s in self._sealed)
+
+    def pending(self):
+        ''' Bars spooled and not yet replayed '''
+        return self._pending
+
+    def append(self,bars):
+        while bars:
+            if self._active is None or self._active.full():
+                self._rotate()
+            n = self._active.append(bars)
+            self._pending += n
+            bars = bars[n:]
+
+    def read(self,max_rows):
+        ''' Oldest unreplayed bars (at most max_rows, never across segments) '''
+        segment = self._sealed[0] if self._sealed else self._active
+        if segment is None:
+            return []
+        bars = segment.read(max_rows)
+        self._reading = len(bars)
+        self._read_from = segment
+        return bars
+
+    def commit(self):
+        ''' The bars of the last read() are in the database '''
+        if not self._reading:
+            return
+        segment = self._read_from
+        segment.mark_done(self._reading)
+        self._pending -= self._reading
+        self._reading = 0
+        self._read_from = None
+        if segment.done >= segment.count and segment is not self._active:
+            # Sealed (possibly since the read) - the active one keeps taking bars
+            self._sealed.remove(segment)
+            segment.close()
+            os.remove(segment.path)
+
+    def close(self):
+        for segment in self._sealed + ([self._active] if self._active else []):
+            segment.close()
+        self._sealed = []
+        self._active = None
+
+    def _rotate(self):
+        if self._active is not None:
+            if self._active.count > self._active.done:
+                self._sealed.append(self._active)
+            else:
+                self._active.close()
+                os.remove(self._active.path)
+        path = os.path.join(self._dir,f'spool_{self._next_seq:08d}.seg')
+        self._next_seq += 1
+        self._active = _Segment(path,self._capacity)
@@ -0,0 +1,113 @@
+'''
+Overload test against replay_server.ReplayServer: the database is throttled
+below the offered bar rate and memory is sampled while the backlog builds
+
+    python stress_backpressure.py --policy block --rate 20000 --db-rate 2000 --seconds 60
+    python stress_backpressure.py --policy spill
+    python stress_backpressure.py --policy unbounded        (the old queue.Queue, for comparison)
+
+BarsConnection -> iq_queue -> Listener -> db_queue -> throttled NullDatabase
+(bench_pipeline.py). Every second: Python heap in use (tracemalloc), queue
+depths and bars committed. With a bounded policy the heap levels off once
+the queues reach their bound; unbounded it grows with the backlog.
+'''
+
+import argparse
+import configparser
+import queue
+import tempfile
+import tracemalloc
+from time import sleep, perf_counter
+
+import backpressure
+import connection
+import listener
+import mylogger
+from bench_pipeline import NullDatabase
+from replay_server import ReplayServer
+
+class ThrottledDatabase(NullDatabase):
+    ''' NullDatabase that takes rows / db_rate seconds per batch, like a database that cannot keep up '''
+
+    db_rate = 2000
+
+    def _write_batch(self,groups):
+        rows = sum(len(group) for group in groups.values())
+        sleep(rows / ThrottledDatabase.db_rate)
+
+def make_queues(args,logger):
+    if args.policy == 'unbounded':
+        return queue.Queue(), queue.Queue()
+    iq_policy = 'block' if args.policy == 'spill' else args.policy
+    iq_queue = backpressure.BoundedQueue(args.iq_size,iq_policy,'iq_queue',logger,
+                                         weigh=backpressure.batch_messages,spill_path=args.spill_path)
+    db_queue = backpressure.BoundedQueue(args.db_size,args.policy,'db_queue',logger,spill_path=args.spill_path)
+    return iq_queue, db_queue
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Memory under a throttled database')
+    parser.add_argument('--policy',choices=['block','spill','unbounded'],default='block')
+    parser.add_argument('--symbols',type=int,default=200)
+    parser.add_argument('--rate',type=float,default=20000,help='live bars/sec offered by the server')
+    parser.add_argument('--db-rate',type=float,default=2000,help='bars/sec the throttled database writes')
+    parser.add_argument('--iq-size',type=int,default=20000,help='messages')
+    parser.add_argument('--db-size',type=int,default=20000,help='bars')
+    parser.add_argument('--spill-path',default=tempfile.gettempdir())
+    parser.add_argument('--seconds',type=float,default=30)
+    args = parser.parse_args()
+
+    symbols = [f'SYM{i}' for i in range(args.symbols)]
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    config['market']['symbols'] = ','.join(symbols)
+    config['market']['catchup'] = 'false'
+
+    logger = mylogger.Logger('','',tempfile.gettempdir() + '/')
+    ThrottledDatabase.db_rate = args.db_rate
+
+    server = ReplayServer(deriv_port=0,hist_port=0,level1_port=0,rate=args.rate)
+    server.start()
+    connection.BarsConnection.iqfeed_host = server.host
+    connection.BarsConnection.deriv_port = server.deriv_port
+
+    tracemalloc.start()
+    iq_queue, db_queue = make_queues(args,logger)
+    db = ThrottledDatabase(db_queue,logger)
+    db.connect()
+    for sym in symbols:
+        db.ensure_table(sym)
+    listen = listener.Listener(iq_queue,db_queue,logger,symbols)
+    listen.start_listening()
+    conn = connection.BarsConnection(iq_queue,logger)
+    conn.connect()
+
+    samples = []
+    try:
+        conn.subscribe_to_symbols(symbols,config)
+        started = perf_counter()
+        print(f"\n{'sec':>5} {'heap MB':>9} {'iq items':>9} {'db bars':>9} {'committed':>10}")
+        while perf_counter() - started < args.seconds:
+            sleep(1)
+            heap = tracemalloc.get_traced_memory()[0] / 2**20
+            samples.append(heap)
+            print(f'{perf_counter() - started:5.0f} {heap:9.1f} {iq_queue.qsize():9,} {db_queue.qsize():9,} {db._rows_written:10,}')
+    finally:
+        # Unthrottle so the backlog drains quickly
+        ThrottledDatabase.db_rate = float('inf')
+        conn.disconnect()
+        server.stop()
+        print('Draining...')
+        listen.stop_listening()
+        db.disconnect()
+
+    # Bounded queues are full well before the last third of the run
+    tail = samples[len(samples) * 2 // 3:]
+    growth = (sum(tail[len(tail) // 2:]) / max(1,len(tail) - len(tail) // 2)
+              - sum(tail[:len(tail) // 2]) / max(1,len(tail) // 2)) if len(tail) > 1 else 0.0
+    print(f'\n{args.policy}: offered {args.rate:,.0f} bars/sec, database {args.db_rate:,.0f} bars/sec')
+    print(f'  heap peak {max(samples):.1f} MB, growth over the last third {growth:+.1f} MB')
+    if isinstance(db_queue,backpressure.BoundedQueue):
+        print(f'  iq_queue {iq_queue.stats()}')
+        print(f'  db_queue {db_queue.stats()}')
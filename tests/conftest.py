@@ -0,0 +1,20 @@
+import os
+import sys
+
+# The modules live flat in the repository root
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+class ListLogger():
+    ''' mylogger.Logger stand-in keeping the messages '''
+
+    def __init__(self):
+        self.messages = []
+
+    def log(self,msg,how='f'):
+        self.messages.append(msg)
+
+@pytest.fixture
+def logger():
+    return ListLogger()
@@ -0,0 +1,79 @@
+import asyncio
+import configparser
+import queue
+import threading
+import pytest
+from backpressure import (BoundedQueue, AsyncBoundedQueue, coalesce_updates, batch_messages,
+                          queue_from_config)
+
+def bu(request_id,close):
+    return [request_id,'BU','SPY','2021-01-04 09:31:00','1','1','1',close,'0','0','0']
+
+def bc(request_id):
+    return [request_id,'BC','SPY','2021-01-04 09:31:00','1','1','1','1','0','0','0']
+
+def test_coalesce_keeps_newest_update_and_complete_bars():
+    items = [(1.0,[bu('B-SPY-60','1'),bc('B-SPY-60'),bu('B-QQQ-60','1')]),
+             (2.0,[['T','20210104 09:31:01'],bu('B-SPY-60','2')]),
+             (3.0,[bu('B-SPY-60','3')])]
+    assert coalesce_updates(items) == 2
+    assert items[0][1] == [bc('B-SPY-60'),bu('B-QQQ-60','1')]
+    assert items[1][1] == [['T','20210104 09:31:01']]
+    assert items[2][1] == [bu('B-SPY-60','3')]
+
+def test_block_policy_waits_for_room(logger):
+    q = BoundedQueue(2,'block',logger=logger)
+    q.put(1)
+    q.put(2)
+    with pytest.raises(queue.Full):
+        q.put(3,timeout=0.05)
+    threading.Timer(0.1,q.get).start()
+    q.put(3,timeout=5)
+    assert q.waits == 2 and q.peak == 2
+    assert [q.get(),q.get()] == [2,3]
+
+def test_spill_policy_keeps_order(tmp_path,logger):
+    q = BoundedQueue(3,'spill',logger=logger,spill_path=str(tmp_path))
+    for i in range(10):
+        q.put(i)
+    assert q.spilled == 7 and q.qsize() == 10
+    assert [q.get() for _ in range(10)] == list(range(10))
+    for _ in range(10):
+        q.task_done()
+    q.join()
+    assert any('spilling' in msg for msg in logger.messages)
+
+def test_coalesce_policy_makes_room(logger):
+    q = BoundedQueue(3,'coalesce',logger=logger,weigh=batch_messages)
+    q.put((1.0,[bu('B-SPY-60','1'),bu('B-SPY-60','2')]))
+    q.put((2.0,[bu('B-SPY-60','3')]))
+    q.put((3.0,[bu('B-SPY-60','4')]),timeout=1)
+    # Only what is already queued is coalesced - the update being put is newer
+    assert q.coalesced == 2 and q.depth() == 2
+    assert q.get()[1] == []
+    assert q.get()[1] == [bu('B-SPY-60','3')]
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        BoundedQueue(1,'drop')
+
+def test_queue_from_config_splits_bound():
+    config = configparser.ConfigParser()
+    config.read_dict({'queues': {'db_size': '100','db_policy': 'spill'}})
+    q = queue_from_config(config,'db',None,'db_queue-writer-0',parts=4,policy='block')
+    assert (q.size,q.policy,q.name) == (25,'block','db_queue-writer-0')
+
+def test_async_queue_blocks_by_weight(logger):
+    async def run():
+        q = AsyncBoundedQueue(3,'iq_queue',logger,weigh=batch_messages)
+        await q.put((1.0,[['a'],['b']]))
+        await q.put((2.0,[['c'],['d']]))
+        assert q.full() and q.depth() == 4
+        putter = asyncio.create_task(q.put((3.0,[['e']])))
+        await asyncio.sleep(0.05)
+        assert not putter.done() and q.waits == 1
+        assert (await q.get())[0] == 1.0
+        await asyncio.wait_for(putter,1)
+        assert q.depth() == 3 and q.peak == 4
+    asyncio.run(run())
+    assert any('above high water mark' in msg for msg in logger.messages)
@@ -0,0 +1,25 @@
+from bars import Bar, parse_bar, stamp_epoch, request_interval, day_string
+
+def test_parse_bar():
+    fields = 'B-SPY-60,BC,SPY,2021-01-04 09:31:00,371.1,371.5,370.9,371.2,1500000,2500,42,'.split(',')
+    bar = parse_bar(fields,1.0,2.0)
+    assert (bar.symbol,bar.kind,bar.interval) == ('SPY','C',60)
+    assert (bar.open,bar.high,bar.low,bar.close) == (371.1,371.5,370.9,371.2)
+    assert (bar.volume,bar.cumvol) == (2500,1500000)
+    assert (bar.date,bar.time) == ('2021-01-04','09:31:00')
+    assert (bar.received,bar.dequeued) == (1.0,2.0)
+    assert bar.row() == ('SPY','2021-01-04','09:31:00',371.1,371.5,370.9,371.2,2500,1500000)
+
+def test_stamp_epoch_is_wall_clock_as_utc():
+    assert stamp_epoch('1970-01-01 00:00:00') == 0
+    assert stamp_epoch('2021-01-04 09:31:00') == 1609752660
+    assert day_string(1609752660 // 86400) == '2021-01-04'
+
+def test_request_interval():
+    assert request_interval('B-SPY-60') == 60
+    assert request_interval('B-BRK.B-300') == 300
+    assert request_interval('SPY') is None
+
+def test_time_property():
+    bar = Bar('SPY','H',stamp_epoch('2021-01-04 16:00:05'),1.0,1.0,1.0,1.0,0,0)
+    assert bar.time == '16:00:05'
@@ -0,0 +1,49 @@
+import socket
+from connection import LineFramer
+
+def test_partial_line_kept_until_complete():
+    framer = LineFramer(64)
+    framer.feed(b'T,20210104 09:30:00\r\nB-SPY-60,BC,SP')
+    assert framer.lines() == ['T,20210104 09:30:00']
+    assert framer.pending() == len(b'B-SPY-60,BC,SP')
+    framer.feed(b'Y,2021-01-04 09:31:00\r\n')
+    assert framer.lines() == ['B-SPY-60,BC,SPY,2021-01-04 09:31:00']
+    assert framer.pending() == 0
+
+def test_no_complete_line():
+    framer = LineFramer(16)
+    framer.feed(b'abc')
+    assert framer.lines() == []
+    assert framer.pending() == 3
+
+def test_blank_lines_dropped():
+    framer = LineFramer(64)
+    framer.feed(b'a\r\n\r\nb\n')
+    assert framer.lines() == ['a','b']
+
+def test_line_longer_than_buffer_grows_it():
+    framer = LineFramer(8)
+    line = 'x' * 100
+    for i in range(0,100,7):
+        framer.feed(line[i:i + 7].encode())
+    framer.feed(b'\r\n')
+    assert framer.lines() == [line]
+
+def test_partial_line_moved_to_front():
+    framer = LineFramer(16)
+    framer.feed(b'0123456789\nab')
+    assert framer.lines() == ['0123456789']
+    framer.feed(b'cdefghijklm\n')
+    assert framer.lines() == ['abcdefghijklm']
+
+def test_recv_into():
+    a, b = socket.socketpair()
+    try:
+        framer = LineFramer(32)
+        a.sendall(b'S,CURRENT PROTOCOL,6.1\r\nn,XYZ')
+        assert framer.recv_into(b) > 0
+        assert framer.lines() == ['S,CURRENT PROTOCOL,6.1']
+        a.close()
+        assert framer.recv_into(b) == 0
+    finally:
+        b.close()
@@ -0,0 +1,39 @@
+import configparser
+import queue
+import pytest
+from mp_pipeline import ShmRing, ProcessFeed
+
+@pytest.fixture
+def ring():
+    ring = ShmRing(64)
+    yield ring
+    ring.close(unlink=True)
+
+def test_ring_keeps_records_in_order_across_wrap(ring):
+    for i in range(20):
+        ring.put(b'record %d' % i)
+        assert ring.get(timeout=1) == b'record %d' % i
+    assert ring.used() == 0
+
+def test_full_ring_is_not_a_socket_error(ring):
+    ring.put(b'x' * 28)
+    ring.put(b'y' * 28)
+    with pytest.raises(queue.Full):
+        ring.put(b'z' * 28,timeout=0.01)
+
+def test_feed_raises_when_parser_died_with_full_ring(logger,monkeypatch):
+    monkeypatch.setattr(ProcessFeed,'ring_bytes',64)
+    config = configparser.ConfigParser()
+    config.read_dict({'database': {'batch_rows': '10'},'queues': {'db_size': '100'}})
+    feed = ProcessFeed(logger,['SPY'],config,workers=1)
+    try:
+        assert feed._queue_size == 10
+        feed._put_record(0,b'x' * 28)
+        feed._put_record(0,b'y' * 28)
+        # The parser process was never started - a full ring must not wait forever
+        with pytest.raises(RuntimeError):
+            feed._put_record(0,b'z' * 28)
+        assert feed._ring_waits == [1]
+    finally:
+        for r in feed._rings:
+            r.close(unlink=True)
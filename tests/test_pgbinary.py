@@ -0,0 +1,46 @@
+import struct
+from decimal import Decimal
+import pytest
+import pgbinary
+from bars import Bar, stamp_epoch
+
+def decode_numeric(field):
+    ''' Length prefixed NUMERIC field -> Decimal (inverse of pgbinary.numeric) '''
+    length, ndigits, weight, sign, dscale = struct.unpack_from('!ihhHh',field)
+    assert length == len(field) - 4
+    digits = struct.unpack_from(f'!{ndigits}h',field,12)
+    value = sum((Decimal(d) * Decimal(10000) ** (weight - i) for i,d in enumerate(digits)),Decimal(0))
+    value = value.quantize(Decimal(1).scaleb(-dscale))
+    return -value if sign == 0x4000 else value
+
+@pytest.mark.parametrize('text',['0','1','9999','10000','123456789','0.5','0.0001','12.34',
+                                 '371.25','100000.00001','-42.125','-0.01','1e-05','1.5e+20'])
+def test_numeric_text_round_trip(text):
+    assert decode_numeric(pgbinary._numeric_text(text)) == Decimal(text)
+
+@pytest.mark.parametrize('value',[0,1,9999,10000,12345678,99990000,100000000,10 ** 12,-7])
+def test_numeric_int_round_trip(value):
+    assert decode_numeric(pgbinary.numeric(value)) == value
+
+@pytest.mark.parametrize('value',[371.21,0.1,100.0,1234.5678,-3.5])
+def test_numeric_float_uses_repr_digits(value):
+    assert decode_numeric(pgbinary.numeric(value)) == Decimal(repr(value))
+
+def test_symbol_rows_layout():
+    bar = Bar('SPY','C',stamp_epoch('2021-01-04 09:31:00'),1.5,2.0,1.0,1.75,100,1000,60)
+    data = pgbinary.symbol_rows([bar])
+    assert data.startswith(pgbinary.HEADER) and data.endswith(pgbinary.TRAILER)
+    row = data[len(pgbinary.HEADER):-len(pgbinary.TRAILER)]
+    fields, symlen = struct.unpack_from('!hi',row)
+    assert (fields,row[6:6 + symlen]) == (9,b'SPY')
+    _, days, _, micros = struct.unpack_from('!iiiq',row,6 + symlen)
+    # Postgres dates count from 2000-01-01
+    assert days == 7674 and micros == (9 * 3600 + 31 * 60) * 1000000
+
+def test_partitioned_rows_layout():
+    bar = Bar('QQQ','C',stamp_epoch('2000-01-01 00:01:00'),1.5,2.0,1.0,1.75,100,1000,60)
+    row = pgbinary.partitioned_rows([bar])[len(pgbinary.HEADER):-len(pgbinary.TRAILER)]
+    fields, symlen = struct.unpack_from('!hi',row)
+    values = struct.unpack_from('!iqididididiqiq',row,6 + symlen)
+    assert fields == 8
+    assert values[1::2] == (60000000,1.5,2.0,1.0,1.75,100,1000)
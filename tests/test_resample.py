@@ -0,0 +1,49 @@
+from bars import Bar, stamp_epoch
+from resample import Resampler
+
+def base(stamp,price,volume,kind='C'):
+    return Bar('SPY',kind,stamp_epoch(stamp),price,price + 0.5,price - 0.5,price,volume,0,60)
+
+def resampler():
+    out = []
+    return Resampler(60,{'SPY': [300]},[out.append]), out
+
+def test_bucket_emitted_on_last_base_bar():
+    r, out = resampler()
+    for i,minute in enumerate(range(31,36)):
+        r.add(base(f'2021-01-04 09:{minute}:00',100.0 + i,10))
+    assert len(out) == 1
+    bar = out[0]
+    assert bar.ts == stamp_epoch('2021-01-04 09:35:00') and bar.interval == 300
+    assert (bar.open,bar.high,bar.low,bar.close,bar.volume) == (100.0,104.5,99.5,104.0,50)
+
+def test_bucket_emitted_when_later_bar_arrives():
+    r, out = resampler()
+    r.add(base('2021-01-04 09:31:00',100.0,10))
+    r.add(base('2021-01-04 09:37:00',101.0,10))
+    assert [b.ts for b in out] == [stamp_epoch('2021-01-04 09:35:00')]
+    assert out[0].volume == 10
+
+def test_replayed_bar_inside_bucket_not_added_twice():
+    r, out = resampler()
+    r.add(base('2021-01-04 09:31:00',100.0,10))
+    r.add(base('2021-01-04 09:32:00',101.0,10))
+    r.add(base('2021-01-04 09:32:00',101.0,10,kind='H'))
+    r.add(base('2021-01-04 09:31:00',90.0,10,kind='H'))
+    for minute in (33,34,35):
+        r.add(base(f'2021-01-04 09:{minute}:00',101.0,10))
+    assert len(out) == 1
+    assert out[0].volume == 50 and out[0].low == 99.5
+
+def test_replayed_bar_of_emitted_bucket_ignored():
+    r, out = resampler()
+    for minute in range(31,36):
+        r.add(base(f'2021-01-04 09:{minute}:00',100.0,10))
+    # Resubscription replays the interval already emitted
+    for minute in range(33,36):
+        r.add(base(f'2021-01-04 09:{minute}:00',100.0,10,kind='H'))
+    assert len(out) == 1
+    r.add(base('2021-01-04 09:36:00',100.0,10))
+    r.add(base('2021-01-04 09:41:00',100.0,10))
+    assert [b.ts for b in out][1:] == [stamp_epoch('2021-01-04 09:40:00')]
+    assert out[1].volume == 10
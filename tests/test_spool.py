@@ -0,0 +1,65 @@
+import os
+from bars import Bar
+from spool import BarSpool, _HEADER, _RECORD
+
+def bars(n,start=0,symbol='SPY'):
+    return [Bar(symbol,'C',start + 60 * i,1.0 + i,2.0,0.5,1.5,10 * i,100 * i,60) for i in range(n)]
+
+def segments(path):
+    return sorted(f for f in os.listdir(path) if f.endswith('.seg'))
+
+def spool(path,records=10):
+    return BarSpool(str(path),_HEADER.size + records * _RECORD.size)
+
+def test_round_trip(tmp_path):
+    s = spool(tmp_path)
+    s.append(bars(3))
+    out = s.read(10)
+    assert [(b.symbol,b.kind,b.ts,b.open,b.volume,b.cumvol,b.interval) for b in out] == \
+           [(b.symbol,b.kind,b.ts,b.open,b.volume,b.cumvol,b.interval) for b in bars(3)]
+    s.commit()
+    assert s.pending() == 0 and s.read(10) == []
+
+def test_active_segment_read_in_place(tmp_path):
+    s = spool(tmp_path)
+    for cycle in range(4):
+        s.append(bars(2,start=1000 * cycle))
+        assert [b.ts for b in s.read(10)] == [1000 * cycle,1000 * cycle + 60]
+        s.commit()
+        # No new segment per replay cycle
+        assert segments(tmp_path) == ['spool_00000001.seg']
+    assert s.pending() == 0
+
+def test_rotates_when_full(tmp_path):
+    s = spool(tmp_path,records=4)
+    s.append(bars(10))
+    assert len(segments(tmp_path)) == 3
+    ts = []
+    while s.pending():
+        ts += [b.ts for b in s.read(3)]
+        s.commit()
+    assert ts == [60 * i for i in range(10)]
+    # Fully replayed sealed segments are deleted, the active one is kept
+    assert segments(tmp_path) == ['spool_00000003.seg']
+
+def test_append_between_read_and_commit(tmp_path):
+    s = spool(tmp_path,records=4)
+    s.append(bars(3))
+    first = s.read(10)
+    s.append(bars(3,start=1000))    # fills & seals the segment being read
+    s.commit()
+    rest = []
+    while s.pending():
+        rest += s.read(10)
+        s.commit()
+    assert [b.ts for b in first + rest] == [0,60,120,1000,1060,1120]
+
+def test_restart_resumes(tmp_path):
+    s = spool(tmp_path)
+    s.append(bars(5))
+    s.read(2)
+    s.commit()
+    s.close()
+    s = spool(tmp_path)
+    assert s.pending() == 3
+    assert [b.ts for b in s.read(10)] == [120,180,240]
@@ -0,0 +1,54 @@
+from ticks import TickBarBuilder
+
+def builder(intervals=(60,)):
+    out = []
+    return TickBarBuilder(intervals,[out.append]), out
+
+def test_bar_emitted_on_next_interval():
+    b, out = builder()
+    b.trade('SPY',6005.0,10.0,100,1000)
+    b.trade('SPY',6030.0,10.5,50,1050)
+    b.trade('SPY',6020.0,9.5,50,1100)
+    b.trade('SPY',6061.0,10.2,10,1110)
+    assert len(out) == 1
+    bar = out[0]
+    assert (bar.ts,bar.open,bar.high,bar.low,bar.close,bar.volume,bar.cumvol) == (6060,10.0,10.5,9.5,9.5,200,1100)
+
+def test_heartbeat_closes_bar():
+    b, out = builder()
+    b.trade('SPY',6005.0,10.0,100,1000)
+    b.advance(6059)
+    assert not out
+    b.advance(6060)
+    assert [bar.ts for bar in out] == [6060]
+
+def test_late_print_after_heartbeat_dropped():
+    # Trades at 6005/6050, heartbeat at 6060, then a print stamped 6059.5
+    b, out = builder()
+    b.trade('SPY',6005.0,10.0,100,1000)
+    b.trade('SPY',6050.0,10.1,100,1100)
+    b.advance(6060)
+    b.trade('SPY',6059.5,10.2,5,1105)
+    b.advance(6200)
+    assert [(bar.ts,bar.volume) for bar in out] == [(6060,200)]
+    assert b.late_prints == 1
+
+    b.trade('SPY',6061.0,10.3,7,1112)
+    b.advance(6120)
+    assert [(bar.ts,bar.volume) for bar in out] == [(6060,200),(6120,7)]
+
+def test_late_print_for_older_interval_dropped():
+    b, out = builder()
+    b.trade('SPY',6065.0,10.0,100,1000)
+    b.trade('SPY',5990.0,10.0,5,1005)
+    b.advance(6120)
+    assert [(bar.ts,bar.volume) for bar in out] == [(6120,100)]
+    assert b.late_prints == 1
+
+def test_several_intervals():
+    b, out = builder((5,15))
+    for second in range(0,15):
+        b.trade('SPY',6000.0 + second,10.0,1,second)
+    b.advance(6015)
+    assert sorted((bar.interval,bar.ts,bar.volume) for bar in out) == [
+        (5,6005,5),(5,6010,5),(5,6015,5),(15,6015,15)]
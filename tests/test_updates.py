@@ -0,0 +1,62 @@
+from barcache import BarCache
+from bars import Bar, stamp_epoch
+from updates import UpdateAggregator
+
+def bu(stamp,o,h,l,c,cumvol,volume,request_id='SPY-60'):
+    return [request_id,'BU','SPY',stamp,str(o),str(h),str(l),str(c),str(cumvol),str(volume),'0']
+
+def bc(stamp,o,h,l,c,cumvol,volume):
+    return Bar('SPY','C',stamp_epoch(stamp),o,h,l,c,volume,cumvol,60)
+
+def test_snapshot_throttled(logger):
+    agg = UpdateAggregator(logger,snapshot_seconds=1)
+    snaps = []
+    agg.subscribe(snaps.append)
+    agg.update(bu('2021-01-04 09:31:00',1.0,1.2,0.9,1.1,100,10))
+    agg.publish_due(now=10.0)
+    agg.update(bu('2021-01-04 09:31:00',1.0,1.3,0.9,1.2,150,60))
+    agg.publish_due(now=10.5)
+    assert [s.close for s in snaps] == [1.1]
+    agg.publish_due(now=11.0)
+    assert [s.close for s in snaps] == [1.1,1.2]
+    assert snaps[-1].kind == 'U' and snaps[-1].volume == 60
+
+def test_complete_bar_not_overwritten_by_stale_update(logger):
+    # BU, BC, then publish_due - the cache must keep the complete bar
+    cache = BarCache()
+    agg = UpdateAggregator(logger,snapshot_seconds=0)
+    agg.subscribe(cache.update)
+
+    agg.update(bu('2021-01-04 09:31:00',1.0,1.2,0.9,1.1,100,10))
+    complete = bc('2021-01-04 09:31:00',1.0,1.5,0.8,1.4,200,110)
+    agg.check('SPY-60',complete)
+    cache.update(complete)
+    agg.publish_due(now=1.0)
+
+    assert cache.latest('SPY',60)['volume'] == 110
+    assert cache.latest('SPY',60)['close'] == 1.4
+    assert agg.checked == 1 and agg.mismatches == 0
+
+def test_late_update_after_complete_ignored(logger):
+    cache = BarCache()
+    agg = UpdateAggregator(logger,snapshot_seconds=0)
+    agg.subscribe(cache.update)
+    agg.update(bu('2021-01-04 09:31:00',1.0,1.2,0.9,1.1,100,10))
+    complete = bc('2021-01-04 09:31:00',1.0,1.5,0.8,1.4,200,110)
+    agg.check('SPY-60',complete)
+    cache.update(complete)
+
+    agg.update(bu('2021-01-04 09:31:00',1.0,1.2,0.9,1.1,100,10))
+    agg.publish_due(now=1.0)
+    assert cache.latest('SPY',60)['volume'] == 110
+
+    # The next bar forms as usual
+    agg.update(bu('2021-01-04 09:32:00',1.4,1.4,1.3,1.3,210,10))
+    agg.publish_due(now=2.0)
+    assert cache.latest('SPY',60)['ts'] == stamp_epoch('2021-01-04 09:32:00')
+
+def test_mismatch_logged(logger):
+    agg = UpdateAggregator(logger)
+    agg.update(bu('2021-01-04 09:31:00',1.0,1.6,0.9,1.1,100,10))
+    agg.check('SPY-60',bc('2021-01-04 09:31:00',1.0,1.5,0.9,1.4,200,110))
+    assert agg.mismatches == 1 and logger.messages
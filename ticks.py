@@ -0,0 +1,422 @@
+r'''
+Level 1 trade capture - bars built locally from every trade, raw ticks stored
+
+    TradesConnection (port 5009) --bounded tick queue--> TickListener --> TickBarBuilder --> bar sinks
+                                                                      \--> TickStore (Parquet, zstd)
+
+Bars are labelled with the end of their interval like IQFeed's (a trade at
+09:30:12 is in the 09:31:00 one minute bar) and emitted on the first trade of
+a later interval, or once the T heartbeat clock passes the end of the
+interval. Intervals already delivered by the derivative port (the base
+interval and [resample] intervals) are not built from ticks. Used by the threaded
+pipeline ([pipeline] mode = threads).
+
+    [ticks]
+    enabled = false
+    intervals = 5,15            bar seconds built from trades
+    queue_batches = 2000        socket reads the tick queue holds before the reader waits
+    store = true
+    path = ticks/
+    flush_rows = 250000         ticks per Parquet part file ...
+    flush_seconds = 30          ... or seconds, whichever comes first
+'''
+
+import glob
+import os
+import queue
+import threading
+from array import array
+from time import perf_counter, monotonic
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import backpressure
+import connection
+import metrics
+from bars import Bar, day_epoch, day_string
+
+trades = metrics.registry.counter('iqfeed_trades_total','Level 1 trades parsed')
+
+class _Forming():
+    ''' The bar being built for one symbol/interval - reused for every interval '''
+
+    __slots__ = ('ts','open','high','low','close','volume','cumvol','emitted')
+
+    def __init__(self):
+        self.ts = None
+        self.emitted = None     # end of the last bar emitted
+
+class TickBarBuilder():
+    '''
+    Bars of several intervals from a stream of trades - one Bar object per completed bar
+    Trades stamped at or before the end of a bar already emitted (late prints,
+    e.g. after the heartbeat closed the interval) are counted in late_prints and dropped
+    '''
+
+    def __init__(self,intervals,sinks):
+        '''
+        intervals = bar lengths in seconds
+        sinks = callables taking one bars.Bar (e.g. db_queue.put, BarCache.update)
+        '''
+        self._intervals = sorted(intervals)
+        self._sinks = list(sinks)
+        self._forming = {}      # symbol -> [(interval, _Forming)]
+        self.late_prints = 0
+
+    def add_sink(self,sink):
+        self._sinks.append(sink)
+
+    def trade(self,symbol,ts,price,size,totalvol,received=None,dequeued=None):
+        forming = self._forming.get(symbol)
+        if forming is None:
+            forming = self._forming[symbol] = [(k,_Forming()) for k in self._intervals]
+        second = int(ts)
+        for k,b in forming:
+            end = (second // k + 1) * k
+            if b.ts != end:
+                if (b.emitted is not None and end <= b.emitted) or (b.ts is not None and end < b.ts):
+                    self.late_prints += 1
+                    continue
+                if b.ts is not None:
+                    self._emit(symbol,k,b,received,dequeued)
+                b.ts = end
+                b.open = b.high = b.low = price
+                b.volume = 0
+            elif price > b.high:
+                b.high = price
+            elif price < b.low:
+                b.low = price
+            b.close = price
+            b.volume += size
+            b.cumvol = totalvol
+
+    def advance(self,now,received=None,dequeued=None):
+        ''' Emit every bar whose interval ended at or before now (epoch seconds, Bar.ts scale) '''
+        for symbol,forming in self._forming.items():
+            for k,b in forming:
+                if b.ts is not None and b.ts <= now:
+                    self._emit(symbol,k,b,received,dequeued)
+
+    def _emit(self,symbol,k,b,received,dequeued):
+        bar = Bar(symbol,'C',b.ts,b.open,b.high,b.low,b.close,b.volume,b.cumvol,k,received,dequeued)
+        b.emitted = b.ts
+        b.ts = None
+        for sink in self._sinks:
+            sink(bar)
+
+class TickStore():
+    '''
+    Raw trades in zstd Parquet part files, one directory per day:
+    ticks/2021-01-04/part-000001.parquet with symbol (dictionary), ts, price, size, totalvol
+
+    append() adds to typed arrays; every flush_rows ticks or flush_seconds the
+    arrays are handed to a writer thread (bounded queue) that writes one part
+    file, so each part on disk is complete even if the process dies.
+    '''
+
+    schema = pa.schema([('symbol',pa.dictionary(pa.int32(),pa.string())),('ts',pa.timestamp('us')),
+                        ('price',pa.float64()),('size',pa.int64()),('totalvol',pa.int64())])
+
+    def __init__(self,root,flush_rows=250000,flush_seconds=30):
+        self._root = root
+        self._flush_rows = flush_rows
+        self._flush_seconds = flush_seconds
+        self._next_part = {}        # day -> next part number
+        self._reset()
+        self.rows_written = 0
+        self._parts = queue.Queue(maxsize=8)
+        self._writer = threading.Thread(target=self._write_parts,name='TickStoreWriter')
+        self._writer.start()
+
+    def append(self,symbol,ts,price,size,totalvol):
+        self._symbols.append(symbol)
+        self._ts.append(ts)
+        self._price.append(price)
+        self._size.append(size)
+        self._totalvol.append(totalvol)
+        if len(self._symbols) >= self._flush_rows:
+            self.flush()
+
+    def maybe_flush(self):
+        if self._symbols and monotonic() - self._started >= self._flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if not self._symbols:
+            return
+        self._parts.put((self._symbols,self._ts,self._price,self._size,self._totalvol))
+        self._reset()
+
+    def close(self):
+        ''' Flush and wait for every part to be written '''
+        self.flush()
+        self._parts.put(None)
+        self._writer.join()
+
+    def read(self,day,symbols=None,columns=None):
+        ''' pyarrow.Table of the day's (YYYY-MM-DD) trades, optionally of some symbols only '''
+        paths = sorted(glob.glob(os.path.join(self._root,day,'part-*.parquet')))
+        if not paths:
+            return TickStore.schema.empty_table()
+        filters = [('symbol','in',list(symbols))] if symbols else None
+        tables = [pq.read_table(path,columns=columns,filters=filters) for path in paths]
+        return pa.concat_tables(tables)
+
+    def _reset(self):
+        self._symbols = []
+        self._ts = array('d')
+        self._price = array('d')
+        self._size = array('q')
+        self._totalvol = array('q')
+        self._started = monotonic()
+
+    def _write_parts(self):
+        while True:
+            part = self._parts.get()
+            if part is None:
+                return
+            symbols, ts, price, size, totalvol = part
+            ts = np.frombuffer(ts,dtype=np.float64)
+            days = (ts // 86400).astype(np.int64)
+            columns = (np.array(symbols,dtype=object),(ts * 1e6).round().astype(np.int64).view('datetime64[us]'),
+                       np.frombuffer(price,dtype=np.float64),np.frombuffer(size,dtype=np.int64),
+                       np.frombuffer(totalvol,dtype=np.int64))
+            # A part can only straddle midnight
+            for day in np.unique(days):
+                rows = days == day
+                self._write_part(day_string(int(day)),[column[rows] for column in columns])
+
+    def _write_part(self,day,columns):
+        directory = os.path.join(self._root,day)
+        if day not in self._next_part:
+            os.makedirs(directory,exist_ok=True)
+            existing = glob.glob(os.path.join(directory,'part-*.parquet'))
+            self._next_part[day] = max([int(os.path.basename(p)[5:11]) for p in existing],default=0) + 1
+        path = os.path.join(directory,f'part-{self._next_part[day]:06d}.parquet')
+        self._next_part[day] += 1
+
+        symbol, ts, price, size, totalvol = columns
+        table = pa.Table.from_arrays([pa.array(symbol,type=pa.string()).dictionary_encode(),pa.array(ts),
+                                      pa.array(price),pa.array(size),pa.array(totalvol)],
+                                     schema=TickStore.schema)
+        pq.write_table(table,path + '.tmp',compression='zstd')
+        os.replace(path + '.tmp',path)
+        self.rows_written += len(ts)
+
+class TickHandler():
+    '''
+    Parses Level 1 messages (see connection.TradesConnection) - trades go to
+    the TickBarBuilder and TickStore, T heartbeats close finished bars
+
+    For logging:
+    logger.log(msg,how)
+    how = string = comination of 'f','p','t'
+    'f' = write to file; 'p' = print; 't' = Telegram message
+    '''
+
+    def __init__(self,logger,builder=None,store=None):
+        self._logger = logger
+        self._builder = builder
+        self._store = store
+        self._days = {}         # 'MM/DD/YYYY' -> epoch seconds at midnight
+        self.trades = 0
+
+    def handle_batches(self,batches):
+        ''' batches = list of (receipt time, list of messages, each a list of fields) '''
+        dequeued = perf_counter()
+        builder, store = self._builder, self._store
+        count = 0
+        for received,messages in batches:
+            for fields in messages:
+                kind = fields[0]
+                if kind == 'Q':
+                    # Message Contents: C = last qualified trade, E = extended hours, O = other trade
+                    contents = fields[7]
+                    if 'C' not in contents and 'E' not in contents and 'O' not in contents:
+                        continue
+                    symbol = fields[1]
+                    t = fields[4]
+                    day = self._days.get(fields[5])
+                    if day is None:
+                        day = self._day(fields[5])
+                    ts = day + int(t[0:2]) * 3600 + int(t[3:5]) * 60 + float(t[6:])
+                    price = float(fields[2])
+                    size = int(fields[3])
+                    totalvol = int(fields[6])
+                    if builder is not None:
+                        builder.trade(symbol,ts,price,size,totalvol,received,dequeued)
+                    if store is not None:
+                        store.append(symbol,ts,price,size,totalvol)
+                    count += 1
+                elif kind == 'T':
+                    # T,[YYYYMMDD HH:MM:SS]
+                    stamp = fields[1]
+                    if builder is not None:
+                        now = day_epoch(f'{stamp[:4]}-{stamp[4:6]}-{stamp[6:8]}') + (
+                              int(stamp[9:11]) * 3600 + int(stamp[12:14]) * 60 + int(stamp[15:17]))
+                        builder.advance(now,received,dequeued)
+                elif kind == 'n':
+                    self._logger.log(f'IQFeed: Invalid symbol {fields[1]}',how='tfp')
+                elif kind == 'E':
+                    self._logger.log(f"IQFeed Level 1 error: {','.join(fields[1:])}",how='tfp')
+                elif kind == 'S':
+                    self._logger.log(','.join(fields[1:]),how='f')
+                # P (summary on watch) & F (fundamentals) are not trades
+
+        if store is not None:
+            store.maybe_flush()
+        self.trades += count
+        trades.inc(count)
+
+    def _day(self,mdy):
+        day = day_epoch(f'{mdy[6:10]}-{mdy[0:2]}-{mdy[3:5]}')
+        self._days[mdy] = day
+        return day
+
+class TickListener(TickHandler):
+    ''' TickHandler on its own thread, draining the tick queue as Listener does '''
+
+    poll_timeout = 0.5
+
+    def __init__(self,tick_queue,logger,builder=None,store=None,name='TickListenerThread'):
+        super().__init__(logger,builder,store)
+        self._queue = tick_queue
+        self._thread = threading.Thread(target=self,name=name)
+        self._stop = threading.Event()
+
+    def __call__(self):
+        while not self._stop.is_set():
+            self._pull_queue()
+
+    def start_listening(self):
+        self._stop.clear()
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def stop_listening(self):
+        print('Waiting for tick queue to clear before killing thread')
+        self._queue.join()
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(30)
+        if self._thread.is_alive():
+            print('ERROR! Tick listener thread may still be alive!')
+
+    def _pull_queue(self):
+        try:
+            batches = [self._queue.get(timeout=TickListener.poll_timeout)]
+        except queue.Empty:
+            if self._store is not None:
+                self._store.maybe_flush()
+            return
+
+        while True:
+            try:
+                batches.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        self.handle_batches(batches)
+        for _ in batches:
+            self._queue.task_done()
+
+class TickFeed():
+    '''
+    TradesConnection + TickListener (+ TickStore) with the feed calls main.py
+    uses: start_listening, connect, subscribe_to_symbols, disconnect,
+    stop_listening, add_bar_listener, add_symbols, remove_symbols, maybe_report
+    '''
+
+    def __init__(self,logger,symbols,intervals,sinks,queue_batches=2000,store=None,report_seconds=60):
+        self._logger = logger
+        self._symbols = list(symbols)
+        self._store = store
+        self._report_seconds = report_seconds
+        self._last_report = perf_counter()
+        self._last_trades = 0
+
+        self.intervals = list(intervals)
+        self.tick_queue = backpressure.BoundedQueue(queue_batches,'block','tick_queue',logger)
+        self.builder = TickBarBuilder(intervals,sinks) if intervals else None
+        self.listener = TickListener(self.tick_queue,logger,self.builder,store)
+        self.conn = connection.TradesConnection(self.tick_queue,logger)
+
+    def add_bar_listener(self,bar_listener):
+        if self.builder is not None:
+            self.builder.add_sink(bar_listener)
+
+    def start_listening(self):
+        self.listener.start_listening()
+
+    def stop_listening(self):
+        self.listener.stop_listening()
+        if self._store is not None:
+            self._store.close()
+
+    def connect(self):
+        self.conn.connect()
+
+    def disconnect(self):
+        self.conn.disconnect()
+
+    def subscribe_to_symbols(self,config=None,latest=None):
+        self.conn.subscribe_to_symbols(self._symbols)
+
+    def add_symbols(self,symbols):
+        ''' Watch the trades of symbols not watched yet - returns them '''
+        added = [sym for sym in dict.fromkeys(symbols) if sym not in self._symbols]
+        if added:
+            self._symbols += added
+            self.conn.subscribe_to_symbols(added)
+        return added
+
+    def remove_symbols(self,symbols):
+        removed = [sym for sym in dict.fromkeys(symbols) if sym in self._symbols]
+        if removed:
+            self._symbols = [sym for sym in self._symbols if sym not in removed]
+            self.conn.unwatch_symbols(removed)
+        return removed
+
+    def queue_depths(self):
+        ''' {'ticks': tick queue backlog} - metrics gauge '''
+        return {'ticks': self.tick_queue.qsize()}
+
+    def maybe_report(self):
+        ''' Log trades/sec, tick queue backlog and reads that waited on a full queue once every report_seconds '''
+        now = perf_counter()
+        if now - self._last_report < self._report_seconds:
+            return
+        elapsed = now - self._last_report
+        self._last_report = now
+        count = self.listener.trades
+        rate = (count - self._last_trades) / elapsed
+        self._last_trades = count
+        msg = (f'Ticks: {rate:,.0f} trades/sec, backlog {self.tick_queue.qsize()}/{self.tick_queue.size}, '
+               f'{self.conn.queue_full} reads waited on a full queue')
+        if self.builder is not None and self.builder.late_prints:
+            msg += f', {self.builder.late_prints} late prints dropped'
+        self._logger.log(msg,how='f')
+
+def feed_from_config(config,symbols,sinks,logger,exclude=()):
+    '''
+    TickFeed from [ticks] (None if not enabled) - intervals in exclude (already
+    delivered by the derivative port) are dropped with a warning
+    '''
+    if not config.has_section('ticks') or not config['ticks'].getboolean('enabled',fallback=False):
+        return None
+    section = config['ticks']
+
+    intervals = []
+    for k in sorted({int(k) for k in section.get('intervals','').split(',') if k.strip()}):
+        if k in exclude:
+            print(f'WARNING: tick bar interval {k} is already built by IQFeed - ignored')
+        else:
+            intervals.append(k)
+
+    store = None
+    if section.getboolean('store',fallback=True):
+        store = TickStore(section.get('path','ticks/'),section.getint('flush_rows',fallback=250000),
+                          section.getfloat('flush_seconds',fallback=30))
+    return TickFeed(logger,symbols,intervals,sinks,section.getint('queue_batches',fallback=2000),store)
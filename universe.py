@@ -0,0 +1,213 @@
+'''
+The tracked symbols at runtime, shared by every stage
+
+SymbolRegistry is the one set of symbols the Listeners validate bars against
+(a hashed lookup, no lock) and that the feeds & database follow: symbols
+added at runtime get their tables and BW watches, removed ones are unwatched -
+nothing is restarted or paused. Changes come from
+
+    config.ini      [market] symbols is re-read when the file changes - only
+                    the difference to the previous version of the file is applied
+    control port    one line per request, one JSON reply line:
+                    ADD SPY,QQQ / REMOVE SPY / LIST
+
+    [universe]
+    watch_config = true
+    poll_seconds = 5
+    port = 0                0 = no control port
+'''
+
+import configparser
+import json
+import os
+import socketserver
+import threading
+
+class SymbolRegistry():
+    '''
+    Ordered set of symbols - membership tests read a frozenset that add/remove
+    replace (copy on write), so readers never lock. Changes are serialized and
+    handed to the callbacks registered with subscribe, after the set changed
+    '''
+
+    def __init__(self,symbols=()):
+        self._lock = threading.RLock()
+        self._order = list(dict.fromkeys(symbols))
+        self._set = frozenset(self._order)
+        self._on_add = []
+        self._on_remove = []
+
+    def __contains__(self,symbol):
+        return symbol in self._set
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+    def symbols(self):
+        return list(self._order)
+
+    def subscribe(self,on_add=None,on_remove=None):
+        ''' on_add / on_remove = callables taking the list of symbols added / removed '''
+        with self._lock:
+            if on_add is not None:
+                self._on_add.append(on_add)
+            if on_remove is not None:
+                self._on_remove.append(on_remove)
+
+    def add(self,symbols):
+        ''' Returns the symbols that were not tracked yet '''
+        with self._lock:
+            added = [sym for sym in dict.fromkeys(symbols) if sym not in self._set]
+            if added:
+                self._order = self._order + added
+                self._set = frozenset(self._order)
+                for callback in self._on_add:
+                    callback(added)
+            return added
+
+    def remove(self,symbols):
+        ''' Returns the symbols that were tracked - bars of theirs still in flight are dropped by the Listeners '''
+        with self._lock:
+            removed = [sym for sym in dict.fromkeys(symbols) if sym in self._set]
+            if removed:
+                gone = set(removed)
+                self._order = [sym for sym in self._order if sym not in gone]
+                self._set = frozenset(self._order)
+                for callback in self._on_remove:
+                    callback(removed)
+            return removed
+
+###############################################################################
+# Sources of changes
+
+class ConfigWatcher():
+    ''' Polls config.ini and applies [market] symbols changes to the registry '''
+
+    def __init__(self,registry,logger,path='config.ini',poll_seconds=5):
+        self._registry = registry
+        self._logger = logger
+        self._path = path
+        self._poll_seconds = poll_seconds
+        self._mtime = self._stat()
+        self._last = self._read_symbols()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self,name='ConfigWatcher',daemon=True)
+
+    def __call__(self):
+        while not self._stop.wait(self._poll_seconds):
+            try:
+                self.check()
+            except Exception as e:
+                self._logger.log(f'WARNING: could not apply {self._path} symbol changes: {e}',how='tfp')
+
+    def start(self):
+        self._thread.start()
+        print(f'Watching {self._path} for symbol changes')
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(self._poll_seconds + 5)
+
+    def check(self):
+        ''' Apply the symbols added to / removed from the file since the last check '''
+        mtime = self._stat()
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        symbols = self._read_symbols()
+        if not symbols:
+            # Half-written file (or no symbols at all) - keep what is tracked
+            return
+        added = [sym for sym in symbols if sym not in self._last]
+        removed = [sym for sym in self._last if sym not in symbols]
+        self._last = symbols
+        if added:
+            self._logger.log(f'{self._path}: adding {added}',how='tfp')
+            self._registry.add(added)
+        if removed:
+            self._logger.log(f'{self._path}: removing {removed}',how='tfp')
+            self._registry.remove(removed)
+
+    def _stat(self):
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_symbols(self):
+        config = configparser.ConfigParser()
+        config.read(self._path)
+        if not config.has_section('market'):
+            return []
+        return [sym.strip() for sym in config['market'].get('symbols','').split(',') if sym.strip()]
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    ''' ADD <symbols> / REMOVE <symbols> / LIST - symbols comma separated '''
+
+    def handle(self):
+        for raw in self.rfile:
+            parts = raw.decode().split()
+            if not parts:
+                continue
+            try:
+                reply = self._answer(parts)
+            except (ValueError,IndexError) as e:
+                reply = {'error': str(e)}
+            except Exception as e:
+                reply = {'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+
+    def _answer(self,parts):
+        registry = self.server.registry
+        cmd = parts[0].upper()
+        if cmd == 'LIST':
+            return registry.symbols()
+        symbols = [sym for sym in ','.join(parts[1:]).upper().split(',') if sym]
+        if not symbols:
+            raise ValueError(f'{cmd} needs symbols')
+        if cmd == 'ADD':
+            self.server.logger.log(f'Control port: adding {symbols}',how='tfp')
+            return {'added': registry.add(symbols)}
+        if cmd == 'REMOVE':
+            self.server.logger.log(f'Control port: removing {symbols}',how='tfp')
+            return {'removed': registry.remove(symbols)}
+        raise ValueError(f'Unknown request {cmd}')
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class ControlServer():
+    ''' Symbol changes on a localhost port (see _ControlHandler for the protocol) '''
+
+    def __init__(self,registry,logger,port,host='127.0.0.1'):
+        self._server = _Server((host,port),_ControlHandler)
+        self._server.registry = registry
+        self._server.logger = logger
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,name='ControlServer',daemon=True)
+
+    def start(self):
+        self._thread.start()
+        print(f'Symbol control port {self.port}')
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def watchers_from_config(config,registry,logger,path='config.ini'):
+    ''' ConfigWatcher and/or ControlServer from [universe] (started) - call stop() on each at shutdown '''
+    section = config['universe'] if config.has_section('universe') else {}
+    watchers = []
+    if str(section.get('watch_config','true')).lower() in ('1','true','yes','on'):
+        watchers.append(ConfigWatcher(registry,logger,path,float(section.get('poll_seconds',5))))
+    port = int(section.get('port',0))
+    if port:
+        watchers.append(ControlServer(registry,logger,port))
+    for watcher in watchers:
+        watcher.start()
+    return watchers
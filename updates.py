@@ -0,0 +1,152 @@
+from time import monotonic
+from bars import Bar, stamp_epoch, request_interval
+
+class FormingBar():
+    '''
+    The bar currently forming for one watch (request ID), overwritten in place
+    by every BU message - IQFeed sends the whole bar so far, so the newest
+    update is the aggregate
+    '''
+
+    __slots__ = ('symbol','interval','ts','open','high','low','close','volume','cumvol',
+                 'updates','dirty','closed')
+
+    def __init__(self,symbol,interval):
+        self.symbol = symbol
+        self.interval = interval
+        self.ts = None
+        self.open = self.high = self.low = self.close = 0.0
+        self.volume = self.cumvol = 0
+        self.updates = 0        # BU messages folded into the current bar
+        self.dirty = False      # changed since the last snapshot
+        self.closed = None      # ts of the last bar completed by a BC
+
+    def snapshot(self):
+        ''' Copy as a bars.Bar of kind 'U' '''
+        return Bar( self.symbol,'U',self.ts,self.open,self.high,self.low,self.close,
+                    self.volume,self.cumvol,self.interval)
+
+class UpdateAggregator():
+    '''
+    Folds BU update messages into one FormingBar per watch and publishes
+    snapshots of the bars that changed at most every snapshot_seconds
+
+    update() runs for every BU message and only writes into the existing
+    FormingBar (no Bar objects or containers per message). Snapshots are
+    built only when publish_due() finds the throttle interval elapsed.
+
+    check() closes the forming bar when its complete BC bar arrives - no
+    snapshot of it is published afterwards (it would replace the complete bar
+    in a BarCache) - and logs bars whose open/high/low/volume disagree with
+    what the updates showed.
+
+    For logging:
+    logger.log(msg,how)
+    '''
+
+    def __init__(self,logger,snapshot_seconds=0.25,check_complete=True):
+        self._logger = logger
+        self._snapshot_seconds = snapshot_seconds
+        self._check_complete = check_complete
+
+        self._forming = {}      # request ID -> FormingBar
+        self._dirty = []        # FormingBars changed since the last snapshot
+        self._subscribers = []
+        self._next_publish = 0.0
+
+        self.updates = 0
+        self.snapshots = 0
+        self.checked = 0
+        self.mismatches = 0
+
+    def subscribe(self,subscriber):
+        ''' subscriber = callable taking one bars.Bar of kind 'U' '''
+        self._subscribers.append(subscriber)
+
+    def update(self,fields):
+        ''' fields = one BU message (see bars.parse_bar for the layout) '''
+        bar = self._forming.get(fields[0])
+        if bar is None:
+            bar = FormingBar(fields[2],request_interval(fields[0]))
+            self._forming[fields[0]] = bar
+
+        stamp = fields[3]
+        ts = stamp_epoch(stamp)
+        if bar.closed is not None and ts <= bar.closed:
+            # Late update of a bar already completed
+            return
+        if ts != bar.ts:
+            bar.ts = ts
+            bar.updates = 0
+        bar.open = float(fields[4])
+        bar.high = float(fields[5])
+        bar.low = float(fields[6])
+        bar.close = float(fields[7])
+        bar.cumvol = int(fields[8])
+        bar.volume = int(fields[9])
+        bar.updates += 1
+        self.updates += 1
+
+        if not bar.dirty:
+            bar.dirty = True
+            self._dirty.append(bar)
+
+    def publish_due(self,now=None):
+        ''' Snapshot every changed bar to the subscribers if the throttle interval has passed '''
+        if not self._dirty:
+            return
+        now = monotonic() if now is None else now
+        if now < self._next_publish:
+            return
+        self._next_publish = now + self._snapshot_seconds
+
+        dirty, self._dirty = self._dirty, []
+        for bar in dirty:
+            bar.dirty = False
+            if self._subscribers:
+                snap = bar.snapshot()
+                for subscriber in self._subscribers:
+                    subscriber(snap)
+        self.snapshots += len(dirty)
+
+    def check(self,request_id,bar):
+        ''' bar = complete bars.Bar (kind 'C') received for request_id - closes the forming bar '''
+        forming = self._forming.get(request_id)
+        if forming is None or forming.ts != bar.ts:
+            return
+
+        if self._check_complete and forming.updates:
+            self.checked += 1
+            if (bar.open != forming.open or bar.high < forming.high or bar.low > forming.low
+                    or bar.volume < forming.volume):
+                self.mismatches += 1
+                msg = (f'BC bar disagrees with {forming.updates} updates: {bar} | '
+                       f'updates O={forming.open} H={forming.high} L={forming.low} V={forming.volume}')
+                self._logger.log(msg,how='f')
+
+        forming.updates = 0
+        forming.closed = bar.ts
+        if forming.dirty:
+            forming.dirty = False
+            self._dirty.remove(forming)
+
+    def stats(self):
+        return {'updates': self.updates,'snapshots': self.snapshots,
+                'checked': self.checked,'mismatches': self.mismatches}
+
+def aggregator_from_config(config,logger):
+    '''
+    [updates]
+    enabled = true
+    snapshot_seconds = 0.25     min seconds between snapshots
+    check_complete = true       compare BC bars with the aggregated updates
+    None if disabled
+    '''
+    if not config.has_section('updates'):
+        return None
+    section = config['updates']
+    if not section.getboolean('enabled',fallback=True):
+        return None
+    return UpdateAggregator(logger,
+                            section.getfloat('snapshot_seconds',fallback=0.25),
+                            section.getboolean('check_complete',fallback=True))